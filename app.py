@@ -1,18 +1,36 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, flash, session
+from flask import (Flask, render_template, request, jsonify, send_file, redirect, url_for, flash, session,
+                   Response, stream_with_context)
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlite3
-from database import init_db, get_db_connection, DATABASE, update_database_schema
+from database import (init_db, get_db_connection, DATABASE, update_database_schema,
+                      refresh_stock_locations, active_project_codes, match_project_code,
+                      assign_project_code, rename_project_code, refresh_parcel_status,
+                      data_versions, bulk_writes, begin_immediate, is_busy_error,
+                      sync_reservations, reservation_shortages, reserved_quantities,
+                      ReadOnlyPool)
 import openpyxl
 from openpyxl.styles import Font, Alignment, PatternFill
-from datetime import datetime
+from openpyxl.cell import WriteOnlyCell
+from datetime import datetime, timedelta
 import os
-from auth import User, has_permission
-from utils import normalize_number, normalize_date, format_excel_number
-from excel_import import ExcelImporter
+from auth import (User, has_permission, invalidate_user, require_permission,
+                  permission_denied, load_permission_matrix, PERMISSIONS,
+                  DEFAULT_ROLE_PERMISSIONS, USER_CACHE)
+from utils import normalize_number, normalize_date, format_excel_number, iso_date
+from excel_import import ExcelImporter, start_parse_pool
+from excel_styles import WorkbookStyles, row_styles, TITLE_BLUE
+from cache import TTLCache, ReportCache
+import metrics
+import normalizers
+from uploads import UploadStore, UploadError, MAX_CHUNK_SIZE
+from idempotency import idempotent
+from writer import WriteQueue, Rollback, run_in_transaction
+import archive
 import shutil
 import zipfile
+import csv
 import hashlib
 import json
 import io
@@ -32,6 +50,20 @@ ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Excel import parsing: process-pool size (1 = always serial), rows per chunk,
+# and the combined file size below which parsing stays serial
+_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+app.config['IMPORT_WORKERS'] = int(os.environ.get('MIDFLOW_IMPORT_WORKERS', min(_cpus, 4)))
+app.config['IMPORT_CHUNK_ROWS'] = 50000
+app.config['IMPORT_PARALLEL_MIN_BYTES'] = 1024 * 1024
+
+# Reception writes: 1 = serialise them through one writer thread that
+# group-commits (see writer.py); otherwise each request commits on its own
+app.config['WRITE_QUEUE'] = os.environ.get('MIDFLOW_WRITE_QUEUE', '0') == '1'
+
+# Idle read-only connections kept for reports and exports
+app.config['REPORT_READERS'] = int(os.environ.get('MIDFLOW_REPORT_READERS', 4))
+
 # Flask-Login setup
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -46,10 +78,14 @@ os.makedirs('data', exist_ok=True)
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs('templates/pages', exist_ok=True)  # Create pages folder
 
+# Chunked, resumable uploads (large packing lists and backups)
+UPLOADS = UploadStore(os.path.join(UPLOAD_FOLDER, '.partial'))
+
 if not os.path.exists(DATABASE):
     init_db()
 else:
     update_database_schema()
+load_permission_matrix()
 
 # Ensure currency column exists on order_lines (order_lines is source of truth for currency)
 def _ensure_currency_column():
@@ -72,6 +108,36 @@ def _ensure_currency_column():
         print(f"[schema] currency column check: {e}")
 _ensure_currency_column()
 
+# Item master cache for barcode lookups on the scanning path. Items rarely
+# change; manage_items invalidates on write and the TTL bounds staleness
+# from any out-of-band edit.
+ITEM_CACHE = TTLCache('items', maxsize=20000, ttl=600)
+
+def _load_item(barcode):
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT * FROM items WHERE barcode = ?', (barcode,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+def _warm_item_cache():
+    try:
+        conn = get_db_connection()
+        rows = conn.execute(
+            'SELECT * FROM items ORDER BY updated_at DESC LIMIT ?', (ITEM_CACHE.maxsize,)
+        ).fetchall()
+        conn.close()
+        ITEM_CACHE.set_many((r['barcode'], dict(r)) for r in rows)
+    except Exception as e:
+        print(f"[cache] item cache warm-up skipped: {e}")
+_warm_item_cache()
+
+# Fork the import parse workers now, while no thread has been started yet
+start_parse_pool(app.config['IMPORT_WORKERS'])
+
+metrics.register('normalizer_memo', normalizers.memo_stats)
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -196,6 +262,13 @@ def set_language():
     
     return jsonify({'success': True, 'language': language})
 
+@app.route('/api/metrics', methods=['GET'])
+@login_required
+@require_permission('manage_all')
+def get_metrics():
+    """In-process counters and cache statistics for this worker"""
+    return jsonify({'success': True, 'metrics': metrics.snapshot()})
+
 @app.route('/api/user-role', methods=['GET'])
 @login_required
 def get_user_role():
@@ -210,7 +283,7 @@ def manage_items():
     
     if request.method == 'POST':
         if not has_permission(current_user, 'manage_items'):
-            return jsonify({'success': False, 'message': 'Permission denied'}), 403
+            return permission_denied('manage_items')
         
         data = request.json
         barcode = data.get('barcode')
@@ -225,6 +298,7 @@ def manage_items():
             )
             conn.commit()
             conn.close()
+            ITEM_CACHE.invalidate(barcode)
             return jsonify({'success': True, 'message': 'Item added successfully'})
         except sqlite3.IntegrityError:
             conn.close()
@@ -239,12 +313,10 @@ def manage_items():
 @login_required
 def get_item_by_barcode(barcode):
     """Get item by barcode for validation"""
-    conn = get_db_connection()
-    item = conn.execute('SELECT * FROM items WHERE barcode = ?', (barcode,)).fetchone()
-    conn.close()
+    item = ITEM_CACHE.get_or_load(barcode, _load_item)
     
     if item:
-        return jsonify({'success': True, 'item': dict(item)})
+        return jsonify({'success': True, 'item': item})
     else:
         return jsonify({'success': False, 'message': 'Item not found'}), 404
 
@@ -256,7 +328,7 @@ def manage_packing_lists():
     
     if request.method == 'POST':
         if not has_permission(current_user, 'create_packing_list'):
-            return jsonify({'success': False, 'message': 'Permission denied'}), 403
+            return permission_denied('create_packing_list')
         
         data = request.json
         list_name = data.get('list_name')
@@ -449,7 +521,7 @@ def create_mission_details():
         # Only admin can create when one already exists
         if not has_permission(current_user, 'manage_all'):
             conn.close()
-            return jsonify({'success': False, 'message': 'Only administrators can update mission details'}), 403
+            return permission_denied('manage_all', 'Only administrators can update mission details')
     
     data = request.json
     
@@ -492,11 +564,9 @@ def create_mission_details():
 
 @app.route('/api/mission-details/<int:mission_id>', methods=['PUT'])
 @login_required
+@require_permission('manage_all', 'Only administrators can update mission details')
 def update_mission_details(mission_id):
     """Update mission details (only admin/HQ)"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Only administrators can update mission details'}), 403
-    
     conn = get_db_connection()
     data = request.json
     
@@ -568,11 +638,9 @@ def get_project(project_id):
 
 @app.route('/api/projects', methods=['POST'])
 @login_required
+@require_permission('manage_all', 'Only administrators can create projects')
 def create_project():
     """Create new project (unlimited)"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Only administrators can create projects'}), 403
-    
     conn = get_db_connection()
     data = request.json
     
@@ -598,6 +666,7 @@ def create_project():
             next_order,
             current_user.id
         ))
+        assign_project_code(conn, data.get('project_code').upper())
         
         conn.commit()
         project_id = cursor.lastrowid
@@ -614,15 +683,16 @@ def create_project():
 
 @app.route('/api/projects/<int:project_id>', methods=['PUT'])
 @login_required
+@require_permission('manage_all', 'Only administrators can update projects')
 def update_project(project_id):
     """Update project"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Only administrators can update projects'}), 403
-    
     conn = get_db_connection()
     data = request.json
     
     try:
+        new_code = data.get('project_code').upper()
+        row = conn.execute('SELECT project_code FROM projects WHERE id = ?',
+                           (project_id,)).fetchone()
         conn.execute('''
             UPDATE projects SET
                 project_name = ?,
@@ -631,10 +701,13 @@ def update_project(project_id):
             WHERE id = ?
         ''', (
             data.get('project_name'),
-            data.get('project_code').upper(),
+            new_code,
             data.get('description', ''),
             project_id
         ))
+        if row:
+            rename_project_code(conn, row['project_code'], new_code)
+        assign_project_code(conn, new_code)
         
         conn.commit()
         conn.close()
@@ -650,11 +723,9 @@ def update_project(project_id):
 
 @app.route('/api/projects/<int:project_id>', methods=['DELETE'])
 @login_required
+@require_permission('manage_all', 'Only administrators can delete projects')
 def delete_project(project_id):
     """Delete (deactivate) project"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Only administrators can delete projects'}), 403
-    
     conn = get_db_connection()
     
     try:
@@ -670,11 +741,9 @@ def delete_project(project_id):
 
 @app.route('/api/projects/reorder', methods=['POST'])
 @login_required
+@require_permission('manage_all', 'Only administrators can reorder projects')
 def reorder_projects():
     """Reorder projects"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Only administrators can reorder projects'}), 403
-    
     conn = get_db_connection()
     data = request.json
     project_ids = data.get('project_ids', [])
@@ -696,11 +765,9 @@ def reorder_projects():
 
 @app.route('/api/users', methods=['GET'])
 @login_required
+@require_permission('manage_all', 'Access denied')
 def get_users():
     """Get all users (admin only)"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Access denied'}), 403
-    
     conn = get_db_connection()
     users = conn.execute('''
         SELECT id, username, role, language, created_at
@@ -717,11 +784,9 @@ def get_users():
 
 @app.route('/api/users', methods=['POST'])
 @login_required
+@require_permission('manage_all', 'Access denied')
 def create_user():
     """Create new user (admin only)"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Access denied'}), 403
-    
     data = request.json
     username = data.get('username', '').strip()
     password = data.get('password', '').strip()
@@ -765,11 +830,9 @@ def create_user():
 
 @app.route('/api/users/<int:user_id>', methods=['PUT'])
 @login_required
+@require_permission('manage_all', 'Access denied')
 def update_user(user_id):
     """Update user (admin only)"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Access denied'}), 403
-    
     data = request.json
     username = data.get('username', '').strip()
     role = data.get('role', '').strip()
@@ -819,6 +882,7 @@ def update_user(user_id):
         
         conn.commit()
         conn.close()
+        invalidate_user(user_id)
         
         return jsonify({'success': True, 'message': 'User updated successfully'})
     
@@ -828,11 +892,9 @@ def update_user(user_id):
 
 @app.route('/api/users/<int:user_id>', methods=['DELETE'])
 @login_required
+@require_permission('manage_all', 'Access denied')
 def delete_user(user_id):
     """Delete user (admin only)"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Access denied'}), 403
-    
     # Cannot delete self
     if user_id == current_user.id:
         return jsonify({'success': False, 'message': 'You cannot delete your own account'}), 400
@@ -843,6 +905,7 @@ def delete_user(user_id):
         conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
         conn.commit()
         conn.close()
+        invalidate_user(user_id)
         
         return jsonify({'success': True, 'message': 'User deleted successfully'})
     
@@ -850,16 +913,56 @@ def delete_user(user_id):
         conn.close()
         return jsonify({'success': False, 'message': str(e)}), 500
     
+@app.route('/api/role-permissions', methods=['GET'])
+@login_required
+@require_permission('manage_all', 'Access denied')
+def get_role_permissions():
+    """Effective role → permissions matrix (admin only)"""
+    matrix = load_permission_matrix()
+    return jsonify({'success': True, 'permissions': list(PERMISSIONS),
+                    'roles': {role: sorted(perms) for role, perms in matrix.items()}})
+
+@app.route('/api/role-permissions/<role>', methods=['PUT', 'DELETE'])
+@login_required
+@require_permission('manage_all', 'Access denied')
+def set_role_permissions(role):
+    """Override a role's permissions (PUT) or restore its defaults (DELETE)"""
+    role = role.strip().upper()
+    perms = set((request.json or {}).get('permissions', [])) if request.method == 'PUT' else set()
+    unknown = perms - set(PERMISSIONS)
+    if unknown:
+        return jsonify({'success': False, 'message': f"Unknown permission(s): {', '.join(sorted(unknown))}"}), 400
+    
+    conn = get_db_connection()
+    try:
+        # Some user's role must keep manage_all, or no one could reach this
+        # endpoint again
+        after = dict(load_permission_matrix(conn))
+        after[role] = perms if request.method == 'PUT' else set(DEFAULT_ROLE_PERMISSIONS.get(role, ()))
+        held = {r[0] for r in conn.execute('SELECT DISTINCT UPPER(role) FROM users')}
+        if not any('manage_all' in after.get(r, ()) for r in held):
+            conn.close()
+            return jsonify({'success': False,
+                            'message': 'At least one user role must keep manage_all'}), 400
+        conn.execute('DELETE FROM role_permissions WHERE role = ?', (role,))
+        conn.executemany('INSERT INTO role_permissions (role, permission) VALUES (?, ?)',
+                         [(role, p) for p in sorted(perms)])
+        conn.commit()
+        matrix = load_permission_matrix(conn)
+        conn.close()
+        return jsonify({'success': True, 'role': role, 'permissions': sorted(matrix.get(role, []))})
+    except Exception as e:
+        conn.close()
+        return jsonify({'success': False, 'message': str(e)}), 500
+    
 # ============== EXCEL EXPORT ROUTES ==============
 
 @app.route('/api/export/packing-list/<int:list_id>')
 @login_required
+@require_permission('export')
 def export_packing_list(list_id):
     """Export packing list to Excel with custom formatting"""
-    if not has_permission(current_user, 'export'):
-        return jsonify({'success': False, 'message': 'Permission denied'}), 403
-    
-    conn = get_db_connection()
+    conn = _reports_db()
     
     # Get packing list info
     packing_list = conn.execute('''
@@ -935,14 +1038,29 @@ def export_packing_list(list_id):
     
     return send_file(filepath, as_attachment=True, download_name=filename)
 
+_BASIC_DATA_EXPORT_COLUMNS = [
+    ('Unique ID', 'unique_id'), ('Packing Ref', 'packing_ref'), ('Line No', 'line_no'),
+    ('Item Code', 'item_code'), ('Item Description', 'item_description'),
+    ('Qty Unit Tot', 'qty_unit_tot'), ('Packaging', 'packaging'), ('Parcel N°', 'parcel_no'),
+    ('Nb Parcels', 'nb_parcels'), ('Batch No', 'batch_no'), ('Exp Date', 'exp_date'),
+    ('Kg Total', 'kg_total'), ('dm3 Total', 'dm3_total'),
+    ('Transport Reception', 'transport_reception'), ('Sub Folder', 'sub_folder'),
+    ('Field Ref', 'field_ref'), ('Ref Op MSFL', 'ref_op_msfl'), ('Parcel Nb', 'parcel_nb'),
+    ('Weight (kg)', 'weight_kg'), ('Volume (m3)', 'volume_m3'),
+    ('Invoice/Credit Note Ref', 'invoice_credit_note_ref'),
+    ('Estim Value (EU)', 'estim_value_eu'), ('Imported At', 'imported_at'),
+]
+
 @app.route('/api/basic-data/export', methods=['GET'])
 @login_required
+@require_permission('export')
 def export_basic_data():
-    """Export basic_data to Excel"""
-    if not has_permission(current_user, 'export'):
-        return jsonify({'success': False, 'message': 'Permission denied'}), 403
-    
-    conn = get_db_connection()
+    """Export basic_data to Excel (or CSV/TSV with ?format=)"""
+    fmt = _delimited_format()
+    if fmt:
+        return _stream_delimited(fmt, 'basic_data_export', _BASIC_DATA_EXPORT_COLUMNS,
+                                 lambda c: c.execute('SELECT * FROM basic_data ORDER BY imported_at DESC'))
+    conn = _reports_db()
     data = conn.execute('SELECT * FROM basic_data ORDER BY imported_at DESC').fetchall()
     conn.close()
     
@@ -1017,49 +1135,100 @@ def export_basic_data():
     
     return send_file(filepath, as_attachment=True, download_name=filename)
 
+# ============== CHUNKED UPLOADS ==============
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Open a resumable upload: {filename, size, sha256?} → {upload_id, chunk_size, offset}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        status = UPLOADS.create(data.get('filename'), data.get('size'), current_user.id,
+                                chunk_size=data.get('chunk_size'), sha256=data.get('sha256'))
+        return jsonify({'success': True, **status})
+    except UploadError as e:
+        return jsonify({'success': False, 'message': str(e), **e.extra}), e.status
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    """Bytes received so far — the offset to resume from"""
+    try:
+        return jsonify({'success': True, **UPLOADS.status(upload_id, current_user.id)})
+    except UploadError as e:
+        return jsonify({'success': False, 'message': str(e), **e.extra}), e.status
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    """Append one chunk (raw body) at ?offset=N, checked against X-Chunk-Sha256 / X-Chunk-Crc32"""
+    try:
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return jsonify({'success': False, 'message': 'offset is required'}), 400
+        if (request.content_length or 0) > MAX_CHUNK_SIZE:
+            return jsonify({'success': False, 'message': 'Chunk too large'}), 413
+        status = UPLOADS.write_chunk(upload_id, current_user.id, offset, request.get_data(cache=False),
+                                     sha256=request.headers.get('X-Chunk-Sha256'),
+                                     crc32=request.headers.get('X-Chunk-Crc32'))
+        return jsonify({'success': True, **status})
+    except UploadError as e:
+        return jsonify({'success': False, 'message': str(e), **e.extra}), e.status
+
 # ============== EXCEL IMPORT ROUTES ==============
 
 @app.route('/api/import/preview', methods=['POST'])
 @login_required
 def preview_import():
-    """Preview Excel file before importing"""
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'message': 'No file uploaded'}), 400
-    
-    file = request.files['file']
-    file_type = request.form.get('file_type', 'file1')
-    
-    if file.filename == '':
-        return jsonify({'success': False, 'message': 'No file selected'}), 400
-    
-    if file and allowed_file(file.filename):
+    """Preview Excel file before importing (multipart file or finished upload_id)"""
+    params = request.get_json(silent=True) or request.form
+    file_type = params.get('file_type', 'file1')
+    upload_id = params.get('upload_id')
+
+    if upload_id:
+        try:
+            meta = UPLOADS.status(upload_id, current_user.id)
+            if not allowed_file(meta['filename']):
+                return jsonify({'success': False, 'message': 'Invalid file type. Only .xlsx and .xls allowed'}), 400
+            filename = secure_filename(meta['filename'])
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            UPLOADS.take(upload_id, current_user.id, filepath)
+        except UploadError as e:
+            return jsonify({'success': False, 'message': str(e), **e.extra}), e.status
+    else:
+        if 'file' not in request.files:
+            return jsonify({'success': False, 'message': 'No file uploaded'}), 400
+        
+        file = request.files['file']
+        
+        if file.filename == '':
+            return jsonify({'success': False, 'message': 'No file selected'}), 400
+        
+        if not allowed_file(file.filename):
+            return jsonify({'success': False, 'message': 'Invalid file type. Only .xlsx and .xls allowed'}), 400
         filename = secure_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
-        
-        try:
-            data_rows, columns = ExcelImporter.read_excel_file(filepath, file_type)
-            preview = data_rows[:10]  # First 10 rows for preview
-            
-            return jsonify({
-                'success': True,
-                'preview': preview,
-                'columns': columns,
-                'total_rows': len(data_rows),
-                'filename': filename
-            })
-        except Exception as e:
-            return jsonify({'success': False, 'message': f'Error reading file: {str(e)}'}), 500
     
-    return jsonify({'success': False, 'message': 'Invalid file type. Only .xlsx and .xls allowed'}), 400
+    try:
+        # First 10 rows for preview; the row count comes from sheet metadata
+        preview, columns, total_rows = ExcelImporter.preview_excel_file(filepath, file_type, rows=10)
+        
+        return jsonify({
+            'success': True,
+            'preview': preview,
+            'columns': columns,
+            'total_rows': total_rows,
+            'filename': filename
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error reading file: {str(e)}'}), 500
 
 @app.route('/api/import/execute', methods=['POST'])
 @login_required
+@require_permission('manage_items')
 def execute_import():
     """Execute the import of one or two Excel files"""
-    if not has_permission(current_user, 'manage_items'):
-        return jsonify({'success': False, 'message': 'Permission denied'}), 403
-    
     data = request.json
     file1_name = data.get('file1')
     file2_name = data.get('file2')
@@ -1073,8 +1242,7 @@ def execute_import():
         
         if not os.path.exists(file1_path):
             return jsonify({'success': False, 'message': 'File 1 not found'}), 404
-        
-        file1_data, _ = ExcelImporter.read_excel_file(file1_path, 'file1')
+        jobs = [(file1_path, 'file1')]
         
         # If second file provided, merge data
         if file2_name:
@@ -1082,15 +1250,23 @@ def execute_import():
             
             if not os.path.exists(file2_path):
                 return jsonify({'success': False, 'message': 'File 2 not found'}), 404
-            
-            file2_data, _ = ExcelImporter.read_excel_file(file2_path, 'file2')
-            merged_data = ExcelImporter.merge_data(file1_data, file2_data)
+            jobs.append((file2_path, 'file2'))
+        
+        # Parse both workbooks (and chunks of large ones) in parallel when worthwhile
+        parsed = ExcelImporter.read_excel_files(
+            jobs,
+            workers=app.config['IMPORT_WORKERS'],
+            chunk_rows=app.config['IMPORT_CHUNK_ROWS'],
+            min_parallel_bytes=app.config['IMPORT_PARALLEL_MIN_BYTES'])
+        file1_data = parsed[0]
+        if file2_name:
+            merged_data = ExcelImporter.merge_data(file1_data, parsed[1])
         else:
             merged_data = file1_data
         
         # Import to database
         source_files = f"{file1_name}" + (f" + {file2_name}" if file2_name else "")
-        imported_count, errors = ExcelImporter.import_to_database(
+        counts, errors = ExcelImporter.import_to_database(
             merged_data, 
             source_files, 
             current_user.id
@@ -1098,7 +1274,12 @@ def execute_import():
         
         return jsonify({
             'success': True,
-            'imported_count': imported_count,
+            'imported_count': counts['inserted'] + counts['updated'],
+            'inserted': counts['inserted'],
+            'updated': counts['updated'],
+            'unchanged': counts['unchanged'],
+            'duplicates': counts['duplicates'],
+            'skipped_received': counts['skipped_received'],
             'total_rows': len(merged_data),
             'errors': errors[:10] if errors else []  # Return first 10 errors
         })
@@ -1184,11 +1365,9 @@ import json
 
 @app.route('/api/backup/create', methods=['POST'])
 @login_required
+@require_permission('manage_all', 'Only administrators can create backups')
 def create_backup():
     """Create a backup zip file"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Only administrators can create backups'}), 403
-    
     try:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
@@ -1225,7 +1404,8 @@ def create_backup():
             "created_by": current_user.username,
             "db_file": "inventory.db",
             "db_sha256": db_sha256,
-            "db_size_bytes": db_size
+            "db_size_bytes": db_size,
+            "archives": [name for name, _ in archive.archive_files(DATABASE)]
         }
         
         # Create zip file
@@ -1233,6 +1413,10 @@ def create_backup():
             # Add database
             zipf.write(DATABASE, 'inventory.db')
             
+            # Add the closed years' archives
+            for name, path in archive.archive_files(DATABASE):
+                zipf.write(path, f'archive/{name}')
+            
             # Add metadata
             metadata_json = json.dumps(backup_meta, indent=2)
             zipf.writestr("backup_meta.json", metadata_json)
@@ -1251,11 +1435,9 @@ def create_backup():
 
 @app.route('/api/backup/download/<filename>')
 @login_required
+@require_permission('manage_all', 'Access denied')
 def download_backup(filename):
     """Download a backup file"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Access denied'}), 403
-    
     try:
         backup_path = os.path.join('data', 'backups', filename)
         
@@ -1318,26 +1500,35 @@ def list_backups():
 
 @app.route('/api/backup/restore', methods=['POST'])
 @login_required
+@require_permission('manage_all', 'Only administrators can restore backups')
 def restore_backup():
-    """Restore from uploaded backup file"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Only administrators can restore backups'}), 403
-    
+    """Restore from an uploaded backup file (multipart file or finished upload_id)"""
     try:
-        if 'file' not in request.files:
-            return jsonify({'success': False, 'message': 'No file uploaded'}), 400
-        
-        file = request.files['file']
-        
-        if file.filename == '':
-            return jsonify({'success': False, 'message': 'No file selected'}), 400
-        
-        if not file.filename.endswith('.zip'):
-            return jsonify({'success': False, 'message': 'Invalid file type. Only .zip files allowed'}), 400
-        
-        # Save uploaded file temporarily
         temp_zip = os.path.join('data', 'temp_restore.zip')
-        file.save(temp_zip)
+        params = request.get_json(silent=True) or request.form
+        upload_id = params.get('upload_id')
+
+        if upload_id:
+            try:
+                if not UPLOADS.status(upload_id, current_user.id)['filename'].endswith('.zip'):
+                    return jsonify({'success': False, 'message': 'Invalid file type. Only .zip files allowed'}), 400
+                UPLOADS.take(upload_id, current_user.id, temp_zip)
+            except UploadError as e:
+                return jsonify({'success': False, 'message': str(e), **e.extra}), e.status
+        else:
+            if 'file' not in request.files:
+                return jsonify({'success': False, 'message': 'No file uploaded'}), 400
+            
+            file = request.files['file']
+            
+            if file.filename == '':
+                return jsonify({'success': False, 'message': 'No file selected'}), 400
+            
+            if not file.filename.endswith('.zip'):
+                return jsonify({'success': False, 'message': 'Invalid file type. Only .zip files allowed'}), 400
+            
+            # Save uploaded file temporarily
+            file.save(temp_zip)
         
         # Extract and validate
         temp_dir = 'data/temp_restore'
@@ -1394,8 +1585,21 @@ def restore_backup():
             safety_backup = os.path.join('data', 'backups', f'pre_restore_safety_{timestamp}.db')
             shutil.copy(DATABASE, safety_backup)
         
-        # Replace current database
+        # Replace current database (the writer thread reopens it on next use)
+        if WRITE_QUEUE is not None:
+            WRITE_QUEUE.close()
         shutil.copy(extracted_db, DATABASE)
+        extracted_archives = os.path.join(temp_dir, 'archive')
+        if os.path.isdir(extracted_archives):
+            os.makedirs(archive.archive_dir(DATABASE), exist_ok=True)
+            for name in os.listdir(extracted_archives):
+                shutil.copy(os.path.join(extracted_archives, name),
+                            os.path.join(archive.archive_dir(DATABASE), name))
+        REPORT_CACHE.clear()
+        REPORTS_POOL.clear()
+        ITEM_CACHE.invalidate()         # item rows are keyed by code, not by DB
+        USER_CACHE.invalidate()         # the restored users table may differ
+        load_permission_matrix()        # and its role_permissions overrides
         
         # Clean up
         os.remove(temp_zip)
@@ -1433,11 +1637,9 @@ def restore_backup():
 
 @app.route('/api/backup/delete/<filename>', methods=['DELETE'])
 @login_required
+@require_permission('manage_all', 'Access denied')
 def delete_backup(filename):
     """Delete a backup file"""
-    if not has_permission(current_user, 'manage_all'):
-        return jsonify({'success': False, 'message': 'Access denied'}), 403
-    
     try:
         backup_path = os.path.join('data', 'backups', filename)
         
@@ -1452,6 +1654,60 @@ def delete_backup(filename):
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+# ── Closed years: history archived to data/archive (see archive.py) ──
+
+@app.route('/api/archive/years', methods=['GET'])
+@login_required
+@require_permission('manage_all', 'Access denied')
+def archive_years():
+    conn = None
+    try:
+        conn = get_db_connection()
+        rows = conn.execute('''
+            SELECT a.year, a.row_counts, a.opening_rows, a.closed_at,
+                   u.username AS closed_by_name
+            FROM archive_periods a
+            LEFT JOIN users u ON u.id = a.closed_by
+            ORDER BY a.year
+        ''').fetchall()
+        years = []
+        for r in rows:
+            path = archive.archive_path(r['year'], DATABASE)
+            years.append({**dict(r), 'row_counts': json.loads(r['row_counts'] or '{}'),
+                          'file': os.path.basename(path),
+                          'size': os.path.getsize(path) if os.path.exists(path) else None})
+        return jsonify({'success': True, 'years': years,
+                        'closable_up_to': datetime.now().year - 1})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+    finally:
+        if conn: conn.close()
+
+
+@app.route('/api/archive/close-year', methods=['POST'])
+@login_required
+@require_permission('manage_all', 'Only administrators can close years')
+def archive_close_year():
+    """Move the settled history up to the end of `year` to its archive file
+    and carry the stock balances forward as OPENING rows."""
+    data = request.get_json(silent=True) or request.form
+    try:
+        year = int(data.get('year'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'year required'}), 400
+    try:
+        result = archive.close_year(year, closed_by=current_user.id, db_path=DATABASE)
+        return jsonify({'success': True, **result})
+    except archive.ArchiveError as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status
+    except sqlite3.OperationalError as e:
+        if is_busy_error(e):
+            return jsonify({'success': False, 'message': 'busy', 'retry': True}), 503
+        return jsonify({'success': False, 'message': str(e)}), 500
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
 # ============== END USERS ROUTES ==============
 
 @app.route('/api/end-users', methods=['GET'])
@@ -1715,6 +1971,7 @@ def api_next_order_number():
 # ── CREATE order ───────────────────────────────────────────────
 @app.route('/api/orders', methods=['POST'])
 @login_required
+@idempotent
 def api_create_order():
     conn = None
     try:
@@ -1832,6 +2089,23 @@ def _cr_db():
     return conn
 
 
+# Optional single-writer queue (app.config['WRITE_QUEUE'])
+WRITE_QUEUE = WriteQueue(_cr_db, 'writer') if app.config['WRITE_QUEUE'] else None
+
+
+def _write(name, fn, *args):
+    """Run the unit of work fn(conn, *args) as a write transaction: through
+    WRITE_QUEUE when it is enabled, else on a fresh connection under
+    begin_immediate. Either way it has committed when this returns."""
+    if WRITE_QUEUE is not None:
+        return WRITE_QUEUE.run(fn, *args)
+    conn = _cr_db()
+    try:
+        return run_in_transaction(conn, fn, *args, name=name)
+    finally:
+        conn.close()
+
+
 def _cr_next_reception_number(conn, mission_abbrev='MSF'):
     """Generate next reception number: YY/ABBREV/SR{seq}"""
     year = __import__('datetime').date.today().strftime('%y')
@@ -1858,22 +2132,18 @@ def _cr_mission_abbrev(conn):
     return row['mission_abbreviation'] if row else 'MSN'
 
 
-def _cr_extract_project_code(conn, field_ref):
+def _cr_extract_project_code(conn, field_ref, codes=None):
     """Find which project_code from projects table appears inside field_ref string.
-    Example: field_ref='25/CH/CD502/PO06146' and project_code='CD502' → returns 'CD502'."""
+    Example: field_ref='25/CH/CD502/PO06146' and project_code='CD502' → returns 'CD502'.
+    Pass `codes` (from active_project_codes) when resolving many rows in one request."""
     if not field_ref:
         return None
     try:
-        codes = [r[0] for r in conn.execute(
-            "SELECT project_code FROM projects WHERE is_active=1 AND project_code IS NOT NULL AND project_code != ''"
-        ).fetchall()]
-        field_str = str(field_ref)
-        for code in codes:
-            if code and code in field_str:
-                return code
+        if codes is None:
+            codes = active_project_codes(conn)
+        return match_project_code(codes, field_ref)
     except Exception:
-        pass
-    return None
+        return None
 
 
 # ── GET mission info for reception number ─────────────────────
@@ -2017,6 +2287,22 @@ def cr_get_packing_list():
         if conn: conn.close()
 
 
+def _take_upload_json(upload_id):
+    """Load a finished upload holding a JSON array (e.g. packing-list records)."""
+    path = os.path.join(UPLOAD_FOLDER, f'{upload_id}.json')
+    UPLOADS.take(upload_id, current_user.id, path)
+    try:
+        with open(path, encoding='utf-8') as f:
+            records = json.load(f)
+    except ValueError:
+        raise UploadError('Upload is not a JSON list of records')
+    finally:
+        os.remove(path)
+    if not isinstance(records, list):
+        raise UploadError('Upload is not a JSON list of records')
+    return records
+
+
 # ── POST save packing list → basic_data (direct merge, no JOIN staging) ──
 @app.route('/api/cargo/packing-list', methods=['POST'])
 @login_required
@@ -2027,6 +2313,12 @@ def cr_save_packing_list():
         records   = data.get('records', [])
         session_id= data.get('session_id', '')
         order_type= data.get('order_type', 'International')
+        if data.get('upload_id'):
+            # Large lists arrive through /api/uploads as a JSON array of records
+            try:
+                records = _take_upload_json(data['upload_id'])
+            except UploadError as e:
+                return jsonify({'success': False, 'message': str(e), **e.extra}), e.status
         if not records:
             return jsonify({'success': False, 'message': 'No records provided'}), 400
 
@@ -2055,92 +2347,96 @@ def cr_save_packing_list():
             if r['parcel_number']:
                 received_pn.add(str(r['parcel_number']))
 
+        project_codes = active_project_codes(conn)
         bd_inserted = 0
 
-        for rec in records:
-            packing_ref = str(rec.get('packing_ref', '') or '').strip()
-            line_no     = rec.get('line_no')
-            parcel_nb   = rec.get('parcel_nb')
+        # One data_versions bump for the whole file instead of one per row
+        with bulk_writes(conn, 'basic_data'):
+            for rec in records:
+                packing_ref = str(rec.get('packing_ref', '') or '').strip()
+                line_no     = rec.get('line_no')
+                parcel_nb   = rec.get('parcel_nb')
 
-            # Barcode = packing_ref + parcel_nb  (matches physical label)
-            auto_pn   = (packing_ref + str(parcel_nb or '')).strip() or None
+                # Barcode = packing_ref + parcel_nb  (matches physical label)
+                auto_pn   = (packing_ref + str(parcel_nb or '')).strip() or None
 
-            # unique_id includes line_no so multiple items per parcel are kept
-            unique_id = f"{packing_ref}_{line_no}_{parcel_nb}"
+                # unique_id includes line_no so multiple items per parcel are kept
+                unique_id = f"{packing_ref}_{line_no}_{parcel_nb}"
 
-            # Look up cargo_summary: try exact (ref, parcel_nb) first, then just ref
-            cs = cs_by_exact.get((packing_ref, str(parcel_nb or '').strip()), {})
-            if not cs:
-                cs = cs_by_ref.get(packing_ref, {})
+                # Look up cargo_summary: try exact (ref, parcel_nb) first, then just ref
+                cs = cs_by_exact.get((packing_ref, str(parcel_nb or '').strip()), {})
+                if not cs:
+                    cs = cs_by_ref.get(packing_ref, {})
 
-            # ── Insert into packing_list (staging table, Parcel_number PK) ─
-            # NOTE: packing_list has PRIMARY KEY on Parcel_number so only the
-            # last item per parcel survives here — that is intentional for the
-            # manifest summary.  basic_data below holds ALL item rows.
-            try:
+                # ── Insert into packing_list (staging table, Parcel_number PK) ─
+                # NOTE: packing_list has PRIMARY KEY on Parcel_number so only the
+                # last item per parcel survives here — that is intentional for the
+                # manifest summary.  basic_data below holds ALL item rows.
+                try:
+                    conn.execute('''
+                        INSERT OR REPLACE INTO packing_list
+                        (Parcel_number, Packing_ref, Line_no, Item_code, Item_description,
+                         Qty_unit_tot, Packaging, Parcel_n, Nb_parcels, Batch_no,
+                         Exp_date, Kg_total, Dm3_total, Parcel_nb, cargo_session_id)
+                        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                    ''', (
+                        auto_pn, packing_ref, line_no,
+                        rec.get('item_code'), rec.get('item_description'),
+                        rec.get('qty_unit_tot'), rec.get('packaging'),
+                        rec.get('parcel_n'), rec.get('nb_parcels'),
+                        rec.get('batch_no'), rec.get('exp_date'),
+                        rec.get('kg_total'), rec.get('dm3_total'),
+                        parcel_nb, session_id,
+                    ))
+                except Exception:
+                    pass  # packing_list is secondary; basic_data is the real store
+
+                # ── Insert ALL rows into basic_data (unique per item line) ─────
+                project_code = _cr_extract_project_code(conn, cs.get('field_ref'), project_codes)
                 conn.execute('''
-                    INSERT OR REPLACE INTO packing_list
-                    (Parcel_number, Packing_ref, Line_no, Item_code, Item_description,
-                     Qty_unit_tot, Packaging, Parcel_n, Nb_parcels, Batch_no,
-                     Exp_date, Kg_total, Dm3_total, Parcel_nb, cargo_session_id)
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                    INSERT OR REPLACE INTO basic_data
+                    (unique_id, packing_ref, line_no, item_code, item_description,
+                     qty_unit_tot, packaging, parcel_no, nb_parcels, batch_no,
+                     exp_date, kg_total, dm3_total,
+                     transport_reception, sub_folder, field_ref, ref_op_msfl,
+                     parcel_nb, weight_kg, volume_m3,
+                     invoice_credit_note_ref, estim_value_eu,
+                     parcel_number, reception_status, order_type, cargo_session_id,
+                     source_file, imported_by, project_code, exp_date_iso)
+                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
                 ''', (
-                    auto_pn, packing_ref, line_no,
-                    rec.get('item_code'), rec.get('item_description'),
-                    rec.get('qty_unit_tot'), rec.get('packaging'),
-                    rec.get('parcel_n'), rec.get('nb_parcels'),
-                    rec.get('batch_no'), rec.get('exp_date'),
-                    rec.get('kg_total'), rec.get('dm3_total'),
-                    parcel_nb, session_id,
+                    unique_id,
+                    packing_ref or None,
+                    line_no,
+                    rec.get('item_code'),
+                    rec.get('item_description'),
+                    rec.get('qty_unit_tot'),
+                    rec.get('packaging'),
+                    rec.get('parcel_n'),
+                    rec.get('nb_parcels'),
+                    rec.get('batch_no'),
+                    rec.get('exp_date'),
+                    rec.get('kg_total'),
+                    rec.get('dm3_total'),
+                    cs.get('transport_reception'),
+                    cs.get('sub_folder'),
+                    cs.get('field_ref'),
+                    cs.get('ref_op_msfl'),
+                    str(parcel_nb or ''),
+                    cs.get('weight_kg'),
+                    cs.get('volume_m3'),
+                    cs.get('invoice_credit_note_ref'),
+                    cs.get('estim_value_eu'),
+                    auto_pn,          # parcel_number = barcode on physical label
+                    'Received' if auto_pn and auto_pn in received_pn else 'Pending',
+                    order_type,
+                    session_id,
+                    'Excel Import',
+                    current_user.id,
+                    project_code,
+                    iso_date(rec.get('exp_date')),
                 ))
-            except Exception:
-                pass  # packing_list is secondary; basic_data is the real store
-
-            # ── Insert ALL rows into basic_data (unique per item line) ─────
-            project_code = _cr_extract_project_code(conn, cs.get('field_ref'))
-            conn.execute('''
-                INSERT OR REPLACE INTO basic_data
-                (unique_id, packing_ref, line_no, item_code, item_description,
-                 qty_unit_tot, packaging, parcel_no, nb_parcels, batch_no,
-                 exp_date, kg_total, dm3_total,
-                 transport_reception, sub_folder, field_ref, ref_op_msfl,
-                 parcel_nb, weight_kg, volume_m3,
-                 invoice_credit_note_ref, estim_value_eu,
-                 parcel_number, reception_status, order_type, cargo_session_id,
-                 source_file, imported_by, project_code)
-                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            ''', (
-                unique_id,
-                packing_ref or None,
-                line_no,
-                rec.get('item_code'),
-                rec.get('item_description'),
-                rec.get('qty_unit_tot'),
-                rec.get('packaging'),
-                rec.get('parcel_n'),
-                rec.get('nb_parcels'),
-                rec.get('batch_no'),
-                rec.get('exp_date'),
-                rec.get('kg_total'),
-                rec.get('dm3_total'),
-                cs.get('transport_reception'),
-                cs.get('sub_folder'),
-                cs.get('field_ref'),
-                cs.get('ref_op_msfl'),
-                str(parcel_nb or ''),
-                cs.get('weight_kg'),
-                cs.get('volume_m3'),
-                cs.get('invoice_credit_note_ref'),
-                cs.get('estim_value_eu'),
-                auto_pn,          # parcel_number = barcode on physical label
-                'Received' if auto_pn and auto_pn in received_pn else 'Pending',
-                order_type,
-                session_id,
-                'Excel Import',
-                current_user.id,
-                project_code,
-            ))
-            bd_inserted += 1
+                bd_inserted += 1
 
         conn.commit()
         return jsonify({'success': True, 'pl_inserted': bd_inserted, 'bd_inserted': bd_inserted})
@@ -2258,9 +2554,110 @@ def cr_get_parcels():
         if conn: conn.close()
 
 
+def _receive_parcel_tx(conn, user_id, parcel_num, pallet, notes, session_id, exp_date, batch_no):
+    """Unit of work for one parcel reception; returns (json body, status).
+    Runs inside a write transaction (see _write) and does not commit."""
+    # Generate reception number (unique: the sequence is read under the lock)
+    abbrev     = _cr_mission_abbrev(conn)
+    recep_num  = _cr_next_reception_number(conn, abbrev)
+
+    # Claim the parcel: only rows not yet received are updated, and only
+    # those get stock_transactions below
+    rows = conn.execute('''
+        UPDATE basic_data
+        SET reception_status='Received',
+            reception_number=?,
+            received_at=CURRENT_TIMESTAMP,
+            received_by=?,
+            pallet_number=?,
+            qty_received=qty_unit_tot,
+            exp_date_received=CASE WHEN ? != '' THEN ? ELSE exp_date END,
+            batch_no_received=CASE WHEN ? != '' THEN ? ELSE batch_no END
+        WHERE parcel_number=?
+          AND (reception_status IS NULL OR reception_status != 'Received')
+        RETURNING *
+    ''', (recep_num, user_id, pallet,
+          exp_date, exp_date,
+          batch_no, batch_no,
+          parcel_num)).fetchall()
+
+    if not rows:
+        # Lost the race (or a re-scan): someone else already received it
+        first = conn.execute(
+            "SELECT reception_number, received_at FROM basic_data WHERE parcel_number=? LIMIT 1",
+            [parcel_num]).fetchone()
+        raise Rollback(({
+            'success': False,
+            'message': 'already_received',
+            'reception_number': first['reception_number'] or '',
+            'received_at': first['received_at'] or '',
+            'parcel_number': parcel_num
+        }, 409))
+
+    # Create stock_transaction records (one per claimed item line)
+    iso_updates = []
+    txn_rows = []
+    for row in rows:
+        rd = dict(row)
+        # Use reception-time exp_date/batch_no if provided; fall back to packing-list values
+        eff_exp_date = exp_date if exp_date else rd.get('exp_date', '')
+        eff_batch_no = batch_no if batch_no else rd.get('batch_no', '')
+        eff_exp_iso  = iso_date(eff_exp_date)
+        iso_updates.append((eff_exp_iso, rd['id']))
+        txn_rows.append((
+            recep_num, 'RECEPTION', parcel_num,
+            rd.get('packing_ref'), rd.get('line_no'),
+            rd.get('item_code'), rd.get('item_description'),
+            rd.get('qty_unit_tot'), rd.get('packaging'),
+            eff_batch_no, eff_exp_date, eff_exp_iso,
+            rd.get('field_ref'), rd.get('field_ref'),
+            pallet, rd.get('transport_reception'),
+            rd.get('weight_kg'), rd.get('volume_m3'),
+            rd.get('estim_value_eu'), abbrev,
+            user_id, rd.get('cargo_session_id', session_id), notes,
+            rd.get('project_code')
+        ))
+    conn.executemany('''
+        INSERT INTO stock_transactions
+        (reception_number, transaction_type, parcel_number,
+         packing_ref, line_no, item_code, item_description,
+         qty_received, packaging, batch_no, exp_date, exp_date_iso,
+         order_number, field_ref, pallet_number,
+         transport_reception, weight_kg, volume_m3, estim_value_eu,
+         mission_abbreviation, received_by, cargo_session_id, notes,
+         project_code)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    ''', txn_rows)
+
+    conn.executemany("UPDATE basic_data SET exp_date_iso=? WHERE id=?", iso_updates)
+    refresh_parcel_status(conn, [parcel_num])
+    refresh_stock_locations(conn, parcel_num)
+
+    # Also update cargo_summary if it has this parcel
+    conn.execute('''
+        UPDATE cargo_summary
+        SET reception_status='Received',
+            received_at=CURRENT_TIMESTAMP,
+            received_by=?,
+            notes=?
+        WHERE parcel_number=?
+    ''', (user_id, notes, parcel_num))
+
+    first = dict(rows[0])
+    return {
+        'success': True,
+        'reception_number': recep_num,
+        'parcel_number': parcel_num,
+        'field_ref': first.get('field_ref', ''),
+        'item_count': len(rows),
+        'pallet_number': pallet
+    }, 200
+
+
 # ── POST receive a parcel (button click or barcode scan) ───────
 @app.route('/api/cargo/receive-parcel', methods=['POST'])
 @login_required
+@idempotent
 def cr_receive_parcel_v2():
     conn = None
     try:
@@ -2278,97 +2675,42 @@ def cr_receive_parcel_v2():
 
         conn = _cr_db()
 
-        # Look up parcel rows in basic_data — NO session filter: parcels from any session are receivable
-        rows = conn.execute(
-            "SELECT * FROM basic_data WHERE parcel_number=?", [parcel_num]
-        ).fetchall()
-
-        if not rows:
+        # Look up parcel rows in basic_data — NO session filter: parcels from any session are receivable.
+        # Unknown and fully received parcels (re-scans) are answered without taking the write lock.
+        state = conn.execute('''
+            SELECT COUNT(*) AS n,
+                   SUM(reception_status = 'Received') AS received,
+                   MAX(reception_number) AS reception_number,
+                   MAX(received_at) AS received_at
+            FROM basic_data WHERE parcel_number=?
+        ''', [parcel_num]).fetchone()
+        if not state['n']:
             return jsonify({'success': False, 'message': 'not_found', 'parcel_number': parcel_num}), 404
-
-        # Check if already received
-        if all(dict(r)['reception_status'] == 'Received' for r in rows):
-            first = dict(rows[0])
+        if state['received'] == state['n']:
+            metrics.incr('reception.already_received')
             return jsonify({
                 'success': False,
                 'message': 'already_received',
-                'reception_number': first.get('reception_number', ''),
-                'received_at': first.get('received_at', ''),
+                'reception_number': state['reception_number'] or '',
+                'received_at': state['received_at'] or '',
                 'parcel_number': parcel_num
             }), 409
 
-        # Generate reception number
-        abbrev     = _cr_mission_abbrev(conn)
-        recep_num  = _cr_next_reception_number(conn, abbrev)
-
-        # Create stock_transaction records (one per item line)
-        for row in rows:
-            rd = dict(row)
-            # Use reception-time exp_date/batch_no if provided; fall back to packing-list values
-            eff_exp_date = exp_date if exp_date else rd.get('exp_date', '')
-            eff_batch_no = batch_no if batch_no else rd.get('batch_no', '')
-            conn.execute('''
-                INSERT INTO stock_transactions
-                (reception_number, transaction_type, parcel_number,
-                 packing_ref, line_no, item_code, item_description,
-                 qty_received, packaging, batch_no, exp_date,
-                 order_number, field_ref, pallet_number,
-                 transport_reception, weight_kg, volume_m3, estim_value_eu,
-                 mission_abbreviation, received_by, cargo_session_id, notes,
-                 project_code)
-                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            ''', (
-                recep_num, 'RECEPTION', parcel_num,
-                rd.get('packing_ref'), rd.get('line_no'),
-                rd.get('item_code'), rd.get('item_description'),
-                rd.get('qty_unit_tot'), rd.get('packaging'),
-                eff_batch_no, eff_exp_date,
-                rd.get('field_ref'), rd.get('field_ref'),
-                pallet, rd.get('transport_reception'),
-                rd.get('weight_kg'), rd.get('volume_m3'),
-                rd.get('estim_value_eu'), abbrev,
-                current_user.id, rd.get('cargo_session_id', session_id), notes,
-                rd.get('project_code')
-            ))
-
-        # Update basic_data rows — mark received + record qty + exp/batch
-        conn.execute('''
-            UPDATE basic_data
-            SET reception_status='Received',
-                reception_number=?,
-                received_at=CURRENT_TIMESTAMP,
-                received_by=?,
-                pallet_number=?,
-                qty_received=qty_unit_tot,
-                exp_date_received=CASE WHEN ? != '' THEN ? ELSE exp_date END,
-                batch_no_received=CASE WHEN ? != '' THEN ? ELSE batch_no END
-            WHERE parcel_number=?
-        ''', (recep_num, current_user.id, pallet,
-              exp_date, exp_date,
-              batch_no, batch_no,
-              parcel_num))
-
-        # Also update cargo_summary if it has this parcel
-        conn.execute('''
-            UPDATE cargo_summary
-            SET reception_status='Received',
-                received_at=CURRENT_TIMESTAMP,
-                received_by=?,
-                notes=?
-            WHERE parcel_number=?
-        ''', (current_user.id, notes, parcel_num))
-
-        conn.commit()
-
-        first = dict(rows[0])
-        return jsonify({
-            'success': True,
-            'reception_number': recep_num,
-            'parcel_number': parcel_num,
-            'field_ref': first.get('field_ref', ''),
-            'item_count': len(rows),
-            'pallet_number': pallet
-        })
+        # The conditional claim in _receive_parcel_tx decides which of several
+        # concurrent scanners actually receives the parcel
+        conn.close()
+        conn = None
+        result, status = _write('reception', _receive_parcel_tx, current_user.id, parcel_num,
+                                pallet, notes, session_id, exp_date, batch_no)
+        metrics.incr('reception.received' if status == 200 else 'reception.already_received')
+        return jsonify(result), status
+    except sqlite3.OperationalError as e:
+        if conn:
+            try: conn.rollback()
+            except: pass
+        if is_busy_error(e):
+            return jsonify({'success': False, 'message': 'busy', 'retry': True}), 503
+        return jsonify({'success': False, 'message': str(e)}), 500
     except Exception as e:
         if conn:
             try: conn.rollback()
@@ -2381,6 +2723,7 @@ def cr_receive_parcel_v2():
 # ── POST un-receive a parcel ──────────────────────────────────
 @app.route('/api/cargo/unreceive-parcel', methods=['POST'])
 @login_required
+@idempotent
 def cr_unreceive_parcel():
     conn = None
     try:
@@ -2408,6 +2751,8 @@ def cr_unreceive_parcel():
             SET reception_status='Pending', received_at=NULL, received_by=NULL
             WHERE parcel_number=?
         ''', (parcel_num,))
+        refresh_parcel_status(conn, [parcel_num])
+        refresh_stock_locations(conn, parcel_num)
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -2462,13 +2807,14 @@ def cr_save_local_parcels():
             if r['parcel_number']:
                 received_pn.add(str(r['parcel_number']))
 
+        project_codes = active_project_codes(conn)
         inserted = 0
         for rec in records:
             parcel_num = str(rec.get('parcel_number', '') or '').strip()
             if not parcel_num:
                 continue
             field_ref    = str(rec.get('field_ref', '') or '').strip() or None
-            project_code = rec.get('project_code') or _cr_extract_project_code(conn, field_ref)
+            project_code = rec.get('project_code') or _cr_extract_project_code(conn, field_ref, project_codes)
             status       = 'Received' if parcel_num in received_pn else 'Pending'
             # unique_id for local = LOCAL_{parcel_number} (one logical row per parcel)
             unique_id = f"LOCAL_{parcel_num}"
@@ -2513,26 +2859,20 @@ def cr_save_local_parcels():
         if conn: conn.close()
 
 
-# ── POST recalculate project codes for all existing basic_data rows ─
+# ── POST repair project codes across all existing basic_data rows ─
+# Project codes are assigned at ingest and re-resolved when a project is
+# created or renamed, so this is only an admin repair job (e.g. after a
+# restore or a manual edit of the database).
 @app.route('/api/cargo/recalculate-projects', methods=['POST'])
 @login_required
+@require_permission('manage_all', 'Only administrators can recalculate projects')
 def cr_recalculate_projects():
     conn = None
     try:
         conn = _cr_db()
-        rows = conn.execute(
-            "SELECT DISTINCT parcel_number, field_ref FROM basic_data WHERE field_ref IS NOT NULL AND parcel_number IS NOT NULL"
-        ).fetchall()
         updated = 0
-        for row in rows:
-            pcode = _cr_extract_project_code(conn, row['field_ref'])
-            if pcode:
-                conn.execute(
-                    "UPDATE basic_data SET project_code=? WHERE parcel_number=? AND (project_code IS NULL OR project_code='')",
-                    (pcode, row['parcel_number'])
-                )
-                updated += 1
-        conn.commit()
+        for code in active_project_codes(conn):
+            updated += assign_project_code(conn, code)
 
         # Sync stock_transactions.project_code from basic_data for any rows that are still NULL
         conn.execute('''
@@ -2546,6 +2886,7 @@ def cr_recalculate_projects():
             WHERE (project_code IS NULL OR project_code = '')
               AND parcel_number IS NOT NULL
         ''')
+        refresh_stock_locations(conn)
         conn.commit()
 
         return jsonify({'success': True, 'updated': updated})
@@ -2612,14 +2953,87 @@ def cr_get_local_lines():
         if conn: conn.close()
 
 
+def _receive_line_tx(conn, user_id, line_id, qty, exp_date, batch_no):
+    """Unit of work for a (partial) local order line reception; returns
+    (json body, status). The balance is read under the write lock, so two
+    scanners cannot both receive the last units. Does not commit."""
+    row = conn.execute(
+        "SELECT * FROM order_lines WHERE line_id=?", [line_id]
+    ).fetchone()
+
+    if not row:
+        return {'success': False, 'message': 'order line not found'}, 404
+
+    rd = dict(row)
+    qty_ordered  = float(rd.get('quantity') or 0)
+    qty_prev     = float(rd.get('qty_received') or 0)
+    new_qty_recv = qty_prev + qty
+
+    if new_qty_recv > qty_ordered:
+        return {
+            'success': False,
+            'message': f'Cannot receive {qty} — only {qty_ordered - qty_prev} remaining in balance'
+        }, 400
+
+    # Determine new status
+    new_status = 'Fully Received' if new_qty_recv >= qty_ordered else 'Partial'
+
+    # Generate reception number
+    abbrev    = _cr_mission_abbrev(conn)
+    recep_num = _cr_next_reception_number(conn, abbrev)
+
+    # Create stock_transaction record
+    # Note: order_lines column is 'project', not 'project_code'
+    proj_code = rd.get('project') or rd.get('project_code') or None
+    conn.execute('''
+        INSERT INTO stock_transactions
+        (reception_number, transaction_type, item_code, item_description,
+         qty_received, packaging, batch_no, exp_date, exp_date_iso,
+         order_number, field_ref,
+         mission_abbreviation, received_by, notes, project_code)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    ''', (
+        recep_num, 'RECEPTION',
+        rd.get('item_code'), rd.get('item_description'),
+        qty, rd.get('packaging'), batch_no, exp_date, iso_date(exp_date),
+        rd.get('order_number'), rd.get('order_number'),
+        abbrev, user_id, '', proj_code
+    ))
+
+    # Update order_lines
+    conn.execute('''
+        UPDATE order_lines
+        SET qty_received     = ?,
+            exp_date_received= ?,
+            batch_no_received= ?,
+            received_at      = CURRENT_TIMESTAMP,
+            received_by      = ?,
+            reception_status = ?
+        WHERE line_id=?
+    ''', (new_qty_recv, exp_date, batch_no or None,
+          user_id, new_status, line_id))
+
+    return {
+        'success': True,
+        'line_id': line_id,
+        'reception_number': recep_num,
+        'qty_ordered': qty_ordered,
+        'qty_received': new_qty_recv,
+        'balance_qty': qty_ordered - new_qty_recv,
+        'reception_status': new_status,
+        'exp_date_received': exp_date,
+        'batch_no_received': batch_no
+    }, 200
+
+
 # ── POST receive one order line (local reception) ─────────────
 @app.route('/api/cargo/receive-line', methods=['POST'])
 @login_required
+@idempotent
 def cr_receive_line():
     """Receive a specific quantity for a local order_line.
     Supports partial reception — can call multiple times until balance = 0.
     """
-    conn = None
     try:
         data     = request.json or {}
         line_id  = data.get('line_id')
@@ -2642,84 +3056,15 @@ def cr_receive_line():
         if qty <= 0:
             return jsonify({'success': False, 'message': 'qty_received must be > 0'}), 400
 
-        conn = _cr_db()
-
-        row = conn.execute(
-            "SELECT * FROM order_lines WHERE line_id=?", [line_id]
-        ).fetchone()
-
-        if not row:
-            return jsonify({'success': False, 'message': 'order line not found'}), 404
-
-        rd = dict(row)
-        qty_ordered  = float(rd.get('quantity') or 0)
-        qty_prev     = float(rd.get('qty_received') or 0)
-        new_qty_recv = qty_prev + qty
-
-        if new_qty_recv > qty_ordered:
-            return jsonify({
-                'success': False,
-                'message': f'Cannot receive {qty} — only {qty_ordered - qty_prev} remaining in balance'
-            }), 400
-
-        # Determine new status
-        new_status = 'Fully Received' if new_qty_recv >= qty_ordered else 'Partial'
-
-        # Generate reception number
-        abbrev    = _cr_mission_abbrev(conn)
-        recep_num = _cr_next_reception_number(conn, abbrev)
-
-        # Create stock_transaction record
-        # Note: order_lines column is 'project', not 'project_code'
-        proj_code = rd.get('project') or rd.get('project_code') or None
-        conn.execute('''
-            INSERT INTO stock_transactions
-            (reception_number, transaction_type, item_code, item_description,
-             qty_received, packaging, batch_no, exp_date,
-             order_number, field_ref,
-             mission_abbreviation, received_by, notes, project_code)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        ''', (
-            recep_num, 'RECEPTION',
-            rd.get('item_code'), rd.get('item_description'),
-            qty, rd.get('packaging'), batch_no, exp_date,
-            rd.get('order_number'), rd.get('order_number'),
-            abbrev, current_user.id, '', proj_code
-        ))
-
-        # Update order_lines
-        conn.execute('''
-            UPDATE order_lines
-            SET qty_received     = ?,
-                exp_date_received= ?,
-                batch_no_received= ?,
-                received_at      = CURRENT_TIMESTAMP,
-                received_by      = ?,
-                reception_status = ?
-            WHERE line_id=?
-        ''', (new_qty_recv, exp_date, batch_no or None,
-              current_user.id, new_status, line_id))
-
-        conn.commit()
-
-        return jsonify({
-            'success': True,
-            'line_id': line_id,
-            'reception_number': recep_num,
-            'qty_ordered': qty_ordered,
-            'qty_received': new_qty_recv,
-            'balance_qty': qty_ordered - new_qty_recv,
-            'reception_status': new_status,
-            'exp_date_received': exp_date,
-            'batch_no_received': batch_no
-        })
+        result, status = _write('reception', _receive_line_tx, current_user.id,
+                                line_id, qty, exp_date, batch_no)
+        return jsonify(result), status
+    except sqlite3.OperationalError as e:
+        if is_busy_error(e):
+            return jsonify({'success': False, 'message': 'busy', 'retry': True}), 503
+        return jsonify({'success': False, 'message': str(e)}), 500
     except Exception as e:
-        if conn:
-            try: conn.rollback()
-            except: pass
         return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn: conn.close()
 
 
 # ── DELETE a single cargo summary record ──────────────────────
@@ -2786,11 +3131,14 @@ def cr_summary_stats():
 @app.route('/api/cargo/backorders', methods=['GET'])
 @login_required
 def cr_backorders():
-    """Compare ordered qty (order_lines) vs received qty (stock_transactions)."""
+    """Compare ordered qty (order_lines) vs received qty (stock_transactions),
+    including receptions archived with closed years."""
     conn = None
     try:
-        conn = _cr_db()
-        rows = conn.execute('''
+        conn = _reports_db(archive.ALL_YEARS)
+        receptions = archive.source(conn, 'stock_transactions',
+                                    ('item_code', 'order_number', 'qty_received', 'transaction_type'))
+        rows = conn.execute(f'''
             SELECT
                 ol.item_code,
                 ol.item_description,
@@ -2802,7 +3150,7 @@ def cr_backorders():
             JOIN orders o ON o.id = ol.order_id
             LEFT JOIN (
                 SELECT item_code, order_number, SUM(qty_received) AS received_qty
-                FROM stock_transactions
+                FROM {receptions}
                 WHERE transaction_type = 'RECEPTION'
                 GROUP BY item_code, order_number
             ) st ON st.item_code = ol.item_code
@@ -2981,10 +3329,7 @@ def _build_packing_list_excel(conn, movement_id):
     ws.page_setup.fitToWidth  = 1
     ws.page_setup.fitToHeight = 0
 
-    title_blue  = "1F3A8A"
-    header_fill = PatternFill(start_color=title_blue, end_color=title_blue, fill_type='solid')
-    hdr_font    = Font(bold=True, color='FFFFFF', size=10)
-    bold        = Font(bold=True)
+    styles = WorkbookStyles(wb)
 
     mission = conn.execute(
         "SELECT mission_name FROM mission_details WHERE is_active=1 LIMIT 1"
@@ -2992,8 +3337,7 @@ def _build_packing_list_excel(conn, movement_id):
     mission_name = mission['mission_name'] if mission else ''
 
     # ── Header block ──────────────────────────────────────────────────────
-    ws['A1'] = 'PACKING LIST'
-    ws['A1'].font = Font(bold=True, size=16, color=title_blue)
+    styles.cell(ws, 1, 1, 'PACKING LIST', 'mf_title')
     ws.merge_cells('A1:M1')
 
     ws['A2'] = mission_name
@@ -3031,45 +3375,30 @@ def _build_packing_list_excel(conn, movement_id):
         ('Unit Price', 11), ('Currency', 10), ('Total Value', 13), ('Notes', 24),
     ]
     for col_idx, (hdr, width) in enumerate(headers, 1):
-        cell = ws.cell(row=HDR_ROW, column=col_idx, value=hdr)
-        cell.font      = hdr_font
-        cell.fill      = header_fill
-        cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+        cell = styles.cell(ws, HDR_ROW, col_idx, hdr, 'mf_header')
         ws.column_dimensions[cell.column_letter].width = width
     ws.row_dimensions[HDR_ROW].height = 22
 
     # ── Data rows ─────────────────────────────────────────────────────────
-    total_weight = total_volume = total_value = 0.0
-    alt_fill = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
-
-    for i, ln in enumerate(lines, 1):
-        r = HDR_ROW + i
-        vals = [
-            i, ln['item_code'] or '', ln['item_description'] or '',
-            ln['batch_no'] or '', ln['exp_date'] or '',
-            ln['qty'] or 0, ln['unit'] or '',
-            ln['weight_kg'] or 0, ln['volume_m3'] or 0,
-            ln['unit_price'] or 0, ln['currency'] or '', ln['total_value'] or 0,
-            ln['notes'] or '',
-        ]
-        for c, v in enumerate(vals, 1):
-            cell = ws.cell(row=r, column=c, value=v)
-            cell.alignment = Alignment(vertical='top', wrap_text=(c == 3))
-            if i % 2 == 0:
-                cell.fill = alt_fill
-        total_weight += (ln['weight_kg']   or 0)
-        total_volume += (ln['volume_m3']   or 0)
-        total_value  += (ln['total_value'] or 0)
+    rows = [
+        (i, ln['item_code'] or '', ln['item_description'] or '',
+         ln['batch_no'] or '', ln['exp_date'] or '',
+         ln['qty'] or 0, ln['unit'] or '',
+         ln['weight_kg'] or 0, ln['volume_m3'] or 0,
+         ln['unit_price'] or 0, ln['currency'] or '', ln['total_value'] or 0,
+         ln['notes'] or '')
+        for i, ln in enumerate(lines, 1)
+    ]
+    plain, alt = row_styles(len(headers), wrap_cols=(3,))
+    tr = styles.write_rows(ws, HDR_ROW + 1, rows, plain, alt)
 
     # ── Totals row ────────────────────────────────────────────────────────
-    tr = HDR_ROW + len(lines) + 1
+    totals = {1: 'TOTAL',
+              8:  round(sum(r[7] for r in rows), 3),
+              9:  round(sum(r[8] for r in rows), 3),
+              12: round(sum(r[11] for r in rows), 2)}
     for c in range(1, 14):
-        ws.cell(row=tr, column=c).fill = PatternFill(
-            start_color='D0D8F0', end_color='D0D8F0', fill_type='solid')
-    ws.cell(row=tr, column=1, value='TOTAL').font = bold
-    ws.cell(row=tr, column=8, value=round(total_weight, 3)).font = bold
-    ws.cell(row=tr, column=9, value=round(total_volume, 3)).font = bold
-    ws.cell(row=tr, column=12, value=round(total_value, 2)).font = bold
+        styles.cell(ws, tr, c, totals.get(c), 'mf_total_bold' if c in totals else 'mf_total')
 
     ws.freeze_panes = f'A{HDR_ROW + 1}'
     return wb, pl_number
@@ -3105,7 +3434,7 @@ def _build_cert_excel(conn, movement_id):
         'OROB': ('LO', 'LOAN CERTIFICATE'),
     }
     mov = conn.execute('''
-        SELECT m.*, eu.name AS end_user_name, eu.address AS end_user_address,
+        SELECT m.*, eu.name AS end_user_name, NULL AS end_user_address,
                tp.name AS third_party_name, tp.address AS third_party_address,
                md.mission_name
         FROM movements m
@@ -3142,14 +3471,9 @@ def _build_cert_excel(conn, movement_id):
     ws.page_setup.fitToWidth  = 1
     ws.page_setup.fitToHeight = 0
 
-    title_blue   = "1F3A8A"
-    hdr_fill     = PatternFill(start_color=title_blue, end_color=title_blue, fill_type='solid')
-    hdr_font     = Font(bold=True, color='FFFFFF', size=10)
-    bold         = Font(bold=True)
-    bold14       = Font(bold=True, size=14, color=title_blue)
-    thin         = Side(style='thin')
-    thin_border  = Border(left=thin, right=thin, top=thin, bottom=thin)
-    alt_fill     = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
+    styles = WorkbookStyles(wb)
+    bold   = Font(bold=True)
+    bold14 = Font(bold=True, size=14, color=TITLE_BLUE)
 
     # Column widths
     col_widths = [4, 14, 34, 8, 8, 13, 11, 12, 14]
@@ -3189,39 +3513,25 @@ def _build_cert_excel(conn, movement_id):
     HDR_ROW = 9
     hdrs = ['#', 'Item Code', 'Description', 'Qty', 'Unit', 'Batch No', 'Exp Date', 'Unit Price', 'Total Value']
     for c, h in enumerate(hdrs, 1):
-        cell = ws.cell(row=HDR_ROW, column=c, value=h)
-        cell.font      = hdr_font
-        cell.fill      = hdr_fill
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-        cell.border    = thin_border
+        styles.cell(ws, HDR_ROW, c, h, 'mf_header_boxed')
     ws.row_dimensions[HDR_ROW].height = 18
 
     # ── Data rows ─────────────────────────────────────────────────────────
-    total_value = 0.0
-    for i, ln in enumerate(lines, 1):
-        r  = HDR_ROW + i
-        tv = (ln['qty'] or 0) * (ln['unit_price'] or 0)
-        total_value += tv
-        vals = [i, ln['item_code'] or '', ln['item_description'] or '',
-                ln['qty'] or 0, ln['unit'] or '',
-                ln['batch_no'] or '', ln['exp_date'] or '',
-                ln['unit_price'] or 0, tv]
-        for c, v in enumerate(vals, 1):
-            cell = ws.cell(row=r, column=c, value=v)
-            cell.border    = thin_border
-            cell.alignment = Alignment(vertical='top', wrap_text=(c == 3))
-            if i % 2 == 0:
-                cell.fill = alt_fill
+    rows = [
+        (i, ln['item_code'] or '', ln['item_description'] or '',
+         ln['qty'] or 0, ln['unit'] or '',
+         ln['batch_no'] or '', ln['exp_date'] or '',
+         ln['unit_price'] or 0, (ln['qty'] or 0) * (ln['unit_price'] or 0))
+        for i, ln in enumerate(lines, 1)
+    ]
+    plain, alt = row_styles(len(hdrs), wrap_cols=(3,), boxed=True)
+    tr = styles.write_rows(ws, HDR_ROW + 1, rows, plain, alt)
 
     # ── Total row ─────────────────────────────────────────────────────────
-    tr = HDR_ROW + len(lines) + 1
-    total_fill = PatternFill(start_color='D0D8F0', end_color='D0D8F0', fill_type='solid')
+    totals = {1: 'TOTAL', 9: round(sum(r[8] for r in rows), 2)}
     for c in range(1, 10):
-        cell = ws.cell(row=tr, column=c)
-        cell.fill   = total_fill
-        cell.border = thin_border
-    ws.cell(row=tr, column=1, value='TOTAL').font = bold
-    ws.cell(row=tr, column=9, value=round(total_value, 2)).font = bold
+        styles.cell(ws, tr, c, totals.get(c),
+                    'mf_total_bold_boxed' if c in totals else 'mf_total_boxed')
 
     # ── Signature block ────────────────────────────────────────────────────
     sig_row = tr + 3
@@ -3266,14 +3576,9 @@ def _build_pl_from_lines(lines_data, header, conn):
     ws.page_setup.fitToWidth  = 1
     ws.page_setup.fitToHeight = 0
 
-    title_blue  = "1F3A8A"
-    header_fill = PatternFill(start_color=title_blue, end_color=title_blue, fill_type='solid')
-    hdr_font    = Font(bold=True, color='FFFFFF', size=10)
-    bold        = Font(bold=True)
-    alt_fill    = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
+    styles = WorkbookStyles(wb)
 
-    ws['A1'] = 'PACKING LIST'
-    ws['A1'].font = Font(bold=True, size=16, color=title_blue)
+    styles.cell(ws, 1, 1, 'PACKING LIST', 'mf_title')
     ws.merge_cells('A1:M1')
     ws['A2'] = mission_name
     ws['A2'].font = Font(bold=True, size=12)
@@ -3299,34 +3604,25 @@ def _build_pl_from_lines(lines_data, header, conn):
         ('Weight kg', 11), ('Volume m3', 11), ('Notes', 20),
     ]
     for col_idx, (hdr, width) in enumerate(headers, 1):
-        cell = ws.cell(row=HDR_ROW, column=col_idx, value=hdr)
-        cell.font = hdr_font; cell.fill = header_fill
-        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell = styles.cell(ws, HDR_ROW, col_idx, hdr, 'mf_header')
         ws.column_dimensions[cell.column_letter].width = width
     ws.row_dimensions[HDR_ROW].height = 22
 
-    total_weight = total_volume = 0.0
-    for i, ln in enumerate(lines_data, 1):
-        r = HDR_ROW + i
-        vals = [i, ln.get('parcel_number',''), ln.get('item_code',''),
-                ln.get('item_description',''), ln.get('batch_no',''),
-                ln.get('exp_date',''), ln.get('qty',0), ln.get('unit',''),
-                ln.get('weight_kg',0), ln.get('volume_m3',0), ln.get('notes','')]
-        for c, v in enumerate(vals, 1):
-            cell = ws.cell(row=r, column=c, value=v)
-            cell.alignment = Alignment(vertical='top', wrap_text=(c == 4))
-            if i % 2 == 0:
-                cell.fill = alt_fill
-        total_weight += (ln.get('weight_kg') or 0)
-        total_volume += (ln.get('volume_m3') or 0)
+    rows = [
+        (i, ln.get('parcel_number',''), ln.get('item_code',''),
+         ln.get('item_description',''), ln.get('batch_no',''),
+         ln.get('exp_date',''), ln.get('qty',0), ln.get('unit',''),
+         ln.get('weight_kg',0), ln.get('volume_m3',0), ln.get('notes',''))
+        for i, ln in enumerate(lines_data, 1)
+    ]
+    plain, alt = row_styles(len(headers), wrap_cols=(4,))
+    tr = styles.write_rows(ws, HDR_ROW + 1, rows, plain, alt)
 
-    tr = HDR_ROW + len(lines_data) + 1
-    tot_fill = PatternFill(start_color='D0D8F0', end_color='D0D8F0', fill_type='solid')
+    totals = {1: 'TOTAL',
+              9:  round(sum(ln.get('weight_kg') or 0 for ln in lines_data), 3),
+              10: round(sum(ln.get('volume_m3') or 0 for ln in lines_data), 3)}
     for c in range(1, 12):
-        ws.cell(row=tr, column=c).fill = tot_fill
-    ws.cell(row=tr, column=1, value='TOTAL').font = bold
-    ws.cell(row=tr, column=9, value=round(total_weight, 3)).font = bold
-    ws.cell(row=tr, column=10, value=round(total_volume, 3)).font = bold
+        styles.cell(ws, tr, c, totals.get(c), 'mf_total_bold' if c in totals else 'mf_total')
     ws.freeze_panes = f'A{HDR_ROW + 1}'
     return wb, pl_number
 
@@ -3407,6 +3703,7 @@ def mov_in_get(mov_id):
 # ── Create / Update IN movement (Draft) ──────────────────────────────────
 @app.route('/api/movements/in', methods=['POST'])
 @login_required
+@idempotent
 def mov_in_save():
     conn = None
     try:
@@ -3429,6 +3726,10 @@ def mov_in_save():
             return jsonify({'success': False,
                             'message': f'Third Party is required for {doc_type}'}), 400
 
+        movement_date = iso_date(data.get('movement_date'))
+        if not movement_date:
+            return jsonify({'success': False, 'message': 'A valid movement_date is required'}), 400
+
         lines  = data.get('lines', [])
         tw, tv_m3 = 0.0, 0.0
         for ln in lines:
@@ -3444,7 +3745,7 @@ def mov_in_save():
                     total_weight_kg=?, total_volume_m3=?, notes=?,
                     updated_at=CURRENT_TIMESTAMP
                 WHERE id=? AND movement_type='IN' AND status='Draft'
-            ''', (doc_type, data.get('movement_date'), data.get('dest_project'),
+            ''', (doc_type, movement_date, data.get('dest_project'),
                   end_user_id, third_party_id, tw, tv_m3,
                   data.get('notes'), mov_id))
             conn.execute("DELETE FROM movement_lines WHERE movement_id=?", (mov_id,))
@@ -3455,7 +3756,7 @@ def mov_in_save():
                      end_user_id, third_party_id, total_weight_kg, total_volume_m3,
                      notes, created_by, status)
                 VALUES ('IN', ?, ?, ?, ?, ?, ?, ?, ?, ?, 'Draft')
-            ''', (doc_type, data.get('movement_date'), data.get('dest_project'),
+            ''', (doc_type, movement_date, data.get('dest_project'),
                   end_user_id, third_party_id, tw, tv_m3,
                   data.get('notes'), current_user.id))
             mov_id = cur.lastrowid
@@ -3467,12 +3768,13 @@ def mov_in_save():
             conn.execute('''
                 INSERT INTO movement_lines
                     (movement_id, line_no, item_code, item_description,
-                     qty, unit, batch_no, exp_date,
+                     qty, unit, batch_no, exp_date, exp_date_iso,
                      unit_price, currency, total_value,
                      weight_kg, volume_m3, pallet_number, notes)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (mov_id, idx, ln.get('item_code'), ln.get('item_description'),
                   qty, ln.get('unit'), ln.get('batch_no'), ln.get('exp_date'),
+                  iso_date(ln.get('exp_date')),
                   unit_price, ln.get('currency', 'USD'), qty * unit_price,
                   float(ln.get('weight_kg') or 0), float(ln.get('volume_m3') or 0),
                   ln.get('pallet_number'), ln.get('notes')))
@@ -3507,6 +3809,7 @@ def mov_in_delete(mov_id):
 # ── Confirm IN movement ───────────────────────────────────────────────────
 @app.route('/api/movements/in/<int:mov_id>/confirm', methods=['POST'])
 @login_required
+@idempotent
 def mov_in_confirm(mov_id):
     conn = None
     try:
@@ -3574,48 +3877,51 @@ def mov_in_export(mov_id):
 
 def _available_stock_query(conn, project_code):
     """
-    Returns rows: item_code, item_description, batch_no, exp_date,
+    Returns rows: item_code, item_description, batch_no, exp_date, exp_key,
                   project_code, available_qty
-    Ordered by exp_date ASC (FEFO).
-    Combines: cargo receptions + confirmed IN movements - confirmed OUT movements.
+    Ordered by exp_date_iso ASC (FEFO), undated stock last.
+    Combines: cargo receptions and opening balances + confirmed IN movements - confirmed OUT movements.
+    Lines are matched on the ISO expiry, so '13/04/2030' and '2030-04-13' are one batch.
     """
     rows = conn.execute('''
         WITH receptions AS (
             SELECT item_code,
                    MAX(item_description) AS item_description,
                    COALESCE(batch_no,'') AS batch_no,
-                   COALESCE(exp_date,'') AS exp_date,
+                   COALESCE(exp_date_iso,'') AS exp_key,
+                   MAX(COALESCE(exp_date,'')) AS exp_raw,
                    project_code,
                    SUM(qty_received) AS qty
             FROM stock_transactions
-            WHERE transaction_type = 'RECEPTION'
+            WHERE transaction_type IN ('RECEPTION', 'OPENING')
               AND project_code = ?
-            GROUP BY item_code, batch_no, exp_date, project_code
+            GROUP BY item_code, COALESCE(batch_no,''), COALESCE(exp_date_iso,''), project_code
         ),
         in_mvts AS (
             SELECT ml.item_code,
                    MAX(ml.item_description) AS item_description,
                    COALESCE(ml.batch_no,'') AS batch_no,
-                   COALESCE(ml.exp_date,'') AS exp_date,
+                   COALESCE(ml.exp_date_iso,'') AS exp_key,
+                   MAX(COALESCE(ml.exp_date,'')) AS exp_raw,
                    m.dest_project AS project_code,
                    SUM(ml.qty) AS qty
             FROM movement_lines ml
             JOIN movements m ON m.id = ml.movement_id
             WHERE m.movement_type = 'IN' AND m.status = 'Confirmed'
               AND m.dest_project = ?
-            GROUP BY ml.item_code, ml.batch_no, ml.exp_date, m.dest_project
+            GROUP BY ml.item_code, COALESCE(ml.batch_no,''), COALESCE(ml.exp_date_iso,''), m.dest_project
         ),
         out_mvts AS (
             SELECT ml.item_code,
                    COALESCE(ml.batch_no,'') AS batch_no,
-                   COALESCE(ml.exp_date,'') AS exp_date,
+                   COALESCE(ml.exp_date_iso,'') AS exp_key,
                    m.source_project AS project_code,
                    SUM(ml.qty) AS qty
             FROM movement_lines ml
             JOIN movements m ON m.id = ml.movement_id
             WHERE m.movement_type = 'OUT' AND m.status = 'Confirmed'
               AND m.source_project = ?
-            GROUP BY ml.item_code, ml.batch_no, ml.exp_date, m.source_project
+            GROUP BY ml.item_code, COALESCE(ml.batch_no,''), COALESCE(ml.exp_date_iso,''), m.source_project
         ),
         all_in AS (
             SELECT * FROM receptions
@@ -3624,23 +3930,26 @@ def _available_stock_query(conn, project_code):
         ),
         total_in AS (
             SELECT item_code, MAX(item_description) AS item_description,
-                   batch_no, exp_date, project_code, SUM(qty) AS qty
+                   batch_no, exp_key, MAX(exp_raw) AS exp_raw,
+                   project_code, SUM(qty) AS qty
             FROM all_in
-            GROUP BY item_code, batch_no, exp_date, project_code
+            GROUP BY item_code, batch_no, exp_key, project_code
         )
-        SELECT ti.item_code, ti.item_description, ti.batch_no, ti.exp_date,
+        SELECT ti.item_code, ti.item_description, ti.batch_no,
+               CASE WHEN ti.exp_key != '' THEN ti.exp_key ELSE ti.exp_raw END AS exp_date,
+               ti.exp_key,
                ti.project_code,
                ti.qty - COALESCE(om.qty, 0) AS available_qty
         FROM total_in ti
         LEFT JOIN out_mvts om
                ON om.item_code    = ti.item_code
               AND om.batch_no     = ti.batch_no
-              AND om.exp_date     = ti.exp_date
+              AND om.exp_key      = ti.exp_key
               AND om.project_code = ti.project_code
         WHERE ti.qty - COALESCE(om.qty, 0) > 0
         ORDER BY
-            CASE WHEN ti.exp_date = '' OR ti.exp_date IS NULL THEN 1 ELSE 0 END,
-            ti.exp_date ASC,
+            CASE WHEN ti.exp_key = '' THEN 1 ELSE 0 END,
+            ti.exp_key ASC,
             ti.item_code ASC
     ''', (project_code, project_code, project_code)).fetchall()
     return rows
@@ -3649,15 +3958,29 @@ def _available_stock_query(conn, project_code):
 @app.route('/api/movements/stock', methods=['GET'])
 @login_required
 def mov_stock():
-    """Available stock by project (FEFO sorted). ?project=CODE"""
+    """
+    Available stock by project (FEFO sorted). ?project=CODE
+    available_qty is net of what Draft OUT movements reserve; pass
+    ?exclude=<movement id> to leave out the Draft being edited.
+    """
     project = request.args.get('project', '').strip()
     if not project:
         return jsonify({'success': False, 'message': 'project param required'}), 400
+    exclude = request.args.get('exclude', type=int)
     conn = None
     try:
         conn = _mov_db()
-        rows = _available_stock_query(conn, project)
-        return jsonify({'success': True, 'stock': [dict(r) for r in rows]})
+        reserved = reserved_quantities(conn, project, exclude)
+        stock = []
+        for r in _available_stock_query(conn, project):
+            row = dict(r)
+            held = reserved.get((row['item_code'], row['batch_no'], row['exp_key']), 0)
+            row['on_hand_qty']   = row['available_qty']
+            row['reserved_qty']  = held
+            row['available_qty'] = row['available_qty'] - held
+            if row['available_qty'] > 0:
+                stock.append(row)
+        return jsonify({'success': True, 'stock': stock})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
@@ -3722,6 +4045,7 @@ def mov_out_get(mov_id):
 
 @app.route('/api/movements/out', methods=['POST'])
 @login_required
+@idempotent
 def mov_out_save():
     conn = None
     try:
@@ -3747,24 +4071,33 @@ def mov_out_save():
             return jsonify({'success': False,
                             'message': f'Third Party is required for {doc_type}'}), 400
 
+        movement_date = iso_date(data.get('movement_date'))
+        if not movement_date:
+            return jsonify({'success': False, 'message': 'A valid movement_date is required'}), 400
+
         lines = data.get('lines', [])
         tw, tv_m3 = 0.0, 0.0
         for ln in lines:
             tw    += float(ln.get('weight_kg') or 0)
             tv_m3 += float(ln.get('volume_m3') or 0)
 
+        # Lines and their reservations are written and checked under one lock
+        begin_immediate(conn, 'movements')
         if mov_id:
-            conn.execute('''
+            cur = conn.execute('''
                 UPDATE movements SET
                     doc_type=?, movement_date=?, source_project=?, dest_project=?,
                     end_user_id=?, third_party_id=?,
                     total_weight_kg=?, total_volume_m3=?, notes=?,
                     updated_at=CURRENT_TIMESTAMP
                 WHERE id=? AND movement_type='OUT' AND status='Draft'
-            ''', (doc_type, data.get('movement_date'), source_project,
+            ''', (doc_type, movement_date, source_project,
                   data.get('dest_project') or None,
                   end_user_id, third_party_id, tw, tv_m3,
                   data.get('notes'), mov_id))
+            if not cur.rowcount:
+                conn.rollback()
+                return jsonify({'success': False, 'message': 'Draft not found'}), 404
             conn.execute("DELETE FROM movement_lines WHERE movement_id=?", (mov_id,))
         else:
             cur = conn.execute('''
@@ -3775,7 +4108,7 @@ def mov_out_save():
                      total_weight_kg, total_volume_m3,
                      notes, created_by, status)
                 VALUES ('OUT', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'Draft')
-            ''', (doc_type, data.get('movement_date'), source_project,
+            ''', (doc_type, movement_date, source_project,
                   data.get('dest_project') or None,
                   end_user_id, third_party_id, tw, tv_m3,
                   data.get('notes'), current_user.id))
@@ -3787,18 +4120,31 @@ def mov_out_save():
             conn.execute('''
                 INSERT INTO movement_lines
                     (movement_id, line_no, item_code, item_description,
-                     qty, unit, batch_no, exp_date,
+                     qty, unit, batch_no, exp_date, exp_date_iso,
                      unit_price, currency, total_value,
                      weight_kg, volume_m3, parcel_number, notes)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (mov_id, idx, ln.get('item_code'), ln.get('item_description'),
                   qty, ln.get('unit'), ln.get('batch_no'), ln.get('exp_date'),
+                  iso_date(ln.get('exp_date')),
                   unit_price, ln.get('currency', 'USD'), qty * unit_price,
                   float(ln.get('weight_kg') or 0), float(ln.get('volume_m3') or 0),
                   ln.get('parcel_number'), ln.get('notes')))
 
+        # Reserve the lines; a Draft may not hold more than other Drafts left free
+        sync_reservations(conn, mov_id)
+        short = reservation_shortages(conn, mov_id)
+        if short:
+            conn.rollback()
+            return _shortage_response(short)
+
         conn.commit()
         return jsonify({'success': True, 'id': mov_id})
+    except sqlite3.OperationalError as e:
+        if conn: conn.rollback()
+        if is_busy_error(e):
+            return jsonify({'success': False, 'message': 'busy', 'retry': True}), 503
+        return jsonify({'success': False, 'message': str(e)}), 500
     except Exception as e:
         if conn: conn.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -3806,6 +4152,23 @@ def mov_out_save():
         if conn: conn.close()
 
 
+def _shortage_response(shortages):
+    """400 answer for reservation_shortages() rows, worded like the old
+    confirm-time check and listing every short stock key."""
+    first = shortages[0]
+    held  = (f" ({first['reserved_other']:g} reserved by other drafts)"
+             if first['reserved_other'] else '')
+    return jsonify({
+        'success': False,
+        'message': (f"Insufficient stock for {first['item_code']} "
+                    f"(batch: {first['batch_no'] or '-'}, "
+                    f"exp: {first['exp_key'] or '-'}). "
+                    f"Available: {max(first['available'], 0):g}{held}, "
+                    f"Requested: {first['requested']:g}"),
+        'shortages': [dict(r) for r in shortages],
+    }), 400
+
+
 @app.route('/api/movements/out/<int:mov_id>', methods=['DELETE'])
 @login_required
 def mov_out_delete(mov_id):
@@ -3825,10 +4188,12 @@ def mov_out_delete(mov_id):
 
 @app.route('/api/movements/out/<int:mov_id>/confirm', methods=['POST'])
 @login_required
+@idempotent
 def mov_out_confirm(mov_id):
     conn = None
     try:
         conn = _mov_db()
+        begin_immediate(conn, 'movements')
         mov = conn.execute(
             "SELECT * FROM movements WHERE id=? AND movement_type='OUT' AND status='Draft'",
             (mov_id,)).fetchone()
@@ -3842,23 +4207,13 @@ def mov_out_confirm(mov_id):
             return jsonify({'success': False,
                             'message': 'Cannot confirm: no lines added'}), 400
 
-        # Server-side stock validation
-        project = mov['source_project']
-        avail   = {
-            (r['item_code'], r['batch_no'] or '', r['exp_date'] or ''): r['available_qty']
-            for r in _available_stock_query(conn, project)
-        }
-        for ln in lines:
-            key   = (ln['item_code'], ln['batch_no'] or '', ln['exp_date'] or '')
-            stock = avail.get(key, 0)
-            if (ln['qty'] or 0) > stock:
-                return jsonify({
-                    'success': False,
-                    'message': (f"Insufficient stock for {ln['item_code']} "
-                                f"(batch: {ln['batch_no'] or '-'}, "
-                                f"exp: {ln['exp_date'] or '-'}). "
-                                f"Available: {stock}, Requested: {ln['qty']}")
-                }), 400
+        # Server-side stock validation, against this Draft's own keys only:
+        # on hand minus what the other Drafts reserve must cover every key
+        sync_reservations(conn, mov_id)
+        short = reservation_shortages(conn, mov_id)
+        if short:
+            conn.rollback()
+            return _shortage_response(short)
 
         doc_num = generate_doc_number(conn, mov['doc_type'])
         conn.execute(
@@ -3868,8 +4223,19 @@ def mov_out_confirm(mov_id):
         conn.execute(
             "UPDATE movement_lines SET document_number=? WHERE movement_id=?",
             (doc_num, mov_id))
+        # The confirmed lines now count against on-hand stock directly
+        sync_reservations(conn, mov_id)
+        parcels = {ln['parcel_number'] for ln in lines if ln['parcel_number']}
+        refresh_parcel_status(conn, list(parcels))
+        for parcel in parcels:
+            refresh_stock_locations(conn, parcel)
         conn.commit()
         return jsonify({'success': True, 'document_number': doc_num})
+    except sqlite3.OperationalError as e:
+        if conn: conn.rollback()
+        if is_busy_error(e):
+            return jsonify({'success': False, 'message': 'busy', 'retry': True}), 503
+        return jsonify({'success': False, 'message': str(e)}), 500
     except Exception as e:
         if conn: conn.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -3977,6 +4343,15 @@ def dispatch_packing_list():
         if conn: conn.close()
 
 
+# Quantity of a basic_data line already held by Draft OUT movements
+_PARCEL_RESERVED_SQL = '''
+    (SELECT COALESCE(SUM(sr.qty), 0) FROM stock_reservations sr
+     WHERE sr.parcel_number = basic_data.parcel_number
+       AND sr.item_code     = basic_data.item_code
+       AND sr.batch_no      = COALESCE(basic_data.batch_no_received, basic_data.batch_no, '')
+    ) AS reserved_qty'''
+
+
 # ── Dispatch: received items (FEFO sorted for parcel-based OUT) ────────────
 @app.route('/api/dispatch/items', methods=['GET'])
 @login_required
@@ -3987,14 +4362,16 @@ def dispatch_items():
     cargo_q    = request.args.get('cargo') or None
     conn = None
     try:
-        conn = _cr_db()
+        conn = _reports_db()
         q  = '''
             SELECT parcel_number, item_code, item_description,
                    COALESCE(batch_no_received, batch_no)       AS batch_no,
                    COALESCE(exp_date_received, exp_date)       AS exp_date,
+                   exp_date_iso,
                    qty_unit_tot AS qty, packaging AS unit,
                    weight_kg, volume_m3, pallet_number, project_code,
-                   packing_ref, field_ref, cargo_session_id, received_at
+                   packing_ref, field_ref, cargo_session_id, received_at,
+                   parcel_status, ''' + _PARCEL_RESERVED_SQL + '''
             FROM basic_data
             WHERE reception_number IS NOT NULL AND parcel_number IS NOT NULL
         '''
@@ -4009,7 +4386,7 @@ def dispatch_items():
         if cargo_q:
             q += ' AND cargo_session_id LIKE ?';     params.append(f'%{cargo_q}%')
         q += ''' ORDER BY project_code ASC,
-                          COALESCE(exp_date_received, exp_date) ASC,
+                          exp_date_iso IS NULL, exp_date_iso ASC,
                           parcel_number ASC'''
         rows = conn.execute(q, params).fetchall()
         return jsonify({'success': True, 'items': [dict(r) for r in rows]})
@@ -4025,14 +4402,14 @@ def dispatch_items():
 def dispatch_parcel_contents(parcel_number):
     conn = None
     try:
-        conn = _cr_db()
+        conn = _reports_db()
         rows = conn.execute(
             '''SELECT parcel_number, item_code, item_description,
                       COALESCE(batch_no_received, batch_no) AS batch_no,
                       COALESCE(exp_date_received, exp_date) AS exp_date,
                       qty_unit_tot AS qty, packaging AS unit,
                       weight_kg, volume_m3, pallet_number, project_code,
-                      packing_ref, field_ref, cargo_session_id
+                      packing_ref, field_ref, cargo_session_id, ''' + _PARCEL_RESERVED_SQL + '''
                FROM basic_data
                WHERE parcel_number=? AND reception_number IS NOT NULL
                ORDER BY line_no''',
@@ -4045,109 +4422,261 @@ def dispatch_parcel_contents(parcel_number):
         if conn: conn.close()
 
 
-# ── Dispatch parcel map — all parcels with status ────────────────────────
+# ── Dispatch parcel map — parcels with lifecycle status, paginated ───────
+# Parcels come in idx_bd_parcel_order order; a page starts after the key of
+# the previous page's last parcel (keyset), so deep pages cost the same as
+# the first one.
+_PARCEL_MAP_KEY = ("COALESCE(project_code, '')", "COALESCE(packing_ref, '')",
+                   "CAST(parcel_number AS INTEGER)", "parcel_number")
+_PARCEL_STATUSES = ('pending', 'received', 'dispatched')
+
+
 @app.route('/api/dispatch/parcel-map', methods=['GET'])
 @login_required
 def dispatch_parcel_map():
+    """
+    One page of parcels with their lifecycle status. Pass the returned
+    next_after as ?after= to get the following page (null on the last one).
+    """
     project = request.args.get('project') or None
     search  = request.args.get('search')  or None
+    status  = request.args.get('status')  or None
+    after   = request.args.get('after')   or None
+    try:
+        limit = min(max(int(request.args.get('limit', 500)), 1), 5000)
+        if after is not None:
+            after = json.loads(after)
+            if not isinstance(after, list) or len(after) != 4:
+                raise ValueError
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid limit or after'}), 400
+    if status and status not in _PARCEL_STATUSES:
+        return jsonify({'success': False, 'message': 'Invalid status'}), 400
     conn = None
     try:
-        conn = get_db_connection()
-        # Get set of dispatched parcel numbers (in confirmed OUT movements)
-        try:
-            disp_rows = conn.execute(
-                '''SELECT DISTINCT ml.parcel_number FROM movement_lines ml
-                   JOIN movements m ON ml.movement_id = m.id
-                   WHERE m.movement_type='OUT' AND m.status='Confirmed'
-                     AND ml.parcel_number IS NOT NULL AND ml.parcel_number != ""'''
-            ).fetchall()
-            dispatched_parcels = {r['parcel_number'] for r in disp_rows}
-        except Exception:
-            dispatched_parcels = set()
-
-        q = '''
-            SELECT parcel_number, project_code, packing_ref, pallet_number, order_type,
-                   field_ref, COUNT(*) AS item_count,
-                   SUM(weight_kg) AS total_weight,
-                   MAX(reception_number) AS reception_number
-            FROM basic_data
-            WHERE parcel_number IS NOT NULL AND parcel_number != ""
-        '''
+        conn = _reports_db()
+        where  = " WHERE parcel_number IS NOT NULL AND parcel_number != ''"
         params = []
-        if project:
-            q += ' AND project_code = ?'; params.append(project)
         if search:
-            q += ' AND (parcel_number LIKE ? OR packing_ref LIKE ?)'; params += [f'%{search}%', f'%{search}%']
-        q += ' GROUP BY parcel_number ORDER BY project_code ASC, packing_ref ASC, CAST(parcel_number AS INTEGER) ASC'
+            where += ' AND (parcel_number LIKE ? OR packing_ref LIKE ?)'; params += [f'%{search}%', f'%{search}%']
+
+        # Per-status parcel counts for the current project/search (drives the
+        # filter UI). Each is a range of idx_bd_parcel_status, grouped in index order.
+        counts = {}
+        for st in _PARCEL_STATUSES:
+            counts[st] = conn.execute(
+                'SELECT COUNT(*) FROM (SELECT 1 FROM basic_data' + where
+                + ' AND parcel_status = ?' + (' AND project_code = ?' if project else '')
+                + ' GROUP BY project_code, parcel_number)',
+                params + [st] + ([project] if project else [])).fetchone()[0]
+
+        # With the project fixed, leave it out of the key: SQLite does not see
+        # that a column pinned by "=" keeps the index order and would sort.
+        key = _PARCEL_MAP_KEY
+        if project:
+            where += f" AND {key[0]} = ?"; params.append(project)
+            key = key[1:]
+        if status:
+            # "+" keeps the planner on the order index rather than the status one
+            where += ' AND +parcel_status = ?'; params.append(status)
+            total = counts[status]
+        else:
+            total = sum(counts.values())
+        if after is not None:
+            cursor = after[-len(key):]
+            if not project:
+                # The leading bound is what lets the row value start an index range
+                where += f' AND {key[0]} >= ?'; params.append(cursor[0])
+            where += f" AND ({', '.join(key)}) > ({', '.join('?' * len(key))})"
+            params += cursor
+        key_sql = ', '.join(key)
 
-        rows = conn.execute(q, params).fetchall()
-        result = []
-        for r in rows:
-            d = dict(r)
-            if r['parcel_number'] in dispatched_parcels:
-                d['status'] = 'dispatched'
-            elif r['reception_number']:
-                d['status'] = 'received'
-            else:
-                d['status'] = 'pending'
-            result.append(d)
-        return jsonify({'success': True, 'parcels': result})
+        rows = conn.execute(f'''
+            SELECT parcel_number, MAX(project_code) AS project_code,
+                   MAX(packing_ref) AS packing_ref, MAX(pallet_number) AS pallet_number,
+                   MAX(order_type) AS order_type, MAX(field_ref) AS field_ref,
+                   COUNT(*) AS item_count,
+                   SUM(weight_kg) AS total_weight,
+                   MAX(reception_number) AS reception_number,
+                   CASE MAX(CASE parcel_status WHEN 'dispatched' THEN 2
+                                               WHEN 'received'   THEN 1 ELSE 0 END)
+                        WHEN 2 THEN 'dispatched' WHEN 1 THEN 'received' ELSE 'pending'
+                   END AS status,
+                   COALESCE(project_code, '') AS k1, COALESCE(packing_ref, '') AS k2,
+                   CAST(parcel_number AS INTEGER) AS k3
+            FROM basic_data{where}
+            GROUP BY {key_sql}
+            ORDER BY {key_sql}
+            LIMIT ?
+        ''', params + [limit]).fetchall()
+        parcels = [dict(r) for r in rows]
+        next_after = None
+        if len(parcels) == limit:
+            last = parcels[-1]
+            next_after = json.dumps([last['k1'], last['k2'], last['k3'], last['parcel_number']])
+        for p in parcels:
+            del p['k1'], p['k2'], p['k3']
+        return jsonify({'success': True, 'parcels': parcels, 'counts': counts,
+                        'total': total, 'limit': limit, 'next_after': next_after})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
         if conn: conn.close()
 
 
+# ── Report cache ──────────────────────────────────────────────────────────
+# Report rows and export files are reused until one of the tables the report
+# reads is written (data_versions triggers bump on every write).
+REPORT_CACHE = ReportCache('reports', maxsize=128, ttl=3600,
+                           disk_dir=os.path.join('data', 'report_cache'))
+
+_RECEPTION_TABLES = ('basic_data', 'users')
+_STOCK_TABLES     = ('basic_data', 'stock_transactions', 'movements', 'movement_lines')
+_MOVEMENT_TABLES  = ('movements', 'movement_lines', 'users', 'end_users', 'third_parties')
+
+
+def _report_versions(conn, tables):
+    try:
+        return data_versions(conn, tables)
+    except sqlite3.OperationalError:
+        return None     # no data_versions table yet (e.g. a just-restored old backup)
+
+
+def _cached_report(conn, report, tables, filters, load):
+    """load() for this report and filters, reused until one of `tables` changes."""
+    versions = _report_versions(conn, tables)
+    if versions is None:
+        return load()
+    return REPORT_CACHE.get_or_load(ReportCache.key(report, filters, versions), load)
+
+
+def _cached_export(conn, report, tables, filters, build):
+    """XLSX bytes from build(), reused until one of `tables` (or the mission) changes."""
+    versions = _report_versions(conn, tables + ('mission_details',))
+    if versions is None:
+        return build()
+    return REPORT_CACHE.file_or_build(ReportCache.key(f'{report}.xlsx', filters, versions), build)
+
+
+def _xlsx_response(data, fname):
+    return send_file(io.BytesIO(data), as_attachment=True, download_name=fname,
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+
+# ── Delimited-text exports (?format=csv or ?format=tsv) ───────────────────
+_STREAM_BATCH_ROWS = 500
+
+
+def _delimited_format():
+    fmt = (request.args.get('format') or '').lower()
+    return fmt if fmt in ('csv', 'tsv') else None
+
+
+def _stream_delimited(fmt, fname_base, columns, query, date_from=None):
+    """
+    Stream query(conn) as CSV/TSV straight from the cursor.
+    columns: [(header, key)] — each row is read as row[key]. date_from is
+    handed to _reports_db, so archived years are read when it reaches them.
+    The generator opens its own connection because the route's one is closed
+    as soon as the response object is returned. Floats are written for the
+    user's language; a decimal comma also switches the CSV separator to ';'.
+    """
+    locale    = getattr(current_user, 'language', None) or 'en'
+    delimiter = '\t' if fmt == 'tsv' else (';' if locale in ('fr', 'es') else ',')
+    keys      = [k for _, k in columns]
+
+    def generate():
+        buf    = io.StringIO()
+        writer = csv.writer(buf, delimiter=delimiter, lineterminator='\r\n')
+
+        def flush():
+            out = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return out
+
+        writer.writerow([h for h, _ in columns])
+        yield flush()
+        conn = _reports_db(date_from)
+        try:
+            n = 0
+            for row in query(conn):
+                writer.writerow([format_excel_number(round(v, 6), locale) if isinstance(v, float) else v
+                                 for v in (row[k] for k in keys)])
+                n += 1
+                if n % _STREAM_BATCH_ROWS == 0:
+                    yield flush()
+            yield flush()
+        finally:
+            conn.close()
+
+    ext  = 'tsv' if fmt == 'tsv' else 'csv'
+    mime = 'text/tab-separated-values' if fmt == 'tsv' else 'text/csv'
+    fname = f"{fname_base}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}"
+    return Response(stream_with_context(generate()), mimetype=f'{mime}; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename="{fname}"'})
+
+
+def _reception_filters():
+    return {k: request.args.get(k) or None
+            for k in ('project', 'order_type', 'reception_number',
+                      'cargo_session', 'date_from', 'date_to')}
+
+
+def _reception_sql(f):
+    """(sql, params) for received parcels matching the reception report filters, newest first."""
+    q = '''
+        SELECT b.parcel_number, b.field_ref, b.project_code, b.order_type,
+               MAX(b.pallet_number) AS pallet_number,
+               COUNT(*) AS item_count,
+               SUM(b.weight_kg) AS total_weight,
+               SUM(b.volume_m3) AS total_volume,
+               MAX(b.reception_number) AS reception_number,
+               MAX(b.received_at)      AS received_at,
+               MAX(b.cargo_session_id) AS cargo_session_id,
+               MAX(b.parcel_note)      AS parcel_note,
+               u.username AS received_by_name
+        FROM basic_data b
+        LEFT JOIN users u ON u.id = b.received_by
+        WHERE b.reception_number IS NOT NULL AND b.parcel_number IS NOT NULL
+    '''
+    params = []
+    if f['project']:
+        q += ' AND b.project_code=?';                 params.append(f['project'])
+    if f['order_type']:
+        q += ' AND b.order_type=?';                   params.append(f['order_type'])
+    if f['reception_number']:
+        q += ' AND b.reception_number LIKE ?';        params.append(f"%{f['reception_number']}%")
+    if f['cargo_session']:
+        q += ' AND b.cargo_session_id LIKE ?';        params.append(f"%{f['cargo_session']}%")
+    if f['date_from']:
+        q += ' AND DATE(b.received_at) >= ?';         params.append(f['date_from'])
+    if f['date_to']:
+        q += ' AND DATE(b.received_at) <= ?';         params.append(f['date_to'])
+    q += ' GROUP BY b.parcel_number ORDER BY b.received_at DESC'
+    return q, params
+
+
+def _reception_rows(conn, f):
+    """Received parcels matching the reception report filters, newest first."""
+    return _cached_report(conn, 'reception', _RECEPTION_TABLES, f,
+                          lambda: [dict(r) for r in conn.execute(*_reception_sql(f)).fetchall()])
+
+
 # ── Reception Report data ─────────────────────────────────────────────────
 @app.route('/api/reports/reception', methods=['GET'])
 @login_required
 def reception_report():
-    project    = request.args.get('project') or None
-    order_type = request.args.get('order_type') or None
-    rec_no     = request.args.get('reception_number') or None
-    cargo_id   = request.args.get('cargo_session') or None
-    date_from  = request.args.get('date_from') or None
-    date_to    = request.args.get('date_to') or None
     conn = None
     try:
-        conn = _cr_db()
-        q = '''
-            SELECT b.parcel_number, b.field_ref, b.project_code, b.order_type,
-                   MAX(b.pallet_number) AS pallet_number,
-                   COUNT(*) AS item_count,
-                   SUM(b.weight_kg) AS total_weight,
-                   SUM(b.volume_m3) AS total_volume,
-                   MAX(b.reception_number) AS reception_number,
-                   MAX(b.received_at)      AS received_at,
-                   MAX(b.cargo_session_id) AS cargo_session_id,
-                   MAX(b.parcel_note)      AS parcel_note,
-                   u.username AS received_by_name
-            FROM basic_data b
-            LEFT JOIN users u ON u.id = b.received_by
-            WHERE b.reception_number IS NOT NULL AND b.parcel_number IS NOT NULL
-        '''
-        params = []
-        if project:
-            q += ' AND b.project_code=?';                 params.append(project)
-        if order_type:
-            q += ' AND b.order_type=?';                   params.append(order_type)
-        if rec_no:
-            q += ' AND b.reception_number LIKE ?';        params.append(f'%{rec_no}%')
-        if cargo_id:
-            q += ' AND b.cargo_session_id LIKE ?';        params.append(f'%{cargo_id}%')
-        if date_from:
-            q += ' AND DATE(b.received_at) >= ?';         params.append(date_from)
-        if date_to:
-            q += ' AND DATE(b.received_at) <= ?';         params.append(date_to)
-        q += ' GROUP BY b.parcel_number ORDER BY b.received_at DESC'
-        rows = conn.execute(q, params).fetchall()
+        conn = _reports_db()
+        rows = _reception_rows(conn, _reception_filters())
         # Summary
         total_parcels = len(rows)
         total_items   = sum(r['item_count'] or 0 for r in rows)
         total_weight  = sum(r['total_weight'] or 0 for r in rows)
         return jsonify({'success': True,
-                        'rows': [dict(r) for r in rows],
+                        'rows': rows,
                         'summary': {'total_parcels': total_parcels,
                                     'total_items': total_items,
                                     'total_weight': round(total_weight, 2)}})
@@ -4163,118 +4692,140 @@ def reception_report():
 def reception_report_export():
     conn = None
     try:
-        conn = _cr_db()
-        # Re-use same query logic as /api/reports/reception
-        project    = request.args.get('project') or None
-        order_type = request.args.get('order_type') or None
-        rec_no     = request.args.get('reception_number') or None
-        cargo_id   = request.args.get('cargo_session') or None
-        date_from  = request.args.get('date_from') or None
-        date_to    = request.args.get('date_to') or None
-
-        q = '''
-            SELECT b.parcel_number, b.field_ref, b.project_code, b.order_type,
-                   MAX(b.pallet_number) AS pallet_number,
-                   COUNT(*) AS item_count,
-                   SUM(b.weight_kg) AS total_weight,
-                   SUM(b.volume_m3) AS total_volume,
-                   MAX(b.reception_number) AS reception_number,
-                   MAX(b.received_at)      AS received_at,
-                   MAX(b.cargo_session_id) AS cargo_session_id,
-                   MAX(b.parcel_note)      AS parcel_note,
-                   u.username AS received_by_name
-            FROM basic_data b
-            LEFT JOIN users u ON u.id = b.received_by
-            WHERE b.reception_number IS NOT NULL AND b.parcel_number IS NOT NULL
-        '''
-        params = []
-        if project:    q += ' AND b.project_code=?';         params.append(project)
-        if order_type: q += ' AND b.order_type=?';           params.append(order_type)
-        if rec_no:     q += ' AND b.reception_number LIKE ?'; params.append(f'%{rec_no}%')
-        if cargo_id:   q += ' AND b.cargo_session_id LIKE ?'; params.append(f'%{cargo_id}%')
-        if date_from:  q += ' AND DATE(b.received_at) >= ?';  params.append(date_from)
-        if date_to:    q += ' AND DATE(b.received_at) <= ?';  params.append(date_to)
-        q += ' GROUP BY b.parcel_number ORDER BY b.received_at DESC'
-        rows = conn.execute(q, params).fetchall()
-
-        mission = conn.execute(
-            "SELECT mission_name FROM mission_details WHERE is_active=1 LIMIT 1"
-        ).fetchone()
-        mission_name = mission['mission_name'] if mission else ''
-
-        wb = openpyxl.Workbook(); ws = wb.active; ws.title = 'Reception Report'
-        title_blue  = "1F3A8A"
-        hdr_fill    = PatternFill(start_color=title_blue, end_color=title_blue, fill_type='solid')
-        hdr_font    = Font(bold=True, color='FFFFFF', size=10)
-        alt_fill    = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
-
-        ws['A1'] = f"{mission_name} — Reception Report"
-        ws['A1'].font = Font(bold=True, size=13, color=title_blue)
-        ws.merge_cells('A1:M1')
-        ws['A2'] = f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-        ws.merge_cells('A2:M2')
-
-        HDR = 4
-        hdrs = [('#','#',4),('Parcel No','parcel_number',14),('Field Ref','field_ref',22),
-                ('Project','project_code',12),('Type','order_type',13),
-                ('Pallet','pallet_number',10),('Items','item_count',7),
-                ('Weight kg','total_weight',11),('Volume m3','total_volume',11),
-                ('Reception No','reception_number',18),('Received At','received_at',18),
-                ('Received By','received_by_name',16),('Notes','parcel_note',22)]
-        for c,(lbl,_,w) in enumerate(hdrs,1):
-            cell = ws.cell(row=HDR, column=c, value=lbl)
-            cell.font = hdr_font; cell.fill = hdr_fill
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            ws.column_dimensions[openpyxl.utils.get_column_letter(c)].width = w
-        ws.row_dimensions[HDR].height = 18
-
-        for i, row in enumerate(rows, 1):
-            r = HDR + i
-            vals = [i, row['parcel_number'], row['field_ref'], row['project_code'],
-                    row['order_type'], row['pallet_number'], row['item_count'],
-                    round(row['total_weight'] or 0, 2), round(row['total_volume'] or 0, 3),
-                    row['reception_number'], str(row['received_at'] or '')[:16],
-                    row['received_by_name'], row['parcel_note']]
-            for c, v in enumerate(vals, 1):
-                cell = ws.cell(row=r, column=c, value=v)
-                cell.alignment = Alignment(vertical='top')
-                if i % 2 == 0: cell.fill = alt_fill
-
-        ws.freeze_panes = f'A{HDR+1}'
-        ws.page_setup.orientation = 'landscape'
-        ws.page_setup.fitToPage   = True
-        ws.page_setup.fitToWidth  = 1
-
-        buf = io.BytesIO(); wb.save(buf); buf.seek(0)
+        filters = _reception_filters()
+        fmt = _delimited_format()
+        if fmt:
+            return _stream_delimited(fmt, 'reception_report', [
+                ('Parcel No', 'parcel_number'), ('Field Ref', 'field_ref'),
+                ('Project', 'project_code'), ('Type', 'order_type'),
+                ('Pallet', 'pallet_number'), ('Items', 'item_count'),
+                ('Weight kg', 'total_weight'), ('Volume m3', 'total_volume'),
+                ('Reception No', 'reception_number'), ('Received At', 'received_at'),
+                ('Received By', 'received_by_name'), ('Notes', 'parcel_note'),
+            ], lambda c: c.execute(*_reception_sql(filters)))
+        conn = _reports_db()
+        data = _cached_export(conn, 'reception', _RECEPTION_TABLES, filters,
+                              lambda: _reception_xlsx(conn, _reception_rows(conn, filters)))
         fname = f"ReceptionReport_{datetime.now().strftime('%Y%m%d')}.xlsx"
-        return send_file(buf, as_attachment=True, download_name=fname,
-                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        return _xlsx_response(data, fname)
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
         if conn: conn.close()
 
 
+def _reception_xlsx(conn, rows):
+    """Reception report workbook as XLSX bytes."""
+    mission = conn.execute(
+        "SELECT mission_name FROM mission_details WHERE is_active=1 LIMIT 1"
+    ).fetchone()
+    mission_name = mission['mission_name'] if mission else ''
+
+    wb = openpyxl.Workbook(); ws = wb.active; ws.title = 'Reception Report'
+    title_blue  = "1F3A8A"
+    hdr_fill    = PatternFill(start_color=title_blue, end_color=title_blue, fill_type='solid')
+    hdr_font    = Font(bold=True, color='FFFFFF', size=10)
+    alt_fill    = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
+
+    ws['A1'] = f"{mission_name} — Reception Report"
+    ws['A1'].font = Font(bold=True, size=13, color=title_blue)
+    ws.merge_cells('A1:M1')
+    ws['A2'] = f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    ws.merge_cells('A2:M2')
+
+    HDR = 4
+    hdrs = [('#','#',4),('Parcel No','parcel_number',14),('Field Ref','field_ref',22),
+            ('Project','project_code',12),('Type','order_type',13),
+            ('Pallet','pallet_number',10),('Items','item_count',7),
+            ('Weight kg','total_weight',11),('Volume m3','total_volume',11),
+            ('Reception No','reception_number',18),('Received At','received_at',18),
+            ('Received By','received_by_name',16),('Notes','parcel_note',22)]
+    for c,(lbl,_,w) in enumerate(hdrs,1):
+        cell = ws.cell(row=HDR, column=c, value=lbl)
+        cell.font = hdr_font; cell.fill = hdr_fill
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        ws.column_dimensions[openpyxl.utils.get_column_letter(c)].width = w
+    ws.row_dimensions[HDR].height = 18
+
+    for i, row in enumerate(rows, 1):
+        r = HDR + i
+        vals = [i, row['parcel_number'], row['field_ref'], row['project_code'],
+                row['order_type'], row['pallet_number'], row['item_count'],
+                round(row['total_weight'] or 0, 2), round(row['total_volume'] or 0, 3),
+                row['reception_number'], str(row['received_at'] or '')[:16],
+                row['received_by_name'], row['parcel_note']]
+        for c, v in enumerate(vals, 1):
+            cell = ws.cell(row=r, column=c, value=v)
+            cell.alignment = Alignment(vertical='top')
+            if i % 2 == 0: cell.fill = alt_fill
+
+    ws.freeze_panes = f'A{HDR+1}'
+    ws.page_setup.orientation = 'landscape'
+    ws.page_setup.fitToPage   = True
+    ws.page_setup.fitToWidth  = 1
+
+    buf = io.BytesIO(); wb.save(buf)
+    return buf.getvalue()
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 #  REPORTS  (Phase 4)
 # ═══════════════════════════════════════════════════════════════════════════
 
-def _reports_db():
-    return _mov_db()
+# Reports, exports and dispatch lookups read through their own pool of
+# read-only connections, so they never hold or wait for the write lock
+REPORTS_POOL = ReadOnlyPool(DATABASE, size=app.config['REPORT_READERS'])
 
 
-def _stock_summary_rows(conn, project=None, item_filter=None):
+def _reports_db(date_from=None):
+    """Pooled read-only connection; one snapshot until conn.close(). When
+    date_from reaches into a closed year, an unpooled reader with those
+    archives attached instead (see archive.source)."""
+    conn = REPORTS_POOL.acquire()
+    if date_from:
+        years = archive.years_needed(conn, date_from)
+        if years:
+            conn.close()
+            return archive.open_reader(years, REPORTS_POOL.path)
+    return conn
+
+
+# Columns the stock summary reads, for archive.source()
+_SUMMARY_SOURCES = {
+    'st': ('stock_transactions', ('transaction_type', 'received_at', 'project_code', 'item_code',
+                                  'item_description', 'batch_no', 'exp_date', 'exp_date_iso',
+                                  'qty_received')),
+    'ml': ('movement_lines', ('movement_id', 'item_code', 'item_description', 'batch_no',
+                              'exp_date', 'exp_date_iso', 'qty')),
+    'm':  ('movements', ('id', 'movement_type', 'status', 'source_project', 'dest_project')),
+}
+
+
+def _stock_summary_sql(project=None, item_filter=None, conn=None):
     """
-    Returns net stock per (project_code, item_code, batch_no, exp_date).
-    Sources: cargo receptions + IN movements - OUT movements.
+    Build the net stock query per (project_code, item_code, batch_no, exp_key):
+    lines are keyed and sorted on the ISO expiry, like _available_stock_query,
+    and exp_date is one of the raw spellings, kept for display.
+    Sources: cargo receptions and opening balances + IN movements - OUT movements.
     bd_receptions fallback covers parcels received before stock_transactions was used.
+    When conn has archives attached, their rows are read and the OPENING rows
+    standing for them left out, so Total IN/OUT stay all-time totals after a
+    year is closed; without, net_stock is the same but closed years count as
+    their OPENING balance. basic_data stays live: archived parcels all have
+    their RECEPTION rows. Returns (sql, params).
     """
+    src = {alias: archive.source(conn, table, cols) if conn is not None else table
+           for alias, (table, cols) in _SUMMARY_SOURCES.items()}
     params_r = []
     params_b = []   # fallback: basic_data for parcels not in stock_transactions
     params_i = []
     params_o = []
 
-    where_r = "WHERE st.transaction_type = 'RECEPTION'"
+    where_r = "WHERE st.transaction_type IN ('RECEPTION', 'OPENING')"
+    opening_cutoff = archive.opening_cutoff(conn) if conn is not None else ''
+    if opening_cutoff:
+        where_r += " AND (st.transaction_type = 'RECEPTION' OR st.received_at < ?)"
+        params_r.append(opening_cutoff)
     where_b = ("WHERE bd.reception_number IS NOT NULL "
                "AND bd.item_code IS NOT NULL "
                "AND bd.qty_unit_tot IS NOT NULL AND bd.qty_unit_tot > 0")
@@ -4307,18 +4858,20 @@ def _stock_summary_rows(conn, project=None, item_filter=None):
             SELECT st.project_code AS project_code,
                    st.item_code, MAX(st.item_description) AS item_description,
                    COALESCE(st.batch_no,'') AS batch_no,
-                   COALESCE(st.exp_date,'') AS exp_date,
+                   COALESCE(st.exp_date_iso,'') AS exp_key,
+                   MAX(COALESCE(st.exp_date,'')) AS exp_date,
                    SUM(st.qty_received) AS qty_in, 0.0 AS qty_out
-            FROM stock_transactions st
+            FROM {src['st']} st
             {where_r}
-            GROUP BY st.project_code, st.item_code, st.batch_no, st.exp_date
+            GROUP BY st.project_code, st.item_code, COALESCE(st.batch_no,''), COALESCE(st.exp_date_iso,'')
         ),
         bd_receptions AS (
             -- Fallback: count received basic_data rows whose parcel is not yet in stock_transactions
             SELECT bd.project_code AS project_code,
                    bd.item_code, MAX(bd.item_description) AS item_description,
                    COALESCE(bd.batch_no_received, bd.batch_no,'') AS batch_no,
-                   COALESCE(bd.exp_date_received, bd.exp_date,'') AS exp_date,
+                   COALESCE(bd.exp_date_iso,'') AS exp_key,
+                   MAX(COALESCE(bd.exp_date_received, bd.exp_date,'')) AS exp_date,
                    SUM(bd.qty_unit_tot) AS qty_in, 0.0 AS qty_out
             FROM basic_data bd
             {where_b}
@@ -4326,27 +4879,30 @@ def _stock_summary_rows(conn, project=None, item_filter=None):
                    OR bd.parcel_number NOT IN (
                        SELECT DISTINCT parcel_number FROM stock_transactions
                        WHERE transaction_type='RECEPTION' AND parcel_number IS NOT NULL))
-            GROUP BY bd.project_code, bd.item_code, bd.batch_no, bd.exp_date
+            GROUP BY bd.project_code, bd.item_code,
+                     COALESCE(bd.batch_no_received, bd.batch_no,''), COALESCE(bd.exp_date_iso,'')
         ),
         in_mvts AS (
             SELECT m.dest_project AS project_code,
                    ml.item_code, MAX(ml.item_description) AS item_description,
                    COALESCE(ml.batch_no,'') AS batch_no,
-                   COALESCE(ml.exp_date,'') AS exp_date,
+                   COALESCE(ml.exp_date_iso,'') AS exp_key,
+                   MAX(COALESCE(ml.exp_date,'')) AS exp_date,
                    SUM(ml.qty) AS qty_in, 0.0 AS qty_out
-            FROM movement_lines ml JOIN movements m ON m.id=ml.movement_id
+            FROM {src['ml']} ml JOIN {src['m']} m ON m.id=ml.movement_id
             {where_i}
-            GROUP BY m.dest_project, ml.item_code, ml.batch_no, ml.exp_date
+            GROUP BY m.dest_project, ml.item_code, COALESCE(ml.batch_no,''), COALESCE(ml.exp_date_iso,'')
         ),
         out_mvts AS (
             SELECT m.source_project AS project_code,
                    ml.item_code, '' AS item_description,
                    COALESCE(ml.batch_no,'') AS batch_no,
-                   COALESCE(ml.exp_date,'') AS exp_date,
+                   COALESCE(ml.exp_date_iso,'') AS exp_key,
+                   MAX(COALESCE(ml.exp_date,'')) AS exp_date,
                    0.0 AS qty_in, SUM(ml.qty) AS qty_out
-            FROM movement_lines ml JOIN movements m ON m.id=ml.movement_id
+            FROM {src['ml']} ml JOIN {src['m']} m ON m.id=ml.movement_id
             {where_o}
-            GROUP BY m.source_project, ml.item_code, ml.batch_no, ml.exp_date
+            GROUP BY m.source_project, ml.item_code, COALESCE(ml.batch_no,''), COALESCE(ml.exp_date_iso,'')
         ),
         combined AS (
             SELECT * FROM receptions
@@ -4355,17 +4911,29 @@ def _stock_summary_rows(conn, project=None, item_filter=None):
             UNION ALL SELECT * FROM out_mvts
         )
         SELECT project_code, item_code, MAX(item_description) AS item_description,
-               batch_no, exp_date,
+               batch_no, MAX(exp_date) AS exp_date, exp_key,
                SUM(qty_in) AS total_in, SUM(qty_out) AS total_out,
                SUM(qty_in) - SUM(qty_out) AS net_stock
         FROM combined
-        GROUP BY project_code, item_code, batch_no, exp_date
+        GROUP BY project_code, item_code, batch_no, exp_key
         HAVING net_stock <> 0 OR SUM(qty_in) > 0
         ORDER BY project_code, item_code,
-                 CASE WHEN exp_date='' OR exp_date IS NULL THEN 1 ELSE 0 END,
-                 exp_date ASC
+                 CASE WHEN exp_key = '' THEN 1 ELSE 0 END,
+                 exp_key ASC
     '''
-    return conn.execute(sql, params_r + params_b + params_i + params_o).fetchall()
+    return sql, params_r + params_b + params_i + params_o
+
+
+def _stock_summary_rows(conn, project=None, item_filter=None):
+    sql, params = _stock_summary_sql(project, item_filter, conn)
+    return conn.execute(sql, params).fetchall()
+
+
+def _stock_summary_cached(conn, project=None, item_filter=None):
+    """Stock summary as dicts, shared by the report page and its export."""
+    return _cached_report(conn, 'stock_summary', _STOCK_TABLES,
+                          {'project': project, 'item': item_filter},
+                          lambda: [dict(r) for r in _stock_summary_rows(conn, project, item_filter)])
 
 
 @app.route('/api/reports/stock-summary', methods=['GET'])
@@ -4373,11 +4941,13 @@ def _stock_summary_rows(conn, project=None, item_filter=None):
 def rpt_stock_summary():
     conn = None
     try:
-        conn    = _reports_db()
+        conn    = _reports_db(archive.ALL_YEARS)
         project = request.args.get('project') or None
         item    = request.args.get('item') or None
-        rows    = _stock_summary_rows(conn, project, item)
-        return jsonify({'success': True, 'rows': [dict(r) for r in rows]})
+        rows    = _stock_summary_cached(conn, project, item)
+        return jsonify({'success': True, 'rows': rows})
+    except archive.ArchiveError as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
@@ -4389,128 +4959,206 @@ def rpt_stock_summary():
 def rpt_stock_summary_export():
     conn = None
     try:
-        conn    = _reports_db()
+        conn    = _reports_db(archive.ALL_YEARS)
         project = request.args.get('project') or None
         item    = request.args.get('item') or None
-        rows    = _stock_summary_rows(conn, project, item)
-
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = 'Stock Summary'
-        ws.page_setup.orientation = 'landscape'
-        ws.page_setup.fitToPage   = True
-        ws.page_setup.fitToWidth  = 1
-        ws.page_setup.fitToHeight = 0
-
-        fill   = PatternFill(start_color='1F3A8A', end_color='1F3A8A', fill_type='solid')
-        hfont  = Font(bold=True, color='FFFFFF', size=10)
-        headers = [
-            ('Project', 14), ('Item Code', 14), ('Description', 34),
-            ('Batch No', 14), ('Exp Date', 11),
-            ('Total IN', 12), ('Total OUT', 12), ('Net Stock', 12),
-        ]
-        for c, (h, w) in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=c, value=h)
-            cell.font = hfont
-            cell.fill = fill
-            cell.alignment = Alignment(horizontal='center')
-            ws.column_dimensions[cell.column_letter].width = w
-
-        alt = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
-        for i, r in enumerate(rows, 2):
-            vals = [r['project_code'], r['item_code'], r['item_description'],
-                    r['batch_no'], r['exp_date'],
-                    r['total_in'], r['total_out'], r['net_stock']]
-            for c, v in enumerate(vals, 1):
-                cell = ws.cell(row=i, column=c, value=v)
-                if i % 2 == 0:
-                    cell.fill = alt
-
-        buf = io.BytesIO()
-        wb.save(buf)
-        buf.seek(0)
+        fmt     = _delimited_format()
+        if fmt:
+            return _stream_delimited(fmt, 'stock_summary', [
+                ('Project', 'project_code'), ('Item Code', 'item_code'),
+                ('Description', 'item_description'), ('Batch No', 'batch_no'),
+                ('Exp Date', 'exp_date'), ('Total IN', 'total_in'),
+                ('Total OUT', 'total_out'), ('Net Stock', 'net_stock'),
+            ], lambda c: c.execute(*_stock_summary_sql(project, item, c)), archive.ALL_YEARS)
+        data    = _cached_export(conn, 'stock_summary', _STOCK_TABLES,
+                                 {'project': project, 'item': item},
+                                 lambda: _stock_summary_xlsx(_stock_summary_cached(conn, project, item)))
         fname = f"stock_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        return send_file(buf, as_attachment=True, download_name=fname,
-                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        return _xlsx_response(data, fname)
+    except archive.ArchiveError as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
         if conn: conn.close()
 
 
+def _stock_summary_xlsx(rows):
+    """Stock summary workbook as XLSX bytes."""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'Stock Summary'
+    ws.page_setup.orientation = 'landscape'
+    ws.page_setup.fitToPage   = True
+    ws.page_setup.fitToWidth  = 1
+    ws.page_setup.fitToHeight = 0
+
+    fill   = PatternFill(start_color='1F3A8A', end_color='1F3A8A', fill_type='solid')
+    hfont  = Font(bold=True, color='FFFFFF', size=10)
+    headers = [
+        ('Project', 14), ('Item Code', 14), ('Description', 34),
+        ('Batch No', 14), ('Exp Date', 11),
+        ('Total IN', 12), ('Total OUT', 12), ('Net Stock', 12),
+    ]
+    for c, (h, w) in enumerate(headers, 1):
+        cell = ws.cell(row=1, column=c, value=h)
+        cell.font = hfont
+        cell.fill = fill
+        cell.alignment = Alignment(horizontal='center')
+        ws.column_dimensions[cell.column_letter].width = w
+
+    alt = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
+    for i, r in enumerate(rows, 2):
+        vals = [r['project_code'], r['item_code'], r['item_description'],
+                r['batch_no'], r['exp_date'],
+                r['total_in'], r['total_out'], r['net_stock']]
+        for c, v in enumerate(vals, 1):
+            cell = ws.cell(row=i, column=c, value=v)
+            if i % 2 == 0:
+                cell.fill = alt
+
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+# Stock card: receptions, opening balances, confirmed IN and confirmed OUT
+# lines in one pass. Ties on txn_date keep the old ordering (receptions, then
+# IN, then OUT); src_id keeps the window deterministic inside each source.
+# {st}/{ml}/{m} are the table sources from archive.source().
+_STOCK_CARD_CTE = '''
+    WITH card_src AS (
+        SELECT st.received_at AS txn_date, st.transaction_type AS doc_type,
+               st.reception_number AS document_number, st.project_code,
+               st.item_code, st.item_description, st.batch_no, st.exp_date,
+               st.qty_received AS qty_in, 0.0 AS qty_out,
+               st.transaction_type AS source, st.received_by AS user_id,
+               0 AS src_rank, st.id AS src_id
+        FROM {st} st
+        WHERE st.item_code = :item
+          AND st.transaction_type IN ('RECEPTION', 'OPENING')
+          AND (st.transaction_type = 'RECEPTION' OR :opening_cutoff = ''
+               OR st.received_at < :opening_cutoff)
+          AND (:project = '' OR st.project_code = :project)
+        UNION ALL
+        SELECT m.movement_date, m.doc_type,
+               m.document_number, m.dest_project,
+               ml.item_code, ml.item_description, ml.batch_no, ml.exp_date,
+               ml.qty, 0.0,
+               'IN', m.created_by,
+               1, ml.id
+        FROM {ml} ml
+        JOIN {m} m ON m.id = ml.movement_id
+        WHERE ml.item_code = :item
+          AND m.movement_type = 'IN' AND m.status = 'Confirmed'
+          AND (:project = '' OR m.dest_project = :project)
+        UNION ALL
+        SELECT m.movement_date, m.doc_type,
+               m.document_number, m.source_project,
+               ml.item_code, ml.item_description, ml.batch_no, ml.exp_date,
+               0.0, ml.qty,
+               'OUT', m.created_by,
+               2, ml.id
+        FROM {ml} ml
+        JOIN {m} m ON m.id = ml.movement_id
+        WHERE ml.item_code = :item
+          AND m.movement_type = 'OUT' AND m.status = 'Confirmed'
+          AND (:project = '' OR m.source_project = :project)
+    ),
+    card AS (
+        SELECT c.txn_date, c.doc_type, c.document_number, c.project_code,
+               c.item_code, c.item_description, c.batch_no, c.exp_date,
+               c.qty_in, c.qty_out, c.source, u.username AS user_name,
+               ROUND(SUM(COALESCE(c.qty_in, 0) - COALESCE(c.qty_out, 0)) OVER (
+                   ORDER BY COALESCE(c.txn_date, ''), c.src_rank, c.src_id
+                   ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW), 4) AS running_balance,
+               COALESCE(c.txn_date, '') AS sort_date, c.src_rank, c.src_id
+        FROM card_src c
+        LEFT JOIN users u ON u.id = c.user_id
+    )
+'''
+_STOCK_CARD_SOURCES = {
+    'st': ('stock_transactions', ('id', 'received_at', 'transaction_type', 'reception_number',
+                                  'project_code', 'item_code', 'item_description', 'batch_no',
+                                  'exp_date', 'qty_received', 'received_by')),
+    'ml': ('movement_lines', ('id', 'movement_id', 'item_code', 'item_description',
+                              'batch_no', 'exp_date', 'qty')),
+    'm':  ('movements', ('id', 'movement_date', 'doc_type', 'document_number', 'movement_type',
+                         'status', 'source_project', 'dest_project', 'created_by')),
+}
+
+
+def _stock_card_sql(conn, item, project):
+    """(card CTE, params) reading the archives attached to conn, if any.
+    OPENING rows standing for an attached archive are left out."""
+    sources = {alias: archive.source(conn, table, cols)
+               for alias, (table, cols) in _STOCK_CARD_SOURCES.items()}
+    params = {'item': item, 'project': project or '',
+              'opening_cutoff': archive.opening_cutoff(conn)}
+    return _STOCK_CARD_CTE.format(**sources), params
+_STOCK_CARD_COLS = ('txn_date, doc_type, document_number, project_code, item_code, '
+                    'item_description, batch_no, exp_date, qty_in, qty_out, source, '
+                    'user_name, running_balance')
+
+
+def _stock_card_cursor(conn, item, project, limit=None, offset=0):
+    """Cursor over stock-card rows in date order with their running balance."""
+    cte, params = _stock_card_sql(conn, item, project)
+    sql = cte + f"SELECT {_STOCK_CARD_COLS} FROM card ORDER BY sort_date, src_rank, src_id"
+    if limit is not None:
+        sql += " LIMIT :limit OFFSET :offset"
+        params.update(limit=limit, offset=offset)
+    return conn.execute(sql, params)
+
+
 @app.route('/api/reports/stock-card', methods=['GET'])
 @login_required
 def rpt_stock_card():
-    """Full transaction history for a specific item + project (stock card)."""
-    conn    = None
-    item    = request.args.get('item', '').strip()
-    project = request.args.get('project', '').strip()
+    """Stock card for an item + project, one page at a time.
+
+    Without ?page= the last (most recent) page is returned. opening_balance is
+    the balance brought forward from everything before the page. Closed
+    years appear as one OPENING line unless ?from= reaches into them, in
+    which case their archived lines are listed instead.
+    """
+    conn      = None
+    item      = request.args.get('item', '').strip()
+    project   = request.args.get('project', '').strip()
+    date_from = request.args.get('from') or None
     if not item:
         return jsonify({'success': False, 'message': 'item param required'}), 400
     try:
-        conn = _reports_db()
-        # Receptions
-        rec_rows = conn.execute('''
-            SELECT st.received_at AS txn_date, st.transaction_type AS doc_type,
-                   st.reception_number AS document_number, st.project_code,
-                   st.item_code, st.item_description, st.batch_no, st.exp_date,
-                   st.qty_received AS qty_in, 0.0 AS qty_out,
-                   'RECEPTION' AS source,
-                   u.username AS user_name
-            FROM stock_transactions st
-            LEFT JOIN users u ON u.id = st.received_by
-            WHERE st.item_code = ?
-              AND (st.transaction_type = 'RECEPTION')
-              AND (? = '' OR st.project_code = ?)
-            ORDER BY st.received_at ASC
-        ''', (item, project, project)).fetchall()
-
-        # IN movements
-        in_rows = conn.execute('''
-            SELECT m.movement_date AS txn_date, m.doc_type,
-                   m.document_number, m.dest_project AS project_code,
-                   ml.item_code, ml.item_description, ml.batch_no, ml.exp_date,
-                   ml.qty AS qty_in, 0.0 AS qty_out,
-                   'IN' AS source,
-                   u.username AS user_name
-            FROM movement_lines ml
-            JOIN movements m ON m.id = ml.movement_id
-            LEFT JOIN users u ON u.id = m.created_by
-            WHERE ml.item_code = ?
-              AND m.movement_type = 'IN' AND m.status = 'Confirmed'
-              AND (? = '' OR m.dest_project = ?)
-            ORDER BY m.movement_date ASC
-        ''', (item, project, project)).fetchall()
-
-        # OUT movements
-        out_rows = conn.execute('''
-            SELECT m.movement_date AS txn_date, m.doc_type,
-                   m.document_number, m.source_project AS project_code,
-                   ml.item_code, ml.item_description, ml.batch_no, ml.exp_date,
-                   0.0 AS qty_in, ml.qty AS qty_out,
-                   'OUT' AS source,
-                   u.username AS user_name
-            FROM movement_lines ml
-            JOIN movements m ON m.id = ml.movement_id
-            LEFT JOIN users u ON u.id = m.created_by
-            WHERE ml.item_code = ?
-              AND m.movement_type = 'OUT' AND m.status = 'Confirmed'
-              AND (? = '' OR m.source_project = ?)
-            ORDER BY m.movement_date ASC
-        ''', (item, project, project)).fetchall()
-
-        all_txns = sorted(
-            [dict(r) for r in (list(rec_rows) + list(in_rows) + list(out_rows))],
-            key=lambda x: (x.get('txn_date') or '')
-        )
-        # Running balance
-        balance = 0.0
-        for t in all_txns:
-            balance += (t['qty_in'] or 0) - (t['qty_out'] or 0)
-            t['running_balance'] = round(balance, 4)
-
-        return jsonify({'success': True, 'transactions': all_txns,
-                        'item': item, 'project': project or 'ALL'})
+        limit = max(1, min(int(request.args.get('limit') or 200), 5000))
+        page  = int(request.args['page']) if request.args.get('page') else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid page or limit'}), 400
+    try:
+        conn = _reports_db(date_from)
+        cte, params = _stock_card_sql(conn, item, project)
+        total, closing = conn.execute(
+            cte + "SELECT COUNT(*), ROUND(COALESCE(SUM("
+            "COALESCE(qty_in, 0) - COALESCE(qty_out, 0)), 0), 4) FROM card",
+            params
+        ).fetchone()
+        pages = max(1, -(-total // limit))
+        page  = max(1, min(pages if page is None else page, pages))
+
+        txns = [dict(r) for r in
+                _stock_card_cursor(conn, item, project, limit, (page - 1) * limit)]
+        if txns:
+            first   = txns[0]
+            opening = round(first['running_balance']
+                            - ((first['qty_in'] or 0) - (first['qty_out'] or 0)), 4)
+        else:
+            opening = closing
+
+        return jsonify({'success': True, 'transactions': txns,
+                        'item': item, 'project': project or 'ALL',
+                        'opening_balance': opening, 'closing_balance': closing,
+                        'total': total, 'page': page, 'pages': pages, 'limit': limit,
+                        'archived_years': archive.attached_years(conn)})
+    except archive.ArchiveError as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
@@ -4520,28 +5168,31 @@ def rpt_stock_card():
 @app.route('/api/reports/stock-card/export', methods=['GET'])
 @login_required
 def rpt_stock_card_export():
-    item    = request.args.get('item', '').strip()
-    project = request.args.get('project', '').strip()
+    item      = request.args.get('item', '').strip()
+    project   = request.args.get('project', '').strip()
+    date_from = request.args.get('from') or None
     if not item:
         return jsonify({'success': False, 'message': 'item param required'}), 400
+    fmt = _delimited_format()
+    if fmt:
+        return _stream_delimited(fmt, 'stock_card_' + _re.sub(r'[^\w]', '_', item), [
+            ('Date', 'txn_date'), ('Type', 'doc_type'), ('Document No', 'document_number'),
+            ('Project', 'project_code'), ('Batch', 'batch_no'), ('Exp Date', 'exp_date'),
+            ('IN Qty', 'qty_in'), ('OUT Qty', 'qty_out'), ('Balance', 'running_balance'),
+            ('User', 'user_name'), ('Source', 'source'),
+        ], lambda c: _stock_card_cursor(c, item, project), date_from)
     conn = None
     try:
-        conn     = _reports_db()
-        resp     = rpt_stock_card()
-        txns     = resp.get_json()['transactions']
+        conn = _reports_db(date_from)
 
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = 'Stock Card'
+        # Write-only workbook: rows go straight from the cursor to the sheet
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet('Stock Card')
         ws.page_setup.orientation = 'landscape'
-        ws.page_setup.fitToPage   = True
+        ws.sheet_properties.pageSetUpPr.fitToPage = True
         ws.page_setup.fitToWidth  = 1
         ws.page_setup.fitToHeight = 0
 
-        ws['A1'] = f"Stock Card — {item}{' | Project: ' + project if project else ''}"
-        ws['A1'].font = Font(bold=True, size=13, color='1F3A8A')
-        ws.merge_cells('A1:L1')
-
         fill   = PatternFill(start_color='1F3A8A', end_color='1F3A8A', fill_type='solid')
         hfont  = Font(bold=True, color='FFFFFF', size=10)
         headers = [
@@ -4550,25 +5201,39 @@ def rpt_stock_card_export():
             ('IN Qty', 10), ('OUT Qty', 10), ('Balance', 10),
             ('User', 14), ('Source', 10),
         ]
-        for c, (h, w) in enumerate(headers, 1):
-            cell = ws.cell(row=3, column=c, value=h)
+        for c, (_, w) in enumerate(headers, 1):
+            ws.column_dimensions[openpyxl.utils.get_column_letter(c)].width = w
+
+        title = WriteOnlyCell(ws, value=f"Stock Card — {item}{' | Project: ' + project if project else ''}")
+        title.font = Font(bold=True, size=13, color='1F3A8A')
+        ws.append([title])
+        ws.append([])
+        header_cells = []
+        for h, _ in headers:
+            cell = WriteOnlyCell(ws, value=h)
             cell.font = hfont
             cell.fill = fill
             cell.alignment = Alignment(horizontal='center')
-            ws.column_dimensions[cell.column_letter].width = w
+            header_cells.append(cell)
+        ws.append(header_cells)
 
         alt = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
-        for i, t in enumerate(txns, 4):
+        for i, t in enumerate(_stock_card_cursor(conn, item, project), 4):
             vals = [
-                t.get('txn_date'), t.get('doc_type'), t.get('document_number'),
-                t.get('project_code'), t.get('batch_no'), t.get('exp_date'),
-                t.get('qty_in'), t.get('qty_out'), t.get('running_balance'),
-                t.get('user_name'), t.get('source'),
+                t['txn_date'], t['doc_type'], t['document_number'],
+                t['project_code'], t['batch_no'], t['exp_date'],
+                t['qty_in'], t['qty_out'], t['running_balance'],
+                t['user_name'], t['source'],
             ]
-            for c, v in enumerate(vals, 1):
-                cell = ws.cell(row=i, column=c, value=v)
-                if i % 2 == 0:
+            if i % 2 == 0:
+                row = []
+                for v in vals:
+                    cell = WriteOnlyCell(ws, value=v)
                     cell.fill = alt
+                    row.append(cell)
+                ws.append(row)
+            else:
+                ws.append(vals)
 
         buf = io.BytesIO()
         wb.save(buf)
@@ -4583,6 +5248,16 @@ def rpt_stock_card_export():
         if conn: conn.close()
 
 
+# Columns the transactions report reads, for archive.source()
+_TX_MOVEMENT_COLS = ('id', 'document_number', 'movement_type', 'doc_type', 'movement_date',
+                     'source_project', 'dest_project', 'total_weight_kg', 'total_volume_m3',
+                     'notes', 'status', 'created_by', 'created_at', 'end_user_id',
+                     'third_party_id')
+_TX_LINE_COLS = ('movement_id', 'line_no', 'item_code', 'item_description', 'batch_no',
+                 'exp_date', 'qty', 'unit', 'unit_price', 'currency', 'total_value',
+                 'weight_kg', 'volume_m3')
+
+
 @app.route('/api/reports/transactions', methods=['GET'])
 @login_required
 def rpt_transactions():
@@ -4597,7 +5272,7 @@ def rpt_transactions():
     limit  = int(request.args.get('limit', 100))
     offset = (page - 1) * limit
     try:
-        conn = _reports_db()
+        conn = _reports_db(date_from)
         wheres = ["m.status = 'Confirmed'"]
         params = []
         if project:
@@ -4616,30 +5291,40 @@ def rpt_transactions():
             wheres.append("m.movement_date <= ?")
             params.append(date_to)
         where_clause = "WHERE " + " AND ".join(wheres)
-
-        rows = conn.execute(f'''
-            SELECT m.id, m.document_number, m.movement_type, m.doc_type,
-                   m.movement_date, m.source_project, m.dest_project,
-                   m.total_weight_kg, m.total_volume_m3, m.notes, m.created_at,
-                   u.username  AS created_by_name,
-                   eu.name     AS end_user_name,
-                   tp.name     AS third_party_name,
-                   (SELECT COUNT(*) FROM movement_lines ml WHERE ml.movement_id=m.id) AS line_count
-            FROM movements m
-            LEFT JOIN users u      ON u.id = m.created_by
-            LEFT JOIN end_users eu ON eu.end_user_id = m.end_user_id
-            LEFT JOIN third_parties tp ON tp.third_party_id = m.third_party_id
-            {where_clause}
-            ORDER BY m.movement_date DESC, m.created_at DESC
-            LIMIT ? OFFSET ?
-        ''', params + [limit, offset]).fetchall()
-
-        total = conn.execute(
-            f"SELECT COUNT(*) FROM movements m {where_clause}", params
-        ).fetchone()[0]
-
-        return jsonify({'success': True, 'movements': [dict(r) for r in rows],
-                        'total': total, 'page': page, 'limit': limit})
+        src_m  = archive.source(conn, 'movements', _TX_MOVEMENT_COLS)
+        src_ml = archive.source(conn, 'movement_lines', ('movement_id',))
+
+        def load():
+            rows = conn.execute(f'''
+                SELECT m.id, m.document_number, m.movement_type, m.doc_type,
+                       m.movement_date, m.source_project, m.dest_project,
+                       m.total_weight_kg, m.total_volume_m3, m.notes, m.created_at,
+                       u.username  AS created_by_name,
+                       eu.name     AS end_user_name,
+                       tp.name     AS third_party_name,
+                       (SELECT COUNT(*) FROM {src_ml} ml WHERE ml.movement_id=m.id) AS line_count
+                FROM {src_m} m
+                LEFT JOIN users u      ON u.id = m.created_by
+                LEFT JOIN end_users eu ON eu.end_user_id = m.end_user_id
+                LEFT JOIN third_parties tp ON tp.third_party_id = m.third_party_id
+                {where_clause}
+                ORDER BY m.movement_date DESC, m.created_at DESC
+                LIMIT ? OFFSET ?
+            ''', params + [limit, offset]).fetchall()
+
+            total = conn.execute(
+                f"SELECT COUNT(*) FROM {src_m} m {where_clause}", params
+            ).fetchone()[0]
+            return [dict(r) for r in rows], total
+
+        filters = {'project': project, 'doc_type': doc_type, 'direction': direction,
+                   'date_from': date_from, 'date_to': date_to, 'page': page, 'limit': limit}
+        rows, total = _cached_report(conn, 'transactions', _MOVEMENT_TABLES, filters, load)
+        return jsonify({'success': True, 'movements': rows,
+                        'total': total, 'page': page, 'limit': limit,
+                        'archived_years': archive.attached_years(conn)})
+    except archive.ArchiveError as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
@@ -4651,12 +5336,12 @@ def rpt_transactions():
 def rpt_transactions_export():
     conn = None
     try:
-        conn      = _reports_db()
         project   = request.args.get('project') or None
         doc_type  = request.args.get('doc_type') or None
         direction = request.args.get('direction') or None
         date_from = request.args.get('date_from') or None
         date_to   = request.args.get('date_to') or None
+        conn      = _reports_db(date_from)
 
         wheres = ["m.status = 'Confirmed'"]
         params = []
@@ -4673,7 +5358,8 @@ def rpt_transactions_export():
             wheres.append("m.movement_date<=?"); params.append(date_to)
         where_clause = "WHERE " + " AND ".join(wheres)
 
-        rows = conn.execute(f'''
+        def tx_sql(c):
+            return f'''
             SELECT m.document_number, m.movement_type, m.doc_type, m.movement_date,
                    m.source_project, m.dest_project,
                    m.total_weight_kg, m.total_volume_m3, m.notes,
@@ -4683,63 +5369,84 @@ def rpt_transactions_export():
                    ml.batch_no, ml.exp_date, ml.qty, ml.unit,
                    ml.unit_price, ml.currency, ml.total_value,
                    ml.weight_kg, ml.volume_m3
-            FROM movements m
+            FROM {archive.source(c, 'movements', _TX_MOVEMENT_COLS)} m
             LEFT JOIN users u      ON u.id = m.created_by
             LEFT JOIN end_users eu ON eu.end_user_id = m.end_user_id
             LEFT JOIN third_parties tp ON tp.third_party_id = m.third_party_id
-            LEFT JOIN movement_lines ml ON ml.movement_id = m.id
+            LEFT JOIN {archive.source(c, 'movement_lines', _TX_LINE_COLS)} ml
+                   ON ml.movement_id = m.id
             {where_clause}
             ORDER BY m.movement_date DESC, m.id, ml.line_no
-        ''', params).fetchall()
-
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = 'Transactions'
-        ws.page_setup.orientation = 'landscape'
-        ws.page_setup.fitToPage   = True
-        ws.page_setup.fitToWidth  = 1
-        ws.page_setup.fitToHeight = 0
-
-        fill  = PatternFill(start_color='1F3A8A', end_color='1F3A8A', fill_type='solid')
-        hfnt  = Font(bold=True, color='FFFFFF', size=9)
-        headers = [
-            'Document No', 'Direction', 'Type', 'Date', 'From Project', 'To Project',
-            'End User', 'Third Party', 'Line', 'Item Code', 'Description',
-            'Batch', 'Exp Date', 'Qty', 'Unit',
-            'Unit Price', 'Currency', 'Total Value',
-            'Weight kg', 'Volume m3', 'Notes',
-        ]
-        widths = [18, 8, 8, 12, 14, 14, 20, 20, 5, 14, 32,
-                  14, 11, 8, 8, 11, 10, 13, 11, 11, 24]
-        for c, (h, w) in enumerate(zip(headers, widths), 1):
-            cell = ws.cell(row=1, column=c, value=h)
-            cell.font = hfnt
-            cell.fill = fill
-            cell.alignment = Alignment(horizontal='center')
-            ws.column_dimensions[cell.column_letter].width = w
-
-        alt = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
-        for i, r in enumerate(rows, 2):
-            vals = [
-                r['document_number'], r['movement_type'], r['doc_type'], r['movement_date'],
-                r['source_project'], r['dest_project'],
-                r['end_user_name'], r['third_party_name'],
-                r['line_no'], r['item_code'], r['item_description'],
-                r['batch_no'], r['exp_date'], r['qty'], r['unit'],
-                r['unit_price'], r['currency'], r['total_value'],
-                r['weight_kg'], r['volume_m3'], r['notes'],
+        '''
+        fmt = _delimited_format()
+        if fmt:
+            return _stream_delimited(fmt, 'transactions', [
+                ('Document No', 'document_number'), ('Direction', 'movement_type'),
+                ('Type', 'doc_type'), ('Date', 'movement_date'),
+                ('From Project', 'source_project'), ('To Project', 'dest_project'),
+                ('End User', 'end_user_name'), ('Third Party', 'third_party_name'),
+                ('Line', 'line_no'), ('Item Code', 'item_code'),
+                ('Description', 'item_description'), ('Batch', 'batch_no'),
+                ('Exp Date', 'exp_date'), ('Qty', 'qty'), ('Unit', 'unit'),
+                ('Unit Price', 'unit_price'), ('Currency', 'currency'),
+                ('Total Value', 'total_value'), ('Weight kg', 'weight_kg'),
+                ('Volume m3', 'volume_m3'), ('Notes', 'notes'),
+            ], lambda c: c.execute(tx_sql(c), params), date_from)
+
+        def build():
+            rows = conn.execute(tx_sql(conn), params).fetchall()
+
+            wb = openpyxl.Workbook()
+            ws = wb.active
+            ws.title = 'Transactions'
+            ws.page_setup.orientation = 'landscape'
+            ws.page_setup.fitToPage   = True
+            ws.page_setup.fitToWidth  = 1
+            ws.page_setup.fitToHeight = 0
+
+            fill  = PatternFill(start_color='1F3A8A', end_color='1F3A8A', fill_type='solid')
+            hfnt  = Font(bold=True, color='FFFFFF', size=9)
+            headers = [
+                'Document No', 'Direction', 'Type', 'Date', 'From Project', 'To Project',
+                'End User', 'Third Party', 'Line', 'Item Code', 'Description',
+                'Batch', 'Exp Date', 'Qty', 'Unit',
+                'Unit Price', 'Currency', 'Total Value',
+                'Weight kg', 'Volume m3', 'Notes',
             ]
-            for c, v in enumerate(vals, 1):
-                cell = ws.cell(row=i, column=c, value=v)
-                if i % 2 == 0:
-                    cell.fill = alt
+            widths = [18, 8, 8, 12, 14, 14, 20, 20, 5, 14, 32,
+                      14, 11, 8, 8, 11, 10, 13, 11, 11, 24]
+            for c, (h, w) in enumerate(zip(headers, widths), 1):
+                cell = ws.cell(row=1, column=c, value=h)
+                cell.font = hfnt
+                cell.fill = fill
+                cell.alignment = Alignment(horizontal='center')
+                ws.column_dimensions[cell.column_letter].width = w
 
-        buf = io.BytesIO()
-        wb.save(buf)
-        buf.seek(0)
+            alt = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
+            for i, r in enumerate(rows, 2):
+                vals = [
+                    r['document_number'], r['movement_type'], r['doc_type'], r['movement_date'],
+                    r['source_project'], r['dest_project'],
+                    r['end_user_name'], r['third_party_name'],
+                    r['line_no'], r['item_code'], r['item_description'],
+                    r['batch_no'], r['exp_date'], r['qty'], r['unit'],
+                    r['unit_price'], r['currency'], r['total_value'],
+                    r['weight_kg'], r['volume_m3'], r['notes'],
+                ]
+                for c, v in enumerate(vals, 1):
+                    cell = ws.cell(row=i, column=c, value=v)
+                    if i % 2 == 0:
+                        cell.fill = alt
+
+            buf = io.BytesIO()
+            wb.save(buf)
+            return buf.getvalue()
+
+        filters = {'project': project, 'doc_type': doc_type, 'direction': direction,
+                   'date_from': date_from, 'date_to': date_to}
+        data  = _cached_export(conn, 'transactions', _MOVEMENT_TABLES, filters, build)
         fname = f"transactions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        return send_file(buf, as_attachment=True, download_name=fname,
-                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        return _xlsx_response(data, fname)
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
@@ -4748,50 +5455,155 @@ def rpt_transactions_export():
 
 # ── Expiry Report ─────────────────────────────────────────────────────────
 
+def _expiry_cte(project=None):
+    """
+    Stock per (project, item, batch, exp_date_iso) restricted to expiry dates on
+    or before :horizon, with days_left and status bucket computed in SQL.
+    Every branch filters on an indexed exp_date_iso range before grouping.
+    Params: :horizon, :today (YYYY-MM-DD) and :project when given.
+    """
+    proj_r = " AND st.project_code = :project"   if project else ""
+    proj_b = " AND bd.project_code = :project"   if project else ""
+    proj_i = " AND m.dest_project = :project"    if project else ""
+    proj_o = " AND m.source_project = :project"  if project else ""
+    return f'''
+        WITH combined AS (
+            SELECT st.project_code AS project_code, st.item_code,
+                   MAX(st.item_description) AS item_description,
+                   COALESCE(st.batch_no,'') AS batch_no, st.exp_date_iso,
+                   SUM(st.qty_received) AS qty_in, 0.0 AS qty_out
+            FROM stock_transactions st
+            WHERE st.exp_date_iso <= :horizon
+              AND st.transaction_type IN ('RECEPTION', 'OPENING'){proj_r}
+            GROUP BY st.project_code, st.item_code, COALESCE(st.batch_no,''), st.exp_date_iso
+            UNION ALL
+            -- Fallback: received basic_data rows whose parcel is not in stock_transactions
+            SELECT bd.project_code, bd.item_code, MAX(bd.item_description),
+                   COALESCE(bd.batch_no_received, bd.batch_no,''), bd.exp_date_iso,
+                   SUM(bd.qty_unit_tot), 0.0
+            FROM basic_data bd
+            WHERE bd.exp_date_iso <= :horizon
+              AND bd.reception_number IS NOT NULL AND bd.item_code IS NOT NULL
+              AND bd.qty_unit_tot > 0{proj_b}
+              AND (bd.parcel_number IS NULL
+                   OR bd.parcel_number NOT IN (
+                       SELECT DISTINCT parcel_number FROM stock_transactions
+                       WHERE transaction_type='RECEPTION' AND parcel_number IS NOT NULL))
+            GROUP BY bd.project_code, bd.item_code,
+                     COALESCE(bd.batch_no_received, bd.batch_no,''), bd.exp_date_iso
+            UNION ALL
+            SELECT m.dest_project, ml.item_code, MAX(ml.item_description),
+                   COALESCE(ml.batch_no,''), ml.exp_date_iso,
+                   SUM(ml.qty), 0.0
+            FROM movement_lines ml JOIN movements m ON m.id = ml.movement_id
+            WHERE ml.exp_date_iso <= :horizon
+              AND m.movement_type = 'IN' AND m.status = 'Confirmed'{proj_i}
+            GROUP BY m.dest_project, ml.item_code, COALESCE(ml.batch_no,''), ml.exp_date_iso
+            UNION ALL
+            SELECT m.source_project, ml.item_code, '',
+                   COALESCE(ml.batch_no,''), ml.exp_date_iso,
+                   0.0, SUM(ml.qty)
+            FROM movement_lines ml JOIN movements m ON m.id = ml.movement_id
+            WHERE ml.exp_date_iso <= :horizon
+              AND m.movement_type = 'OUT' AND m.status = 'Confirmed'{proj_o}
+            GROUP BY m.source_project, ml.item_code, COALESCE(ml.batch_no,''), ml.exp_date_iso
+        ),
+        stock AS (
+            SELECT project_code, item_code, MAX(item_description) AS item_description,
+                   batch_no, exp_date_iso AS exp_date,
+                   SUM(qty_in) - SUM(qty_out) AS net_stock,
+                   CAST(julianday(exp_date_iso) - julianday(:today) AS INTEGER) AS days_left
+            FROM combined
+            GROUP BY project_code, item_code, batch_no, exp_date_iso
+            HAVING net_stock > 0
+        ),
+        expiry AS (
+            SELECT *,
+                   CASE WHEN days_left < 0  THEN 'Expired'
+                        WHEN days_left < 30 THEN 'Critical'
+                        WHEN days_left < 90 THEN 'Warning'
+                        ELSE 'OK' END AS status
+            FROM stock
+        )
+    '''
+
+
+def _expiry_params(project, within_days):
+    today = datetime.now().date()
+    horizon = ('9999-12-31' if within_days >= 36500
+               else (today + timedelta(days=within_days)).isoformat())
+    params = {'today': today.isoformat(), 'horizon': horizon}
+    if project:
+        params['project'] = project
+    return params
+
+
+def _expiry_cursor(conn, project=None, within_days=90, limit=None, offset=0):
+    """Cursor over expiring stock lines, soonest first."""
+    sql = _expiry_cte(project) + '''
+        SELECT project_code, item_code, item_description, batch_no, exp_date,
+               days_left, net_stock, status
+        FROM expiry
+        ORDER BY days_left, project_code, item_code, batch_no
+    '''
+    params = _expiry_params(project, within_days)
+    if limit:
+        sql += " LIMIT :limit OFFSET :offset"
+        params.update(limit=limit, offset=offset)
+    return conn.execute(sql, params)
+
+
+def _expiry_rows(conn, project=None, within_days=90, limit=None, offset=0):
+    """Expiring stock lines as dicts, soonest first."""
+    return [dict(r) for r in _expiry_cursor(conn, project, within_days, limit, offset).fetchall()]
+
+
+def _expiry_rollup(conn, project=None, within_days=90):
+    """Per-project counts per status bucket and stock quantities."""
+    rows = conn.execute(_expiry_cte(project) + '''
+        SELECT project_code,
+               COUNT(*)                                      AS lines,
+               SUM(status = 'Expired')                       AS expired,
+               SUM(status = 'Critical')                      AS critical,
+               SUM(status = 'Warning')                       AS warning,
+               SUM(status = 'OK')                            AS ok,
+               SUM(net_stock)                                AS net_stock,
+               SUM(CASE WHEN status = 'Expired' THEN net_stock ELSE 0 END) AS expired_stock
+        FROM expiry
+        GROUP BY project_code
+        ORDER BY project_code
+    ''', _expiry_params(project, within_days)).fetchall()
+    return [dict(r) for r in rows]
+
+
 @app.route('/api/reports/expiry', methods=['GET'])
 @login_required
 def rpt_expiry():
-    """Items with an expiry date within the next N days (or already expired)."""
+    """Items with an expiry date within the next N days (or already expired).
+    Optional page/limit paginate the rows; rollup and summary always cover the full result."""
     conn = None
+    try:
+        within_days = int(request.args.get('within_days') or 90)
+        limit       = int(request.args.get('limit') or 0)
+        page        = int(request.args.get('page') or 1)
+        if within_days < 0 or limit < 0 or page < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid within_days, page or limit'}), 400
     try:
         conn        = _reports_db()
         project     = request.args.get('project') or None
-        within_days = int(request.args.get('within_days') or 90)
-        rows        = _stock_summary_rows(conn, project, None)
-        today       = datetime.now().date()
-        result      = []
-        for r in rows:
-            if not r['exp_date']:
-                continue
-            try:
-                exp_date = datetime.strptime(r['exp_date'], '%Y-%m-%d').date()
-            except Exception:
-                continue
-            days_left = (exp_date - today).days
-            if days_left > within_days:
-                continue
-            if (r['net_stock'] or 0) <= 0:
-                continue
-            if days_left < 0:
-                status = 'Expired'
-            elif days_left < 30:
-                status = 'Critical'
-            elif days_left < 90:
-                status = 'Warning'
-            else:
-                status = 'OK'
-            result.append({
-                'project_code':    r['project_code'],
-                'item_code':       r['item_code'],
-                'item_description':r['item_description'],
-                'batch_no':        r['batch_no'],
-                'exp_date':        r['exp_date'],
-                'days_left':       days_left,
-                'net_stock':       r['net_stock'],
-                'status':          status,
-            })
-        result.sort(key=lambda x: x['days_left'])
-        return jsonify({'success': True, 'rows': result})
+        # days_left depends on the date, so today is part of the cache key
+        filters     = {'project': project, 'within_days': within_days, 'limit': limit,
+                       'page': page, 'today': datetime.now().date().isoformat()}
+        rows, rollup = _cached_report(conn, 'expiry', _STOCK_TABLES, filters, lambda: (
+            _expiry_rows(conn, project, within_days,
+                         limit=limit or None, offset=(page - 1) * limit),
+            _expiry_rollup(conn, project, within_days)))
+        summary     = {k: sum(p[k] or 0 for p in rollup)
+                       for k in ('lines', 'expired', 'critical', 'warning', 'ok')}
+        return jsonify({'success': True, 'rows': rows, 'rollup': rollup, 'summary': summary,
+                        'total': summary['lines'], 'page': page, 'limit': limit})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
@@ -4803,143 +5615,134 @@ def rpt_expiry():
 def rpt_expiry_export():
     """Export expiry report to Excel."""
     conn = None
+    try:
+        within_days = int(request.args.get('within_days') or 90)
+        if within_days < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid within_days'}), 400
     try:
         conn        = _reports_db()
         project     = request.args.get('project') or None
-        within_days = int(request.args.get('within_days') or 90)
-        rows        = _stock_summary_rows(conn, project, None)
         today       = datetime.now().date()
-        result      = []
-        for r in rows:
-            if not r['exp_date']:
-                continue
-            try:
-                exp_date = datetime.strptime(r['exp_date'], '%Y-%m-%d').date()
-            except Exception:
-                continue
-            days_left = (exp_date - today).days
-            if days_left > within_days:
-                continue
-            if (r['net_stock'] or 0) <= 0:
-                continue
-            status = 'Expired' if days_left < 0 else ('Critical' if days_left < 30 else ('Warning' if days_left < 90 else 'OK'))
-            result.append({
-                'project_code':    r['project_code'],
-                'item_code':       r['item_code'],
-                'item_description':r['item_description'],
-                'batch_no':        r['batch_no'],
-                'exp_date':        r['exp_date'],
-                'days_left':       days_left,
-                'net_stock':       r['net_stock'],
-                'status':          status,
-            })
-        result.sort(key=lambda x: x['days_left'])
-
-        # Get mission name for heading
-        mission_row = conn.execute(
-            "SELECT mission_name, mission_abbreviation FROM mission_details WHERE is_active=1 LIMIT 1"
-        ).fetchone()
-        mission_name  = mission_row['mission_name']        if mission_row else ''
-        mission_abbr  = mission_row['mission_abbreviation'] if mission_row else ''
-
-        from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = 'Expiry Report'
-        ws.page_setup.orientation = 'landscape'
-        ws.page_setup.fitToPage  = True
-        ws.page_setup.fitToWidth = 1
-        ws.page_setup.fitToHeight = 0
-
-        NUM_COLS = 8
-
-        # ── Title block (rows 1-4) ─────────────────────────────────────────
-        title_fill = PatternFill(start_color='1F3A8A', end_color='1F3A8A', fill_type='solid')
-        title_font = Font(bold=True, color='FFFFFF', size=13)
-        sub_font   = Font(bold=False, color='FFFFFF', size=10)
-        white_bold = Font(bold=True, color='FFFFFF', size=10)
-
-        # Row 1: Mission name (left) + report title (right)
-        ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=4)
-        c1 = ws.cell(row=1, column=1, value=mission_name or mission_abbr or 'EXPIRY REPORT')
-        c1.font = title_font
-        c1.fill = title_fill
-        c1.alignment = Alignment(horizontal='left', vertical='center')
-
-        ws.merge_cells(start_row=1, start_column=5, end_row=1, end_column=NUM_COLS)
-        c2 = ws.cell(row=1, column=5, value='EXPIRY REPORT')
-        c2.font = title_font
-        c2.fill = title_fill
-        c2.alignment = Alignment(horizontal='right', vertical='center')
-        ws.row_dimensions[1].height = 22
-
-        # Row 2: Project filter + within days
-        proj_label = f"Project: {project}" if project else 'Project: All'
-        days_label = f"Expiring within: {within_days} days" if within_days < 9999 else 'All expired + expiring'
-        ws.merge_cells(start_row=2, start_column=1, end_row=2, end_column=4)
-        c3 = ws.cell(row=2, column=1, value=proj_label)
-        c3.font = sub_font; c3.fill = title_fill
-        c3.alignment = Alignment(horizontal='left', vertical='center')
-
-        ws.merge_cells(start_row=2, start_column=5, end_row=2, end_column=NUM_COLS)
-        c4 = ws.cell(row=2, column=5, value=days_label)
-        c4.font = sub_font; c4.fill = title_fill
-        c4.alignment = Alignment(horizontal='right', vertical='center')
-        ws.row_dimensions[2].height = 16
-
-        # Row 3: Generated date + summary counts
-        expired_cnt  = sum(1 for r in result if r['status']=='Expired')
-        critical_cnt = sum(1 for r in result if r['status']=='Critical')
-        warning_cnt  = sum(1 for r in result if r['status']=='Warning')
-        gen_label = f"Generated: {today.strftime('%Y-%m-%d')}    |    Expired: {expired_cnt}  Critical: {critical_cnt}  Warning: {warning_cnt}  Total: {len(result)}"
-        ws.merge_cells(start_row=3, start_column=1, end_row=3, end_column=NUM_COLS)
-        c5 = ws.cell(row=3, column=1, value=gen_label)
-        c5.font = white_bold; c5.fill = title_fill
-        c5.alignment = Alignment(horizontal='left', vertical='center')
-        ws.row_dimensions[3].height = 16
-
-        # Row 4: blank spacer with title fill
-        for col in range(1, NUM_COLS + 1):
-            ws.cell(row=4, column=col).fill = title_fill
-        ws.row_dimensions[4].height = 6
-
-        # ── Column headers (row 5) ────────────────────────────────────────
-        headers = [('Project', 12), ('Item Code', 16), ('Description', 34),
-                   ('Batch', 14), ('Exp Date', 11), ('Days Left', 10),
-                   ('Net Stock', 11), ('Status', 10)]
-        hfnt = Font(bold=True, color='FFFFFF')
-        hfill = PatternFill(start_color='374151', end_color='374151', fill_type='solid')
-        thin  = Side(style='thin', color='CCCCCC')
-        border = Border(left=thin, right=thin, top=thin, bottom=thin)
-        for c, (h, w) in enumerate(headers, 1):
-            cell = ws.cell(row=5, column=c, value=h)
-            cell.font   = hfnt
-            cell.fill   = hfill
-            cell.alignment = Alignment(horizontal='center')
-            cell.border = border
-            ws.column_dimensions[cell.column_letter].width = w
-        ws.row_dimensions[5].height = 16
-
-        # ── Data rows (starting row 6) ────────────────────────────────────
-        red_fill    = PatternFill(start_color='FEE2E2', end_color='FEE2E2', fill_type='solid')
-        orange_fill = PatternFill(start_color='FEF3C7', end_color='FEF3C7', fill_type='solid')
-        for i, r in enumerate(result, 6):
-            vals = [r['project_code'], r['item_code'], r['item_description'],
-                    r['batch_no'], r['exp_date'], r['days_left'],
-                    round(r['net_stock'], 3), r['status']]
-            row_fill = red_fill if r['days_left'] < 30 else (orange_fill if r['days_left'] < 90 else None)
-            for c, v in enumerate(vals, 1):
-                cell = ws.cell(row=i, column=c, value=v)
+        fmt         = _delimited_format()
+        if fmt:
+            return _stream_delimited(fmt, 'expiry_report', [
+                ('Project', 'project_code'), ('Item Code', 'item_code'),
+                ('Description', 'item_description'), ('Batch', 'batch_no'),
+                ('Exp Date', 'exp_date'), ('Days Left', 'days_left'),
+                ('Net Stock', 'net_stock'), ('Status', 'status'),
+            ], lambda c: _expiry_cursor(c, project, within_days))
+        def build():
+            result      = _expiry_rows(conn, project, within_days)
+
+            # Get mission name for heading
+            mission_row = conn.execute(
+                "SELECT mission_name, mission_abbreviation FROM mission_details WHERE is_active=1 LIMIT 1"
+            ).fetchone()
+            mission_name  = mission_row['mission_name']        if mission_row else ''
+            mission_abbr  = mission_row['mission_abbreviation'] if mission_row else ''
+
+            from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+            wb = openpyxl.Workbook()
+            ws = wb.active
+            ws.title = 'Expiry Report'
+            ws.page_setup.orientation = 'landscape'
+            ws.page_setup.fitToPage  = True
+            ws.page_setup.fitToWidth = 1
+            ws.page_setup.fitToHeight = 0
+
+            NUM_COLS = 8
+
+            # ── Title block (rows 1-4) ─────────────────────────────────────────
+            title_fill = PatternFill(start_color='1F3A8A', end_color='1F3A8A', fill_type='solid')
+            title_font = Font(bold=True, color='FFFFFF', size=13)
+            sub_font   = Font(bold=False, color='FFFFFF', size=10)
+            white_bold = Font(bold=True, color='FFFFFF', size=10)
+
+            # Row 1: Mission name (left) + report title (right)
+            ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=4)
+            c1 = ws.cell(row=1, column=1, value=mission_name or mission_abbr or 'EXPIRY REPORT')
+            c1.font = title_font
+            c1.fill = title_fill
+            c1.alignment = Alignment(horizontal='left', vertical='center')
+
+            ws.merge_cells(start_row=1, start_column=5, end_row=1, end_column=NUM_COLS)
+            c2 = ws.cell(row=1, column=5, value='EXPIRY REPORT')
+            c2.font = title_font
+            c2.fill = title_fill
+            c2.alignment = Alignment(horizontal='right', vertical='center')
+            ws.row_dimensions[1].height = 22
+
+            # Row 2: Project filter + within days
+            proj_label = f"Project: {project}" if project else 'Project: All'
+            days_label = f"Expiring within: {within_days} days" if within_days < 9999 else 'All expired + expiring'
+            ws.merge_cells(start_row=2, start_column=1, end_row=2, end_column=4)
+            c3 = ws.cell(row=2, column=1, value=proj_label)
+            c3.font = sub_font; c3.fill = title_fill
+            c3.alignment = Alignment(horizontal='left', vertical='center')
+
+            ws.merge_cells(start_row=2, start_column=5, end_row=2, end_column=NUM_COLS)
+            c4 = ws.cell(row=2, column=5, value=days_label)
+            c4.font = sub_font; c4.fill = title_fill
+            c4.alignment = Alignment(horizontal='right', vertical='center')
+            ws.row_dimensions[2].height = 16
+
+            # Row 3: Generated date + summary counts
+            expired_cnt  = sum(1 for r in result if r['status']=='Expired')
+            critical_cnt = sum(1 for r in result if r['status']=='Critical')
+            warning_cnt  = sum(1 for r in result if r['status']=='Warning')
+            gen_label = f"Generated: {today.strftime('%Y-%m-%d')}    |    Expired: {expired_cnt}  Critical: {critical_cnt}  Warning: {warning_cnt}  Total: {len(result)}"
+            ws.merge_cells(start_row=3, start_column=1, end_row=3, end_column=NUM_COLS)
+            c5 = ws.cell(row=3, column=1, value=gen_label)
+            c5.font = white_bold; c5.fill = title_fill
+            c5.alignment = Alignment(horizontal='left', vertical='center')
+            ws.row_dimensions[3].height = 16
+
+            # Row 4: blank spacer with title fill
+            for col in range(1, NUM_COLS + 1):
+                ws.cell(row=4, column=col).fill = title_fill
+            ws.row_dimensions[4].height = 6
+
+            # ── Column headers (row 5) ────────────────────────────────────────
+            headers = [('Project', 12), ('Item Code', 16), ('Description', 34),
+                       ('Batch', 14), ('Exp Date', 11), ('Days Left', 10),
+                       ('Net Stock', 11), ('Status', 10)]
+            hfnt = Font(bold=True, color='FFFFFF')
+            hfill = PatternFill(start_color='374151', end_color='374151', fill_type='solid')
+            thin  = Side(style='thin', color='CCCCCC')
+            border = Border(left=thin, right=thin, top=thin, bottom=thin)
+            for c, (h, w) in enumerate(headers, 1):
+                cell = ws.cell(row=5, column=c, value=h)
+                cell.font   = hfnt
+                cell.fill   = hfill
+                cell.alignment = Alignment(horizontal='center')
                 cell.border = border
-                if row_fill:
-                    cell.fill = row_fill
-
-        buf = io.BytesIO()
-        wb.save(buf)
-        buf.seek(0)
+                ws.column_dimensions[cell.column_letter].width = w
+            ws.row_dimensions[5].height = 16
+
+            # ── Data rows (starting row 6) ────────────────────────────────────
+            red_fill    = PatternFill(start_color='FEE2E2', end_color='FEE2E2', fill_type='solid')
+            orange_fill = PatternFill(start_color='FEF3C7', end_color='FEF3C7', fill_type='solid')
+            for i, r in enumerate(result, 6):
+                vals = [r['project_code'], r['item_code'], r['item_description'],
+                        r['batch_no'], r['exp_date'], r['days_left'],
+                        round(r['net_stock'], 3), r['status']]
+                row_fill = red_fill if r['days_left'] < 30 else (orange_fill if r['days_left'] < 90 else None)
+                for c, v in enumerate(vals, 1):
+                    cell = ws.cell(row=i, column=c, value=v)
+                    cell.border = border
+                    if row_fill:
+                        cell.fill = row_fill
+
+            buf = io.BytesIO()
+            wb.save(buf)
+            return buf.getvalue()
+
+        filters = {'project': project, 'within_days': within_days, 'today': today.isoformat()}
+        data  = _cached_export(conn, 'expiry', _STOCK_TABLES, filters, build)
         fname = f"expiry_report_{today.strftime('%Y%m%d')}.xlsx"
-        return send_file(buf, as_attachment=True, download_name=fname,
-                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        return _xlsx_response(data, fname)
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
@@ -4989,24 +5792,33 @@ def inv_items():
     project = request.args.get('project') or None
     conn    = None
     try:
-        conn  = _mov_db()
-        rows  = _stock_summary_rows(conn, project, None)
+        conn = _mov_db()
+        summary_sql, params = _stock_summary_sql(project, None)
+        # One pass: stock lines joined to every parcel/pallet holding them
+        rows = conn.execute(f'''
+            SELECT s.*, l.locations
+            FROM ({summary_sql}) s
+            LEFT JOIN (
+                SELECT project_code, item_code, batch_no,
+                       json_group_array(json_object(
+                           'parcel_number', parcel_number,
+                           'pallet_number', pallet_number,
+                           'qty', qty)) AS locations
+                FROM (SELECT * FROM stock_locations
+                      ORDER BY project_code, item_code, batch_no, pallet_number, parcel_number)
+                GROUP BY project_code, item_code, batch_no
+            ) l ON l.project_code IS s.project_code
+               AND l.item_code = s.item_code
+               AND l.batch_no  = s.batch_no
+            WHERE s.net_stock > 0
+        ''', params).fetchall()
         items = []
         for r in rows:
-            if (r['net_stock'] or 0) <= 0:
-                continue
             d = dict(r)
-            # Look up parcel_number and pallet_number from basic_data
-            bd = conn.execute(
-                '''SELECT parcel_number, pallet_number FROM basic_data
-                   WHERE item_code=? AND (project_code=? OR (project_code IS NULL AND ? IS NULL))
-                     AND (batch_no_received=? OR batch_no=?)
-                   LIMIT 1''',
-                (d.get('item_code'), d.get('project_code'), d.get('project_code'),
-                 d.get('batch_no') or '', d.get('batch_no') or '')
-            ).fetchone()
-            d['parcel_number'] = bd['parcel_number'] if bd else None
-            d['pallet_number'] = bd['pallet_number'] if bd else None
+            d['locations'] = json.loads(d['locations']) if d['locations'] else []
+            first = d['locations'][0] if d['locations'] else {}
+            d['parcel_number'] = first.get('parcel_number')
+            d['pallet_number'] = first.get('pallet_number')
             items.append(d)
         return jsonify({'success': True, 'items': items})
     except Exception as e:
@@ -5017,6 +5829,7 @@ def inv_items():
 
 @app.route('/api/inventory/count', methods=['POST'])
 @login_required
+@idempotent
 def inv_save_count():
     conn = None
     try:
@@ -5107,7 +5920,7 @@ def inv_count_detail(count_id):
 def inv_count_export(count_id):
     conn = None
     try:
-        conn  = _mov_db()
+        conn  = _reports_db()
         hdr   = conn.execute(
             "SELECT ic.*, u.username AS created_by_name "
             "FROM inventory_counts ic LEFT JOIN users u ON u.id=ic.created_by "
@@ -5203,15 +6016,14 @@ def inv_blank_sheet():
         ws.page_setup.fitToWidth  = 1
         ws.page_setup.fitToHeight = 0
 
+        styles = WorkbookStyles(wb)
+
         ws['A1'] = f"Physical Inventory Count Sheet — {count_type.upper()}"
         ws['A1'].font = Font(bold=True, size=13)
         ws.merge_cells('A1:I1')
         ws['A2'] = f"Project: {project or 'ALL'}  |  Date: _______________  |  Counted by: _______________"
         ws.merge_cells('A2:I2')
 
-        fill  = PatternFill(start_color='1F3A8A', end_color='1F3A8A', fill_type='solid')
-        hfont = Font(bold=True, color='FFFFFF', size=10)
-
         if count_type == 'parcel':
             rows = conn.execute('''
                 SELECT parcel_number, packing_ref, project_code, pallet_number,
@@ -5226,36 +6038,23 @@ def inv_blank_sheet():
             headers = [('Parcel No', 16), ('Packing Ref', 14), ('Project', 12),
                        ('Pallet', 12), ('Items', 8), ('Weight', 10),
                        ('Physical Count', 16), ('OK?', 6), ('Notes', 24)]
-            for c, (h, w) in enumerate(headers, 1):
-                cell = ws.cell(row=4, column=c, value=h)
-                cell.font = hfont; cell.fill = fill
-                cell.alignment = Alignment(horizontal='center')
-                ws.column_dimensions[cell.column_letter].width = w
-            for i, r in enumerate(rows, 5):
-                ws.cell(row=i, column=1, value=r['parcel_number'])
-                ws.cell(row=i, column=2, value=r['packing_ref'])
-                ws.cell(row=i, column=3, value=r['project_code'])
-                ws.cell(row=i, column=4, value=r['pallet_number'])
-                ws.cell(row=i, column=5, value=r['item_count'])
-                ws.cell(row=i, column=6, value=r['total_weight'])
+            values = [(r['parcel_number'], r['packing_ref'], r['project_code'],
+                       r['pallet_number'], r['item_count'], r['total_weight'])
+                      for r in rows]
         else:
             stock_rows = _stock_summary_rows(conn, project, None)
             stock_rows = [r for r in stock_rows if (r['net_stock'] or 0) > 0]
 
             headers = [('Item Code', 14), ('Description', 34), ('Batch', 14), ('Exp Date', 11),
                        ('Project', 12), ('System Qty', 12), ('Physical Qty', 14), ('Variance', 12), ('Notes', 24)]
-            for c, (h, w) in enumerate(headers, 1):
-                cell = ws.cell(row=4, column=c, value=h)
-                cell.font = hfont; cell.fill = fill
-                cell.alignment = Alignment(horizontal='center')
-                ws.column_dimensions[cell.column_letter].width = w
-            for i, r in enumerate(stock_rows, 5):
-                ws.cell(row=i, column=1, value=r['item_code'])
-                ws.cell(row=i, column=2, value=r['item_description'])
-                ws.cell(row=i, column=3, value=r['batch_no'])
-                ws.cell(row=i, column=4, value=r['exp_date'])
-                ws.cell(row=i, column=5, value=r['project_code'])
-                ws.cell(row=i, column=6, value=r['net_stock'])
+            values = [(r['item_code'], r['item_description'], r['batch_no'],
+                       r['exp_date'], r['project_code'], r['net_stock'])
+                      for r in stock_rows]
+
+        for c, (h, w) in enumerate(headers, 1):
+            cell = styles.cell(ws, 4, c, h, 'mf_header')
+            ws.column_dimensions[cell.column_letter].width = w
+        styles.write_rows(ws, 5, values)
 
         ws.freeze_panes = 'A5'
         buf = io.BytesIO()
@@ -5274,10 +6073,20 @@ def inv_blank_sheet():
 #  PALLET CHANGE  (Phase 6)
 # ═══════════════════════════════════════════════════════════════════════════
 
+def _change_pallet_tx(conn, parcel_number, new_pallet):
+    """Unit of work moving a parcel to another pallet (see _write)."""
+    conn.execute(
+        "UPDATE basic_data SET pallet_number=? WHERE parcel_number=?",
+        (new_pallet, parcel_number))
+    conn.execute(
+        "UPDATE stock_transactions SET pallet_number=? WHERE parcel_number=?",
+        (new_pallet, parcel_number))
+    refresh_stock_locations(conn, parcel_number)
+
+
 @app.route('/api/cargo/change-pallet', methods=['PATCH'])
 @login_required
 def cr_change_pallet():
-    conn = None
     try:
         data           = request.get_json()
         parcel_number  = (data.get('parcel_number') or '').strip()
@@ -5285,20 +6094,14 @@ def cr_change_pallet():
         if not parcel_number or not new_pallet:
             return jsonify({'success': False,
                             'message': 'parcel_number and new_pallet are required'}), 400
-        conn = _mov_db()
-        conn.execute(
-            "UPDATE basic_data SET pallet_number=? WHERE parcel_number=?",
-            (new_pallet, parcel_number))
-        conn.execute(
-            "UPDATE stock_transactions SET pallet_number=? WHERE parcel_number=?",
-            (new_pallet, parcel_number))
-        conn.commit()
+        _write('pallet', _change_pallet_tx, parcel_number, new_pallet)
         return jsonify({'success': True, 'new_pallet': new_pallet})
+    except sqlite3.OperationalError as e:
+        if is_busy_error(e):
+            return jsonify({'success': False, 'message': 'busy', 'retry': True}), 503
+        return jsonify({'success': False, 'message': str(e)}), 500
     except Exception as e:
-        if conn: conn.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn: conn.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,323 @@
+"""
+Yearly archive databases for closed periods.
+
+Closing a year moves its settled history out of the live database into
+archive/inventory_<year>.db next to it:
+  - confirmed movements dated up to the year end, with their lines
+  - stock_transactions up to the year end that have no parcel, or whose
+    parcel is closed: every line dispatched by confirmed OUT movements
+    dated up to the year end, and nothing received or drafted after it
+  - the basic_data lines of those closed parcels
+The net stock those rows add up to is written back to the live
+stock_transactions as OPENING rows dated January 1st of the next year, so
+every balance query gives the same answer from the live tables alone.
+
+Reports whose date range reaches into a closed year open a reader with the
+archives it needs attached read-only (open_reader) and name each table
+through source(): the plain table without archives, a UNION ALL over the
+live and archived copies with them. Archived rows keep their ids; those are
+AUTOINCREMENT, so the live database never hands them out again.
+"""
+import json
+import os
+import sqlite3
+from datetime import datetime
+from urllib.parse import quote
+
+from database import (DATABASE, ReadOnlyConnection, begin_immediate, bulk_writes,
+                      refresh_stock_locations)
+import metrics
+
+ARCHIVED_TABLES = ('movements', 'movement_lines', 'stock_transactions', 'basic_data')
+
+# date_from for reports that always need the whole history
+ALL_YEARS = '0000-01-01'
+
+# Parcels whose whole history ends before :cutoff. Parcels received before
+# stock_transactions existed (basic_data only) stay live, so the reports'
+# basic_data fallback keeps counting them exactly as before.
+_CLOSED_PARCELS = '''
+    SELECT bd.parcel_number FROM {s}.basic_data bd
+    WHERE bd.parcel_number IS NOT NULL AND bd.parcel_number != ''
+    GROUP BY bd.parcel_number
+    HAVING SUM(COALESCE(bd.parcel_status, '') != 'dispatched') = 0
+       AND SUM(COALESCE(bd.received_at, '') >= :cutoff) = 0
+    EXCEPT
+    SELECT ml.parcel_number FROM {s}.movement_lines ml
+    JOIN {s}.movements m ON m.id = ml.movement_id
+    WHERE m.movement_type = 'OUT' AND (m.status != 'Confirmed' OR m.movement_date >= :cutoff)
+    EXCEPT
+    SELECT parcel_number FROM {s}.stock_transactions WHERE received_at >= :cutoff
+    EXCEPT
+    SELECT bd.parcel_number FROM {s}.basic_data bd
+    WHERE bd.reception_number IS NOT NULL
+      AND bd.parcel_number NOT IN (
+          SELECT parcel_number FROM {s}.stock_transactions
+          WHERE transaction_type = 'RECEPTION' AND parcel_number IS NOT NULL)
+'''
+
+# table → WHERE clause selecting the rows that move, for schema {s};
+# {parcels} is a query returning the closed parcels
+_SELECTION = {
+    'movements':          "status = 'Confirmed' AND movement_date < :cutoff",
+    'movement_lines':     ("movement_id IN (SELECT id FROM {s}.movements "
+                           "WHERE status = 'Confirmed' AND movement_date < :cutoff)"),
+    'stock_transactions': ("received_at < :cutoff AND (COALESCE(parcel_number, '') = '' "
+                           "OR parcel_number IN ({parcels}))"),
+    'basic_data':         "parcel_number IN ({parcels})",
+}
+
+# Net stock of the rows that move, with the same sources and keys as the
+# stock summary (raw expiry) and the available-stock query (ISO expiry).
+_OPENING_SQL = '''
+    SELECT project_code, item_code, MAX(item_description) AS item_description,
+           batch_no, exp_date, exp_key, ROUND(SUM(qty), 6) AS qty
+    FROM (
+        SELECT st.project_code, st.item_code, st.item_description,
+               COALESCE(st.batch_no, '') AS batch_no, COALESCE(st.exp_date, '') AS exp_date,
+               COALESCE(st.exp_date_iso, '') AS exp_key, st.qty_received AS qty
+        FROM main.stock_transactions st
+        WHERE st.transaction_type IN ('RECEPTION', 'OPENING') AND {stock_transactions}
+        UNION ALL
+        SELECT m.dest_project, ml.item_code, ml.item_description,
+               COALESCE(ml.batch_no, ''), COALESCE(ml.exp_date, ''),
+               COALESCE(ml.exp_date_iso, ''), ml.qty
+        FROM main.movement_lines ml JOIN main.movements m ON m.id = ml.movement_id
+        WHERE m.movement_type = 'IN' AND m.status = 'Confirmed' AND m.movement_date < :cutoff
+        UNION ALL
+        SELECT m.source_project, ml.item_code, NULL,
+               COALESCE(ml.batch_no, ''), COALESCE(ml.exp_date, ''),
+               COALESCE(ml.exp_date_iso, ''), -ml.qty
+        FROM main.movement_lines ml JOIN main.movements m ON m.id = ml.movement_id
+        WHERE m.movement_type = 'OUT' AND m.status = 'Confirmed' AND m.movement_date < :cutoff
+    )
+    WHERE item_code IS NOT NULL
+    GROUP BY project_code, item_code, batch_no, exp_date, exp_key
+    HAVING ABS(SUM(qty)) > 0.000001
+'''
+
+
+class ArchiveError(Exception):
+    """A year that cannot be closed; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def archive_dir(db_path=None):
+    return os.path.join(os.path.dirname(os.path.abspath(db_path or DATABASE)), 'archive')
+
+
+def archive_path(year, db_path=None):
+    return os.path.join(archive_dir(db_path), f'inventory_{int(year)}.db')
+
+
+def _where(table, schema, parcels=None):
+    return _SELECTION[table].format(s=schema,
+                                    parcels=parcels or _CLOSED_PARCELS.format(s=schema))
+
+
+def closed_years(conn):
+    """Closed years, oldest first."""
+    return [r[0] for r in conn.execute("SELECT year FROM archive_periods ORDER BY year")]
+
+
+def years_needed(conn, date_from):
+    """Closed years a report starting at `date_from` (YYYY-MM-DD) has to read.
+    An archive can hold rows dated before its year (a parcel closes in the
+    year of its last dispatch), so every closed year from date_from on is
+    needed. No date_from means the live period only."""
+    try:
+        first = int(str(date_from)[:4]) if date_from else None
+    except ValueError:
+        return []
+    if first is None:
+        return []
+    return [y for y in closed_years(conn) if y >= first]
+
+
+# ── Reading ──────────────────────────────────────────────────────────────
+
+def open_reader(years, db_path=None):
+    """
+    Read-only connection to the live database with the archives of `years`
+    attached as arch_<year>, inside a read transaction like the pooled report
+    connections. It is not pooled: close() really closes it.
+    """
+    db_path = db_path or DATABASE
+    conn = sqlite3.connect('file:' + quote(os.path.abspath(db_path)) + '?mode=ro',
+                           uri=True, factory=ReadOnlyConnection, check_same_thread=False)
+    try:
+        if len(years) > conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED):
+            raise ArchiveError(f'The date range spans {len(years)} closed years; narrow it down')
+        schemas = []
+        for year in years:
+            path = archive_path(year, db_path)
+            if not os.path.exists(path):
+                raise ArchiveError(f'Archive for {year} is missing ({path})', 500)
+            schema = f'arch_{int(year)}'
+            conn.execute(f"ATTACH DATABASE ? AS {schema}",
+                         ('file:' + quote(path) + '?mode=ro',))
+            schemas.append(schema)
+        conn.execute("PRAGMA query_only=1")
+        conn.archive_schemas = tuple(schemas)
+        conn.row_factory = sqlite3.Row
+        conn.execute("BEGIN")
+    except Exception:
+        conn.close()
+        raise
+    metrics.incr('archive.readers')
+    return conn
+
+
+def source(conn, table, columns):
+    """FROM-clause source for `table`: the table itself, or a UNION ALL of the
+    live and attached archive copies projected onto `columns` (columns an
+    older archive does not have read as NULL)."""
+    schemas = getattr(conn, 'archive_schemas', ())
+    if not schemas:
+        return table
+    parts = []
+    for schema in ('main',) + tuple(schemas):
+        have = {r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")}
+        cols = ', '.join(c if c in have else f'NULL AS {c}' for c in columns)
+        parts.append(f"SELECT {cols} FROM {schema}.{table}")
+    return '(' + ' UNION ALL '.join(parts) + ')'
+
+
+def attached_years(conn):
+    """Closed years whose archives `conn` reads."""
+    return [int(s.split('_', 1)[1]) for s in getattr(conn, 'archive_schemas', ())]
+
+
+def opening_cutoff(conn):
+    """received_at from which OPENING rows must be skipped by a reader that
+    also reads the archived rows they stand for ('' = keep them all)."""
+    years = attached_years(conn)
+    return f'{min(years) + 1}-01-01' if years else ''
+
+
+# ── Closing a year ───────────────────────────────────────────────────────
+
+def _check_closable(conn, year, cutoff):
+    if year >= datetime.now().year:
+        raise ArchiveError('Only past years can be closed')
+    last = conn.execute("SELECT MAX(year) FROM archive_periods").fetchone()[0]
+    if last is not None and year <= last:
+        raise ArchiveError(f'Closed up to {last} already; years are closed in order', 409)
+    drafts = conn.execute(
+        "SELECT COUNT(*) FROM movements WHERE status != 'Confirmed' AND movement_date < ?",
+        (cutoff,)).fetchone()[0]
+    if drafts:
+        raise ArchiveError(f'{drafts} draft movement(s) dated up to {year} must be '
+                           f'confirmed or deleted before the year can be closed', 409)
+
+
+def _copy_to_archive(db_path, path, cutoff):
+    """Write the rows that move into a new archive file; returns row counts."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    arch = sqlite3.connect('file:' + quote(path), uri=True)
+    try:
+        arch.execute("ATTACH DATABASE ? AS live",
+                     ('file:' + quote(os.path.abspath(db_path)) + '?mode=ro',))
+        counts = {}
+        for table in ARCHIVED_TABLES:
+            for (sql,) in arch.execute(
+                    "SELECT sql FROM live.sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL "
+                    "AND type IN ('table', 'index') ORDER BY type = 'index'", (table,)).fetchall():
+                arch.execute(sql)
+            counts[table] = arch.execute(
+                f"INSERT INTO main.{table} SELECT * FROM live.{table} WHERE {_where(table, 'live')}",
+                {'cutoff': cutoff}).rowcount
+        arch.commit()
+        arch.execute("DETACH DATABASE live")
+        return counts
+    finally:
+        arch.close()
+
+
+def _move_out_of_live(conn, year, cutoff, closed_by):
+    """Replace the moved rows by OPENING rows. Returns (row counts, openings)."""
+    params = {'cutoff': cutoff}
+    # Pinned first: the closed-parcel test reads the tables being emptied
+    conn.execute("DROP TABLE IF EXISTS temp._closed_parcels")
+    conn.execute("CREATE TEMP TABLE _closed_parcels AS " + _CLOSED_PARCELS.format(s='main'),
+                 params)
+    parcels = "SELECT parcel_number FROM temp._closed_parcels"
+    openings = conn.execute(
+        _OPENING_SQL.format(stock_transactions=_where('stock_transactions', 'main', parcels)),
+        params).fetchall()
+    counts = {}
+    # Lines before their movements, so the ON DELETE CASCADE has nothing left to do
+    for table in ('movement_lines', 'movements', 'stock_transactions', 'basic_data'):
+        counts[table] = conn.execute(
+            f"DELETE FROM {table} WHERE {_where(table, 'main', parcels)}", params).rowcount
+    conn.execute("DROP TABLE temp._closed_parcels")
+    conn.executemany('''
+        INSERT INTO stock_transactions
+            (transaction_type, project_code, item_code, item_description,
+             batch_no, exp_date, exp_date_iso, qty_received,
+             received_by, received_at, notes)
+        VALUES ('OPENING', ?, ?, ?, NULLIF(?, ''), NULLIF(?, ''), NULLIF(?, ''), ?, ?, ?, ?)
+    ''', [(r['project_code'], r['item_code'], r['item_description'],
+           r['batch_no'], r['exp_date'], r['exp_key'], r['qty'],
+           closed_by, f'{cutoff} 00:00:00', f'Opening balance carried forward from {year}')
+          for r in openings])
+    return counts, len(openings)
+
+
+def close_year(year, closed_by=None, db_path=None):
+    """
+    Move the settled history up to the end of `year` into its archive file and
+    carry the balances forward. The live write lock is held throughout, so
+    the copy (made on its own connection) and the delete see the same rows.
+    A crash in between leaves the live database untouched and an archive file
+    without its archive_periods row, which the next attempt overwrites.
+    Returns a summary dict; raises ArchiveError when the year cannot be closed.
+    """
+    db_path = db_path or DATABASE
+    year    = int(year)
+    cutoff  = f'{year + 1}-01-01'
+    path    = archive_path(year, db_path)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    written = False
+    try:
+        begin_immediate(conn, 'archive', busy_timeout_ms=10000)
+        _check_closable(conn, year, cutoff)
+        if os.path.exists(path):
+            os.remove(path)
+        copied  = _copy_to_archive(db_path, path, cutoff)
+        written = True
+        with bulk_writes(conn, *ARCHIVED_TABLES):
+            moved, openings = _move_out_of_live(conn, year, cutoff, closed_by)
+        if moved != copied:
+            raise ArchiveError(f'Archive copy does not match the live rows '
+                               f'(copied {copied}, removing {moved})', 500)
+        conn.execute('''
+            INSERT INTO archive_periods (year, row_counts, opening_rows, closed_by)
+            VALUES (?, ?, ?, ?)
+        ''', (year, json.dumps(copied), openings, closed_by))
+        refresh_stock_locations(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        if written and os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        conn.close()
+    metrics.incr('archive.years_closed')
+    return {'year': year, 'file': os.path.basename(path),
+            'rows': copied, 'opening_rows': openings}
+
+
+def archive_files(db_path=None):
+    """(file name, path) of every archive file, e.g. for backups."""
+    folder = archive_dir(db_path)
+    if not os.path.isdir(folder):
+        return []
+    return [(name, os.path.join(folder, name)) for name in sorted(os.listdir(folder))
+            if name.startswith('inventory_') and name.endswith('.db')]
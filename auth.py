@@ -1,6 +1,28 @@
-from flask_login import UserMixin
+from functools import wraps
+from flask import jsonify
+from flask_login import UserMixin, current_user
 from werkzeug.security import check_password_hash
 from database import get_db_connection
+from cache import TTLCache
+import metrics
+
+# Every permission name checked by the app
+PERMISSIONS = ('manage_all', 'view_all', 'create_packing_list', 'manage_items', 'export')
+
+# Role → permissions policy (role names upper-cased)
+DEFAULT_ROLE_PERMISSIONS = {
+    'ADMINISTRATOR': PERMISSIONS,
+    'HQ':            PERMISSIONS,
+    'COORDINATOR':   ('view_all', 'create_packing_list', 'manage_items', 'export'),
+    'MANAGER':       ('create_packing_list', 'manage_items', 'export'),
+    'SUPERVISOR':    ('create_packing_list', 'manage_items'),
+}
+
+# user_id → (id, username, role, language); loaded once per TTL instead of
+# on every request. Routes that change a user call invalidate_user().
+USER_CACHE = TTLCache('users', maxsize=1000, ttl=300)
+
+_MISSING = object()
 
 class User(UserMixin):
     def __init__(self, id, username, role, language='en'):
@@ -8,10 +30,22 @@ class User(UserMixin):
         self.username = username
         self.role = role
         self.language = language
+        self.permissions = permissions_for_role(role)
 
     @staticmethod
     def get(user_id):
-        """Get user by ID"""
+        """Get user by ID (cached)"""
+        key = str(user_id)
+        fields = USER_CACHE.get(key, _MISSING)
+        if fields is _MISSING:
+            user = User._load(user_id)
+            fields = (user.id, user.username, user.role, user.language) if user else None
+            USER_CACHE.set(key, fields)
+        return User(*fields) if fields else None
+
+    @staticmethod
+    def _load(user_id):
+        """Get user by ID from the database"""
         conn = get_db_connection()
         user_data = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
         conn.close()
@@ -61,48 +95,67 @@ class User(UserMixin):
             conn.commit()
             conn.close()
             self.language = language
+            invalidate_user(self.id)
         except Exception as e:
             print(f"Error updating language: {e}")
 
+def invalidate_user(user_id):
+    """Drop a user from the loader cache after it changes or is deleted"""
+    USER_CACHE.invalidate(str(user_id))
+
+def load_permission_matrix(conn=None):
+    """Compile the role → permissions matrix into frozensets.
+
+    DEFAULT_ROLE_PERMISSIONS is the policy shipped with the app; rows in the
+    role_permissions table replace the defaults for any role they mention,
+    so HQ can tune a role without a deploy. Call again after editing it."""
+    global _MATRIX
+    matrix = {role: set(perms) for role, perms in DEFAULT_ROLE_PERMISSIONS.items()}
+    own = conn is None
+    try:
+        if own:
+            conn = get_db_connection()
+        rows = conn.execute('SELECT role, permission FROM role_permissions').fetchall()
+        overrides = {}
+        for r in rows:
+            overrides.setdefault(r['role'].upper(), set()).add(r['permission'])
+        matrix.update(overrides)
+    except Exception:
+        pass    # table not created yet — defaults only
+    finally:
+        if own and conn is not None:
+            conn.close()
+    _MATRIX = {role: frozenset(perms) for role, perms in matrix.items()}
+    return _MATRIX
+
+def permissions_for_role(role):
+    """Frozen set of permissions granted to a role"""
+    return _MATRIX.get((role or '').upper(), _NO_PERMISSIONS)
+
 def has_permission(user, permission):
     """Check if user has permission"""
-    role = user.role.upper() if hasattr(user, 'role') else ''
-    
-    # Administrator/HQ has all permissions
-    if role in ['ADMINISTRATOR', 'HQ']:
-        return True
-    
-    # Coordinator permissions
-    if role == 'COORDINATOR':
-        return permission in [
-            'view_all',
-            'create_packing_list',
-            'manage_items',
-            'export'
-        ]
-    
-    # Manager permissions
-    if role == 'MANAGER':
-        return permission in [
-            'create_packing_list',
-            'manage_items',
-            'export'
-        ]
-    
-    # Supervisor permissions
-    if role == 'SUPERVISOR':
-        return permission in [
-            'create_packing_list',
-            'manage_items'
-        ]
-    
-    # Special permission mappings
-    permission_map = {
-        'manage_all': ['ADMINISTRATOR', 'HQ'],
-        'view_all': ['ADMINISTRATOR', 'HQ', 'COORDINATOR'],
-        'create_packing_list': ['ADMINISTRATOR', 'HQ', 'COORDINATOR', 'MANAGER', 'SUPERVISOR'],
-        'manage_items': ['ADMINISTRATOR', 'HQ', 'COORDINATOR', 'MANAGER', 'SUPERVISOR'],
-        'export': ['ADMINISTRATOR', 'HQ', 'COORDINATOR', 'MANAGER']
-    }
-    
-    return role in permission_map.get(permission, [])
\ No newline at end of file
+    permissions = getattr(user, 'permissions', None)
+    if permissions is None:
+        permissions = permissions_for_role(getattr(user, 'role', ''))
+    return permission in permissions
+
+def permission_denied(permission, message='Permission denied'):
+    """403 response for a failed check, counted in /api/metrics"""
+    metrics.incr('auth.denied')
+    metrics.incr(f'auth.denied.{permission}')
+    return jsonify({'success': False, 'message': message}), 403
+
+def require_permission(permission, message='Permission denied'):
+    """Route guard: `@require_permission('manage_all')` under @login_required"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not has_permission(current_user, permission):
+                return permission_denied(permission, message)
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+_NO_PERMISSIONS = frozenset()
+# Defaults until the app loads the DB overrides after its schema check
+_MATRIX = {role: frozenset(perms) for role, perms in DEFAULT_ROLE_PERMISSIONS.items()}
@@ -0,0 +1,175 @@
+"""
+Small thread-safe caches shared by all request threads of a worker.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache whose entries also expire after `ttl` seconds.
+    None is a valid cached value (e.g. "barcode not found"), so callers
+    test hits with `get(key, default)` and a sentinel rather than None.
+    """
+
+    def __init__(self, name, maxsize=10000, ttl=600):
+        self.name    = name
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self._data   = OrderedDict()      # key → (expires_at, value)
+        self._lock   = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        metrics.register(f'cache.{name}', self.stats)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                if entry[0] > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value, time.monotonic() + self.ttl)
+
+    def set_many(self, items):
+        """Load many (key, value) pairs at once, e.g. when warming."""
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in items:
+                self._store(key, value, expires)
+
+    def get_or_load(self, key, loader):
+        """Cached value for `key`, calling loader(key) and caching on a miss."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader(key)
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        """Drop one key, or everything when key is None."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size':          len(self._data),
+                'maxsize':       self.maxsize,
+                'ttl_s':         self.ttl,
+                'hits':          self.hits,
+                'misses':        self.misses,
+                'hit_rate':      round(self.hits / lookups, 4) if lookups else None,
+                'evictions':     self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _store(self, key, value, expires):
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+
+class ReportCache:
+    """
+    Report results and generated export files, keyed on the report name, its
+    normalised filters and the data versions of the tables it reads (see
+    database.data_versions). A write to any of those tables changes the key,
+    so stale entries are never hit and simply age out of the LRU.
+
+    Results live in memory only. Export bytes are also written to disk_dir,
+    if set, so they survive a restart and are shared between workers.
+    """
+
+    def __init__(self, name, maxsize=128, ttl=3600, disk_dir=None, disk_max_files=200):
+        self.results        = TTLCache(name, maxsize, ttl)
+        self.files          = TTLCache(f'{name}_files', max(maxsize // 8, 4), ttl)
+        self.disk_dir       = disk_dir
+        self.disk_max_files = disk_max_files
+        self.disk_hits = self.disk_misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            metrics.register(f'cache.{name}_disk', self.disk_stats)
+
+    @staticmethod
+    def key(report, filters, versions):
+        """Stable key; empty filters are dropped and values compared as text."""
+        norm = sorted((k, str(v)) for k, v in (filters or {}).items() if v not in (None, ''))
+        raw  = json.dumps([report, norm, list(versions)])
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get_or_load(self, key, loader):
+        """Cached result for `key`, calling loader() on a miss."""
+        return self.results.get_or_load(key, lambda _k: loader())
+
+    def file_or_build(self, key, builder):
+        """Cached export bytes for `key` (memory, then disk), calling builder() on a miss."""
+        data = self.files.get(key)
+        if data is not None:
+            return data
+        path = os.path.join(self.disk_dir, f'{key}.bin') if self.disk_dir else None
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.disk_hits += 1
+        else:
+            data = builder()
+            if path:
+                self.disk_misses += 1
+                tmp = f'{path}.{os.getpid()}.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+                self._prune_disk()
+        self.files.set(key, data)
+        return data
+
+    def clear(self):
+        """Drop everything, e.g. after the database file itself was replaced."""
+        self.results.invalidate()
+        self.files.invalidate()
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                try:
+                    os.remove(os.path.join(self.disk_dir, name))
+                except OSError:
+                    pass
+
+    def disk_stats(self):
+        files = os.listdir(self.disk_dir) if os.path.isdir(self.disk_dir) else []
+        return {'files': len(files), 'max_files': self.disk_max_files,
+                'hits': self.disk_hits, 'misses': self.disk_misses}
+
+    def _prune_disk(self):
+        """Keep the newest disk_max_files files."""
+        paths = [os.path.join(self.disk_dir, n) for n in os.listdir(self.disk_dir)]
+        if len(paths) <= self.disk_max_files:
+            return
+        paths.sort(key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+        for p in paths[:len(paths) - self.disk_max_files]:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
@@ -1,7 +1,15 @@
 import sqlite3
 import os
 import sys
+import time
+import random
+import queue
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
 from datetime import datetime
+from utils import iso_date
+import metrics
 
 # Ensure stdout can handle Unicode/emoji on Windows (cp1252 terminal)
 try:
@@ -18,7 +26,8 @@ if not os.path.exists(_data_dir):
     os.makedirs(_data_dir)
     print("Created 'data' directory")
 
-DATABASE = os.path.join(_BASE_DIR, 'data', 'inventory.db')
+# MIDFLOW_DATABASE lets tooling (fixtures, benchmarks) point the app at another file
+DATABASE = os.environ.get('MIDFLOW_DATABASE') or os.path.join(_BASE_DIR, 'data', 'inventory.db')
 
 def init_db():
     """Initialize the database with tables"""
@@ -727,6 +736,156 @@ def update_database_schema():
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_icl_item_code ON inventory_count_lines(item_code)')
             print("✅ Created inventory_count_lines table")
 
+        # ── exp_date_iso: sortable YYYY-MM-DD copy of the expiry date ─────────
+        for table in _ISO_DATE_SOURCES:
+            cursor.execute(f"PRAGMA table_info({table})")
+            cols = [c[1] for c in cursor.fetchall()]
+            if cols and 'exp_date_iso' not in cols:
+                try:
+                    cursor.execute(f'ALTER TABLE {table} ADD COLUMN exp_date_iso TEXT')
+                    print(f"✅ Added exp_date_iso to {table}")
+                except Exception:
+                    pass
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_st_exp_iso ON stock_transactions(exp_date_iso)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ml_exp_iso ON movement_lines(exp_date_iso)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_bd_project_exp_iso ON basic_data(project_code, exp_date_iso)')
+        filled = backfill_iso_dates(conn)
+        if filled > 0:
+            print(f"✅ Canonicalised dates on {filled} rows")
+
+        # ── basic_data.content_hash: change detection for re-imports ──────
+        cursor.execute("PRAGMA table_info(basic_data)")
+        if 'content_hash' not in [c[1] for c in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE basic_data ADD COLUMN content_hash TEXT')
+            print("✅ Added content_hash to basic_data")
+        rekeyed = backfill_row_identities(conn)
+        if rekeyed:
+            print(f"✅ Re-keyed {rekeyed} rows from the old Excel importer")
+        # Older databases re-derive project_code in a trigger whenever field_ref
+        # changes, clearing it when nothing matches. Imports resolve the code
+        # themselves and keep an existing one, so that trigger has to go.
+        cursor.execute("DROP TRIGGER IF EXISTS basic_data_project_code_update")
+
+        # ── role_permissions: per-role overrides of the built-in policy ───
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS role_permissions (
+                role       TEXT NOT NULL,
+                permission TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (role, permission)
+            )
+        ''')
+
+        # ── parcel_status: pending → received → dispatched ────────────────
+        cursor.execute("PRAGMA table_info(basic_data)")
+        if 'parcel_status' not in [c[1] for c in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE basic_data ADD COLUMN parcel_status TEXT DEFAULT 'pending'")
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_ml_parcel ON movement_lines(parcel_number)')
+            refresh_parcel_status(conn)
+            print("✅ Added parcel_status to basic_data")
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ml_parcel ON movement_lines(parcel_number)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_bd_parcel_status '
+                       'ON basic_data(parcel_status, project_code, parcel_number)')
+        # Parcel-map order, so a page is one index range walk (no sort)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_bd_parcel_order ON basic_data('
+                       "COALESCE(project_code, ''), COALESCE(packing_ref, ''), "
+                       'CAST(parcel_number AS INTEGER), parcel_number)')
+
+        # ── stock_locations (item/batch/project → parcel & pallet index) ─────
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stock_locations'")
+        if not cursor.fetchone():
+            cursor.execute('''
+                CREATE TABLE stock_locations (
+                    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                    project_code  TEXT,
+                    item_code     TEXT NOT NULL,
+                    batch_no      TEXT NOT NULL DEFAULT '',
+                    parcel_number TEXT NOT NULL,
+                    pallet_number TEXT,
+                    qty           REAL DEFAULT 0,
+                    updated_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sloc_item ON stock_locations(project_code, item_code, batch_no)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sloc_parcel ON stock_locations(parcel_number)')
+            refresh_stock_locations(conn)
+            print("✅ Created stock_locations table")
+        # Parcels dispatched before OUT confirms refreshed their locations
+        cursor.execute("DELETE FROM stock_locations WHERE parcel_number IN "
+                       "(SELECT parcel_number FROM basic_data WHERE parcel_status='dispatched')")
+
+        # ── stock_reservations: quantity held by Draft OUT lines ──────────
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stock_reservations'")
+        if not cursor.fetchone():
+            cursor.execute('''
+                CREATE TABLE stock_reservations (
+                    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                    movement_id   INTEGER NOT NULL REFERENCES movements(id) ON DELETE CASCADE,
+                    line_id       INTEGER,
+                    project_code  TEXT NOT NULL,
+                    item_code     TEXT NOT NULL,
+                    batch_no      TEXT NOT NULL DEFAULT '',
+                    exp_key       TEXT NOT NULL DEFAULT '',
+                    parcel_number TEXT,
+                    qty           REAL NOT NULL DEFAULT 0,
+                    created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sres_key '
+                           'ON stock_reservations(project_code, item_code, batch_no, exp_key)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sres_movement ON stock_reservations(movement_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sres_parcel ON stock_reservations(parcel_number)')
+            sync_reservations(conn)
+            print("✅ Created stock_reservations table")
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_st_stock_key '
+                       'ON stock_transactions(item_code, project_code, transaction_type)')
+
+        # ── idempotency_keys: stored responses of retried write requests ──
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                user_id       TEXT NOT NULL,
+                idem_key      TEXT NOT NULL,
+                method        TEXT,
+                path          TEXT,
+                fingerprint   TEXT NOT NULL,
+                status_code   INTEGER,
+                response_body BLOB,
+                content_type  TEXT,
+                created_at    REAL NOT NULL,
+                PRIMARY KEY (user_id, idem_key)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_idem_created ON idempotency_keys(created_at)')
+
+        # ── archive_periods: years moved out to data/archive (see archive.py) ──
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='archive_periods'")
+        if not cursor.fetchone():
+            cursor.execute('''
+                CREATE TABLE archive_periods (
+                    year         INTEGER PRIMARY KEY,
+                    row_counts   TEXT,
+                    opening_rows INTEGER DEFAULT 0,
+                    closed_by    INTEGER REFERENCES users(id),
+                    closed_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            print("✅ Created archive_periods table")
+
+        # ── data_versions: per-table write counters for the report cache ──
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='data_versions'")
+        if not cursor.fetchone():
+            cursor.execute('''
+                CREATE TABLE data_versions (
+                    name    TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            # A random epoch keeps versions from another database (e.g. a
+            # restored backup of a different mission) from matching
+            cursor.execute("INSERT INTO data_versions (name, version) VALUES ('_epoch', abs(random()))")
+            print("✅ Created data_versions table")
+        install_data_version_triggers(conn)
+
         conn.commit()
         print("✅ Database schema updated successfully")
 
@@ -736,12 +895,487 @@ def update_database_schema():
     finally:
         conn.close()
         
+# Where exp_date_iso comes from, per table. basic_data holds the effective
+# expiry: the date captured at reception if any, else the packing-list one.
+_ISO_DATE_SOURCES = {
+    'stock_transactions': 'exp_date',
+    'movement_lines':     'exp_date',
+    'basic_data':         'COALESCE(exp_date_received, exp_date)',
+}
+
+def _iso_map_for(conn, sql):
+    """Load {raw: iso} for the distinct raw values returned by `sql` into _iso_map."""
+    raws = [r[0] for r in conn.execute(sql).fetchall()]
+    mapped = [(raw, iso) for raw, iso in ((raw, iso_date(raw)) for raw in raws) if iso]
+    conn.execute("DELETE FROM _iso_map")
+    conn.executemany("INSERT OR REPLACE INTO _iso_map (raw, iso) VALUES (?, ?)", mapped)
+    return len(mapped)
+
+def _update_in_batches(conn, table, set_sql, where_sql, batch_size):
+    """Run an UPDATE over id ranges, committing after each batch so a large
+    backfill never holds the write lock for long. Returns rows updated."""
+    max_id = conn.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0] or 0
+    total = 0
+    for lo in range(0, max_id, batch_size):
+        with bulk_writes(conn, table):
+            cur = conn.execute(
+                f"UPDATE {table} SET {set_sql} WHERE id > ? AND id <= ? AND {where_sql}",
+                (lo, lo + batch_size))
+        total += cur.rowcount
+        conn.commit()
+    return total
+
+def backfill_iso_dates(conn, batch_size=20000):
+    """Canonicalise stored dates; returns rows updated.
+    - exp_date_iso filled where still NULL (see _ISO_DATE_SOURCES)
+    - movements.movement_date rewritten to YYYY-MM-DD where it is not already
+    Each distinct raw date is parsed once; updates run in id batches."""
+    total = 0
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _iso_map (raw TEXT PRIMARY KEY, iso TEXT)")
+    try:
+        for table, src in _ISO_DATE_SOURCES.items():
+            cols = [c[1] for c in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+            if 'exp_date_iso' not in cols:
+                continue
+            if not _iso_map_for(conn, f'''
+                    SELECT DISTINCT {src} FROM {table}
+                    WHERE exp_date_iso IS NULL AND {src} IS NOT NULL AND {src} != ''
+            '''):
+                continue
+            total += _update_in_batches(
+                conn, table,
+                f"exp_date_iso = (SELECT iso FROM _iso_map WHERE raw = {src})",
+                f"exp_date_iso IS NULL AND {src} IN (SELECT raw FROM _iso_map)",
+                batch_size)
+
+        not_iso = "movement_date NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'"
+        if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='movements'").fetchone() \
+                and _iso_map_for(conn, f"SELECT DISTINCT movement_date FROM movements WHERE {not_iso}"):
+            total += _update_in_batches(
+                conn, 'movements',
+                "movement_date = (SELECT iso FROM _iso_map WHERE raw = movement_date)",
+                f"{not_iso} AND movement_date IN (SELECT raw FROM _iso_map)",
+                batch_size)
+    finally:
+        conn.execute("DROP TABLE IF EXISTS _iso_map")
+    return total
+
+def backfill_row_identities(conn):
+    """
+    Give basic_data rows written by the old Excel importer (random
+    BD-<timestamp>-<uuid> ids) the deterministic unique_id and content_hash
+    that re-imports look rows up by (see ExcelImporter.row_identity), so
+    re-importing an old packing list updates those lines instead of adding
+    them again. A row whose identity another row already holds keeps its
+    old id. Returns the rows re-keyed. Caller commits.
+    """
+    from excel_import import ExcelImporter      # excel_import imports this module
+    cols = ExcelImporter.IMPORT_COLUMNS
+    legacy = conn.execute(
+        f"SELECT id, {', '.join(cols)} FROM basic_data WHERE unique_id GLOB 'BD-[0-9]*-*'"
+    ).fetchall()
+    if not legacy:
+        return 0
+    updates = []
+    for r in legacy:
+        row = dict(zip(cols, tuple(r)[1:]))
+        values = tuple(row[c] for c in cols)
+        updates.append((ExcelImporter.row_identity(row), ExcelImporter.content_hash(values), r[0]))
+    with bulk_writes(conn, 'basic_data'):
+        before = conn.total_changes
+        conn.executemany("UPDATE OR IGNORE basic_data SET unique_id=?, content_hash=? WHERE id=?",
+                         updates)
+        return conn.total_changes - before
+
+# Received basic_data lines grouped into one location row per
+# (project, item, batch, parcel). Used for full rebuilds and per-parcel refresh.
+_STOCK_LOCATIONS_SELECT = '''
+    SELECT project_code, item_code, COALESCE(batch_no_received, batch_no, ''),
+           parcel_number, MAX(pallet_number),
+           SUM(COALESCE(qty_received, qty_unit_tot, 0))
+    FROM basic_data
+    WHERE reception_number IS NOT NULL AND parcel_number IS NOT NULL
+      AND parcel_number != '' AND item_code IS NOT NULL
+      AND COALESCE(parcel_status, '') != 'dispatched'
+'''
+
+def refresh_stock_locations(conn, parcel_number=None):
+    """Rebuild stock_locations for one parcel, or for everything when
+    parcel_number is None. Dispatched parcels hold no stock, so run
+    refresh_parcel_status first. Caller commits."""
+    insert = ('INSERT INTO stock_locations '
+              '(project_code, item_code, batch_no, parcel_number, pallet_number, qty) ')
+    group  = " GROUP BY project_code, item_code, COALESCE(batch_no_received, batch_no, ''), parcel_number"
+    if parcel_number is None:
+        conn.execute("DELETE FROM stock_locations")
+        conn.execute(insert + _STOCK_LOCATIONS_SELECT + group)
+    else:
+        conn.execute("DELETE FROM stock_locations WHERE parcel_number=?", (parcel_number,))
+        conn.execute(insert + _STOCK_LOCATIONS_SELECT + " AND parcel_number=?" + group,
+                     (parcel_number,))
+
+def refresh_parcel_status(conn, parcel_numbers=None):
+    """Recompute basic_data.parcel_status for the given parcels (all when
+    None): 'dispatched' once a confirmed OUT line carries the parcel,
+    'received' once it has a reception number, else 'pending'. Caller commits."""
+    sql = '''
+        UPDATE basic_data SET parcel_status = CASE
+            WHEN EXISTS (SELECT 1 FROM movement_lines ml
+                         JOIN movements m ON m.id = ml.movement_id
+                         WHERE ml.parcel_number = basic_data.parcel_number
+                           AND m.movement_type = 'OUT' AND m.status = 'Confirmed')
+                THEN 'dispatched'
+            WHEN reception_number IS NOT NULL THEN 'received'
+            ELSE 'pending'
+        END
+    '''
+    if parcel_numbers is None:
+        with bulk_writes(conn, 'basic_data'):
+            conn.execute(sql + " WHERE parcel_number IS NOT NULL AND parcel_number != ''")
+    else:
+        conn.executemany(sql + " WHERE parcel_number = ?",
+                         [(p,) for p in set(parcel_numbers) if p])
+
+def sync_reservations(conn, movement_id=None):
+    """Rebuild stock_reservations from the lines of one Draft OUT movement, or
+    of every Draft OUT when movement_id is None. A movement that is no longer
+    a Draft simply loses its reservations. Caller commits."""
+    insert = '''
+        INSERT INTO stock_reservations
+            (movement_id, line_id, project_code, item_code, batch_no, exp_key, parcel_number, qty)
+        SELECT ml.movement_id, ml.id, m.source_project, ml.item_code,
+               COALESCE(ml.batch_no, ''), COALESCE(ml.exp_date_iso, ''),
+               ml.parcel_number, ml.qty
+        FROM movement_lines ml
+        JOIN movements m ON m.id = ml.movement_id
+        WHERE m.movement_type = 'OUT' AND m.status = 'Draft'
+          AND m.source_project IS NOT NULL AND ml.item_code IS NOT NULL AND ml.qty > 0
+    '''
+    if movement_id is None:
+        conn.execute("DELETE FROM stock_reservations")
+        conn.execute(insert)
+    else:
+        conn.execute("DELETE FROM stock_reservations WHERE movement_id=?", (movement_id,))
+        conn.execute(insert + " AND m.id=?", (movement_id,))
+
+def reservation_shortages(conn, movement_id):
+    """
+    Stock keys (project, item, batch, ISO expiry) that the reservations of
+    `movement_id` over-commit: on hand (receptions and opening balances +
+    confirmed IN - confirmed OUT) minus what other Drafts reserve is less than requested. Only the
+    movement's own keys are looked up, each through the item_code indexes,
+    so the cost follows the number of lines rather than the project's stock.
+    Returns rows of item_code, batch_no, exp_key, requested, on_hand,
+    reserved_other, available; empty when everything fits.
+    """
+    return conn.execute('''
+        WITH req AS (
+            SELECT project_code, item_code, batch_no, exp_key, SUM(qty) AS requested
+            FROM stock_reservations
+            WHERE movement_id = ?
+            GROUP BY project_code, item_code, batch_no, exp_key
+        ),
+        pos AS (
+            SELECT r.*,
+                   (SELECT COALESCE(SUM(st.qty_received), 0) FROM stock_transactions st
+                    WHERE st.item_code = r.item_code AND st.project_code = r.project_code
+                      AND st.transaction_type IN ('RECEPTION', 'OPENING')
+                      AND COALESCE(st.batch_no, '') = r.batch_no
+                      AND COALESCE(st.exp_date_iso, '') = r.exp_key)
+                 + (SELECT COALESCE(SUM(ml.qty), 0) FROM movement_lines ml
+                    JOIN movements m ON m.id = ml.movement_id
+                    WHERE ml.item_code = r.item_code AND m.dest_project = r.project_code
+                      AND m.movement_type = 'IN' AND m.status = 'Confirmed'
+                      AND COALESCE(ml.batch_no, '') = r.batch_no
+                      AND COALESCE(ml.exp_date_iso, '') = r.exp_key)
+                 - (SELECT COALESCE(SUM(ml.qty), 0) FROM movement_lines ml
+                    JOIN movements m ON m.id = ml.movement_id
+                    WHERE ml.item_code = r.item_code AND m.source_project = r.project_code
+                      AND m.movement_type = 'OUT' AND m.status = 'Confirmed'
+                      AND COALESCE(ml.batch_no, '') = r.batch_no
+                      AND COALESCE(ml.exp_date_iso, '') = r.exp_key) AS on_hand,
+                   (SELECT COALESCE(SUM(o.qty), 0) FROM stock_reservations o
+                    WHERE o.project_code = r.project_code AND o.item_code = r.item_code
+                      AND o.batch_no = r.batch_no AND o.exp_key = r.exp_key
+                      AND o.movement_id != ?) AS reserved_other
+            FROM req r
+        )
+        SELECT item_code, batch_no, exp_key, requested, on_hand, reserved_other,
+               on_hand - reserved_other AS available
+        FROM pos
+        WHERE requested > on_hand - reserved_other + 1e-9
+        ORDER BY item_code, batch_no, exp_key
+    ''', (movement_id, movement_id)).fetchall()
+
+def reserved_quantities(conn, project_code, exclude_movement=None):
+    """{(item_code, batch_no, exp_key): qty} held by Draft OUT movements of
+    a project, leaving out exclude_movement (the Draft being edited)."""
+    return {(r[0], r[1], r[2]): r[3] for r in conn.execute('''
+        SELECT item_code, batch_no, exp_key, SUM(qty)
+        FROM stock_reservations
+        WHERE project_code = ? AND movement_id != ?
+        GROUP BY item_code, batch_no, exp_key
+    ''', (project_code, exclude_movement or 0)).fetchall()}
+
+def active_project_codes(conn):
+    """Active project codes in the order they are matched against field_ref."""
+    return [r[0] for r in conn.execute(
+        "SELECT project_code FROM projects WHERE is_active=1 "
+        "AND project_code IS NOT NULL AND project_code != '' ORDER BY id"
+    ).fetchall()]
+
+def match_project_code(codes, field_ref):
+    """First code from `codes` that appears inside field_ref.
+    Example: field_ref='25/CH/CD502/PO06146' and codes=['CD502'] → 'CD502'."""
+    if not field_ref:
+        return None
+    field_str = str(field_ref)
+    for code in codes:
+        if code and code in field_str:
+            return code
+    return None
+
+def assign_project_code(conn, project_code):
+    """Give `project_code` to unassigned basic_data rows whose field_ref
+    contains it, and carry it through to their stock_transactions and
+    stock_locations rows. Only touches rows with no project yet, so it is
+    cheap to run whenever a project is created or its code changes.
+    Returns the number of parcels updated. Caller commits."""
+    if not project_code:
+        return 0
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _assign_parcels (parcel_number TEXT PRIMARY KEY)")
+    try:
+        conn.execute("DELETE FROM _assign_parcels")
+        conn.execute('''
+            INSERT OR IGNORE INTO _assign_parcels
+            SELECT parcel_number FROM basic_data
+            WHERE (project_code IS NULL OR project_code = '')
+              AND parcel_number IS NOT NULL AND instr(field_ref, ?) > 0
+        ''', (project_code,))
+        conn.execute('''
+            UPDATE basic_data SET project_code=?
+            WHERE (project_code IS NULL OR project_code = '')
+              AND instr(field_ref, ?) > 0
+        ''', (project_code, project_code))
+        for table in ('stock_transactions', 'stock_locations'):
+            conn.execute(f'''
+                UPDATE {table} SET project_code=?
+                WHERE (project_code IS NULL OR project_code = '')
+                  AND parcel_number IN (SELECT parcel_number FROM _assign_parcels)
+            ''', (project_code,))
+        return conn.execute("SELECT COUNT(*) FROM _assign_parcels").fetchone()[0]
+    finally:
+        conn.execute("DROP TABLE IF EXISTS _assign_parcels")
+
+# Tables whose writes bump data_versions (the sources of the cached reports).
+# For lookup tables only the columns reports show count as a change, so a
+# login (users.last_login) does not invalidate every report.
+DATA_VERSION_TABLES = {
+    'basic_data':         None,
+    'stock_transactions': None,
+    'movements':          None,
+    'movement_lines':     None,
+    'mission_details':    None,
+    'users':              'username',
+    'end_users':          'name',
+    'third_parties':      'name',
+}
+
+def install_data_version_triggers(conn):
+    """Create the INSERT/UPDATE/DELETE triggers that bump data_versions.
+    They fire per row; bulk rewrites go through bulk_writes instead."""
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    for table, columns in DATA_VERSION_TABLES.items():
+        if table not in existing:
+            continue
+        conn.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)", (table,))
+        for op in ('INSERT', 'UPDATE', 'DELETE'):
+            event = f'UPDATE OF {columns}' if op == 'UPDATE' and columns else op
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_dv_{table}_{op.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+                END
+            """)
+
+@contextmanager
+def bulk_writes(conn, *tables):
+    """
+    Bulk rewrites of `tables` without the per-row data_versions triggers:
+    their triggers are dropped for the duration of the block and each
+    table's version is bumped once at the end. Everything happens inside
+    one write transaction (begun here when none is open), so other
+    connections never see the tables without triggers and a rollback puts
+    them back. The caller commits.
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' "
+                        "AND name='data_versions'").fetchone():
+        yield conn          # schema upgrade before the counters exist
+        return
+    if not conn.in_transaction:
+        begin_immediate(conn, 'bulk')
+    tables = [t for t in tables if t in DATA_VERSION_TABLES]
+    for table in tables:
+        for op in ('insert', 'update', 'delete'):
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_dv_{table}_{op}")
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.executemany("UPDATE data_versions SET version = version + 1 WHERE name = ?",
+                             [(t,) for t in tables])
+            install_data_version_triggers(conn)
+
+def data_versions(conn, tables):
+    """(epoch, version, ...) for `tables` — changes whenever any of them is written."""
+    marks = ','.join('?' * (len(tables) + 1))
+    rows = dict(conn.execute(
+        f"SELECT name, version FROM data_versions WHERE name IN ({marks})",
+        ('_epoch', *tables)).fetchall())
+    return (rows.get('_epoch'),) + tuple(rows.get(t) for t in tables)
+
+def is_busy_error(exc):
+    """True for SQLITE_BUSY / SQLITE_LOCKED surfaced as OperationalError."""
+    msg = str(exc).lower()
+    return isinstance(exc, sqlite3.OperationalError) and ('locked' in msg or 'busy' in msg)
+
+def begin_immediate(conn, name='db', attempts=5, busy_timeout_ms=2000, backoff_s=0.05):
+    """
+    Start a write transaction with BEGIN IMMEDIATE, so the write lock is taken
+    up front rather than upgraded mid-transaction (where SQLite cannot wait and
+    fails with "database is locked"). Each attempt waits up to busy_timeout_ms
+    inside SQLite; SQLITE_BUSY is then retried with jittered exponential
+    backoff, at most `attempts` times. Records <name>.lock_wait_ms timings and
+    <name>.busy_retries / <name>.lock_timeouts counters. Returns the wait in ms;
+    re-raises the OperationalError when the lock could not be had.
+    """
+    conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+    start = time.perf_counter()
+    for attempt in range(1, attempts + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e):
+                raise
+            if attempt == attempts:
+                metrics.incr(f'{name}.lock_timeouts')
+                raise
+            metrics.incr(f'{name}.busy_retries')
+            time.sleep(random.uniform(0, backoff_s * 2 ** attempt))
+    waited_ms = (time.perf_counter() - start) * 1000
+    metrics.observe(f'{name}.lock_wait_ms', waited_ms)
+    return waited_ms
+
+def rename_project_code(conn, old_code, new_code):
+    """Move the rows filed under `old_code` (basic_data, stock_transactions,
+    stock_locations) to `new_code` when a project's code is changed.
+    Returns the number of basic_data rows moved. Caller commits."""
+    if not old_code or not new_code or old_code == new_code:
+        return 0
+    moved = conn.execute("UPDATE basic_data SET project_code=? WHERE project_code=?",
+                         (new_code, old_code)).rowcount
+    for table in ('stock_transactions', 'stock_locations'):
+        conn.execute(f"UPDATE {table} SET project_code=? WHERE project_code=?",
+                     (new_code, old_code))
+    return moved
+
 def get_db_connection():
     """Get a database connection"""
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     return conn
 
+class ReadOnlyConnection(sqlite3.Connection):
+    """Connection handed out by ReadOnlyPool; close() gives it back to the pool."""
+    pool       = None
+    generation = 0
+
+    def close(self):
+        pool = self.pool
+        if pool is None or not pool._release(self):
+            super().close()
+
+class ReadOnlyPool:
+    """
+    Read-only connections for reports and exports, kept apart from the
+    read/write connections the scanners use. Each is opened with a mode=ro
+    URI and PRAGMA query_only, so it can never take the write lock, and with
+    a larger page cache for the big aggregations. acquire() starts a read
+    transaction, so every query of one request sees the same snapshot;
+    close() ends it and returns the connection to the pool (up to `size`
+    idle ones are kept, extra ones are really closed).
+    """
+
+    def __init__(self, path=None, size=4, cache_kib=65536, busy_timeout_ms=5000):
+        self.path            = path or DATABASE
+        self.size            = size
+        self.cache_kib       = cache_kib
+        self.busy_timeout_ms = busy_timeout_ms
+        self._idle           = queue.LifoQueue(maxsize=size)
+        self._lock           = threading.Lock()
+        self._generation     = 0
+        self.opened = self.reused = self.in_use = 0
+        metrics.register('db.read_pool', self.stats)
+
+    def _open(self):
+        uri  = 'file:' + quote(os.path.abspath(self.path)) + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, factory=ReadOnlyConnection,
+                               check_same_thread=False)
+        conn.execute("PRAGMA query_only=1")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_kib)}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.pool       = self
+        conn.generation = self._generation
+        with self._lock:
+            self.opened += 1
+        return conn
+
+    def acquire(self):
+        """A read-only connection inside a fresh read transaction."""
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self.reused += 1
+        except queue.Empty:
+            conn = self._open()
+        conn.row_factory = sqlite3.Row
+        conn.execute("BEGIN")
+        with self._lock:
+            self.in_use += 1
+        return conn
+
+    def _release(self, conn):
+        """Called by conn.close(); False means: really close it."""
+        with self._lock:
+            self.in_use -= 1
+        if conn.generation != self._generation:
+            return False
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+            return True
+        except (sqlite3.Error, queue.Full):
+            return False
+
+    def clear(self):
+        """Close the idle connections, and the busy ones as they come back,
+        e.g. after the database file was replaced by a restore."""
+        self._generation += 1
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.pool = None
+            conn.close()
+
+    def stats(self):
+        return {'size': self.size, 'idle': self._idle.qsize(), 'in_use': self.in_use,
+                'opened': self.opened, 'reused': self.reused}
+
 def backup_database(backup_path=None):
     """Create a backup of the database"""
     if backup_path is None:
@@ -1,8 +1,45 @@
 import openpyxl
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import multiprocessing
+import os
 import uuid
-from database import get_db_connection
-from utils import normalize_number, normalize_date
+from database import get_db_connection, active_project_codes, match_project_code, bulk_writes
+from utils import iso_date
+from normalizers import normalize_column, COLUMN_KINDS
+from cache import TTLCache
+from itertools import islice
+
+# Header row and column map per uploaded file, so execute_import reuses what
+# preview_import detected. Keyed by path + mtime + size, so a re-upload under
+# the same name is detected afresh.
+_LAYOUT_CACHE = TTLCache('import_layouts', maxsize=64, ttl=3600)
+
+# Process pool for parsing large imports, created by start_parse_pool()
+_PARSE_POOL = None
+
+
+def start_parse_pool(workers):
+    """
+    Create the import parse pool once, at startup, before the server starts
+    any thread. Where fork is available every worker is forked right here,
+    while the process is still single-threaded, and never later from a
+    request thread (a fork there could copy a lock another thread holds).
+    Elsewhere the pool uses spawn. Does nothing for workers <= 1 or inside
+    a pool worker. Returns the pool or None.
+    """
+    global _PARSE_POOL
+    if workers <= 1 or _PARSE_POOL is not None or multiprocessing.parent_process() is not None:
+        return _PARSE_POOL
+    fork = 'fork' in multiprocessing.get_all_start_methods()
+    pool = ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context('fork' if fork else 'spawn'))
+    if fork:
+        pool.submit(os.getpid).result()     # a fork pool starts all its workers on first use
+    _PARSE_POOL = pool
+    return pool
 
 class ExcelImporter:
     """
@@ -84,9 +121,56 @@ class ExcelImporter:
         """
         Read Excel file and return data with flexible column mapping
         """
-        wb = openpyxl.load_workbook(file_path, data_only=True)
-        ws = wb.active
-        
+        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            header_row_idx, column_indices = ExcelImporter._cached_layout(
+                ws, file_path, file_type, custom_mapping)
+            data_rows = ExcelImporter._parse_rows(
+                ws.iter_rows(min_row=header_row_idx + 1, values_only=True), column_indices)
+        finally:
+            wb.close()
+        return data_rows, list(column_indices.keys())
+
+    @staticmethod
+    def preview_excel_file(file_path, file_type='file1', rows=10):
+        """
+        Header plus the first `rows` data rows, without parsing the rest.
+        Returns (preview_rows, columns, total_rows); total_rows comes from
+        the sheet's dimension metadata (it may include trailing blank rows).
+        """
+        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            header_row_idx, column_indices = ExcelImporter._cached_layout(ws, file_path, file_type)
+            raw = ws.iter_rows(min_row=header_row_idx + 1, values_only=True)
+            preview = ExcelImporter._parse_rows(islice((r for r in raw if any(r)), rows),
+                                                column_indices)
+            max_row = ws.max_row
+            if max_row is None:     # no dimension recorded — count without parsing
+                ws.reset_dimensions()
+                max_row = header_row_idx + sum(
+                    1 for r in ws.iter_rows(min_row=header_row_idx + 1, values_only=True) if any(r))
+        finally:
+            wb.close()
+        return preview, list(column_indices.keys()), max(max_row - header_row_idx, 0)
+
+    @staticmethod
+    def _cached_layout(ws, file_path, file_type, custom_mapping=None):
+        """_sheet_layout, memoised per uploaded file (not for custom mappings)"""
+        if custom_mapping:
+            return ExcelImporter._sheet_layout(ws, file_type, custom_mapping)
+        st = os.stat(file_path)
+        key = (os.path.abspath(file_path), st.st_mtime_ns, st.st_size, file_type)
+        layout = _LAYOUT_CACHE.get(key)
+        if layout is None:
+            layout = ExcelImporter._sheet_layout(ws, file_type)
+            _LAYOUT_CACHE.set(key, layout)
+        return layout
+
+    @staticmethod
+    def _sheet_layout(ws, file_type, custom_mapping=None):
+        """Header row index and {target column: index} for a worksheet"""
         # Detect header row
         header_row_idx, headers = ExcelImporter.detect_header_row(ws)
         
@@ -99,38 +183,88 @@ class ExcelImporter:
             idx = ExcelImporter.find_column_index(headers, [source_col])
             if idx is not None:
                 column_indices[target_col] = idx
+        return header_row_idx, column_indices
+
+    @staticmethod
+    def _parse_rows(rows, column_indices):
+        """Normalise raw worksheet rows into import dicts, one column at a time"""
+        if not column_indices:
+            return []
+        rows = [row for row in rows if any(row)]  # Skip empty rows
         
-        # Read data rows
-        data_rows = []
-        for row in ws.iter_rows(min_row=header_row_idx + 1, values_only=True):
-            if not any(row):  # Skip empty rows
-                continue
-            
-            row_data = {}
-            for target_col, col_idx in column_indices.items():
-                value = row[col_idx] if col_idx < len(row) else None
-                
-                # Normalize data types
-                if value is not None:
-                    if target_col in ['qty_unit_tot', 'kg_total', 'dm3_total', 'weight_kg', 'volume_m3', 'estim_value_eu']:
-                        value = normalize_number(value)
-                    elif target_col in ['exp_date']:
-                        value = normalize_date(value)
-                    elif target_col in ['nb_parcels']:
-                        try:
-                            value = int(normalize_number(value) or 0)
-                        except:
-                            value = 0
-                    else:
-                        value = str(value).strip() if value else None
-                
-                row_data[target_col] = value
-            
-            if row_data:  # Only add if we got some data
-                data_rows.append(row_data)
+        columns = {}
+        exp_raw = None
+        for target_col, col_idx in column_indices.items():
+            raw = [row[col_idx] if col_idx < len(row) else None for row in rows]
+            columns[target_col] = normalize_column(raw, COLUMN_KINDS.get(target_col, 'text'))
+            if target_col == 'exp_date':
+                # Keep the sortable form too, parsed from the raw cell
+                exp_raw = raw
+                exp_iso = normalize_column(raw, 'iso_date')
         
-        wb.close()
-        return data_rows, list(column_indices.keys())
+        names = list(columns)
+        data_rows = [dict(zip(names, values)) for values in zip(*columns.values())]
+        if exp_raw is not None:
+            for row_data, raw, iso in zip(data_rows, exp_raw, exp_iso):
+                if raw is not None:
+                    row_data['exp_date_iso'] = iso
+        return data_rows
+
+    @staticmethod
+    def _read_chunk(file_path, column_indices, min_row, max_row):
+        """Parse rows min_row..max_row of the active sheet (process-pool task)"""
+        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(min_row=min_row, max_row=max_row, values_only=True)
+            return ExcelImporter._parse_rows(rows, column_indices)
+        finally:
+            wb.close()
+
+    @staticmethod
+    def read_excel_files(jobs, workers=1, chunk_rows=50000, min_parallel_bytes=1024 * 1024):
+        """
+        Read several (file_path, file_type) jobs, returning one row list per job.
+
+        With workers > 1 and enough data, each workbook is split into row
+        ranges of `chunk_rows` and parsed in the pool from start_parse_pool
+        (serially when there is none), so two files (and the chunks of one
+        large file) are read concurrently. A read-only
+        sheet streams from its first row, so chunks of one file mostly
+        parallelise normalisation; the big win is the two files side by side.
+        Small imports, or any pool failure, use the serial reader.
+        """
+        global _PARSE_POOL
+        pool = _PARSE_POOL
+        total_bytes = sum(os.path.getsize(path) for path, _ in jobs)
+        if pool is None or workers <= 1 or total_bytes < min_parallel_bytes:
+            return [ExcelImporter.read_excel_file(path, ftype)[0] for path, ftype in jobs]
+
+        # Plan chunks from the header and the sheet's recorded dimension
+        plans = []
+        for path, ftype in jobs:
+            wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+            try:
+                ws = wb.active
+                header_row_idx, column_indices = ExcelImporter._cached_layout(ws, path, ftype)
+                max_row = ws.max_row
+            finally:
+                wb.close()
+            if not max_row:     # no dimension metadata — cannot split safely
+                return [ExcelImporter.read_excel_file(p, t)[0] for p, t in jobs]
+            plans.append([(path, column_indices, lo, min(lo + chunk_rows - 1, max_row))
+                          for lo in range(header_row_idx + 1, max_row + 1, chunk_rows)])
+
+        try:
+            futures = [[pool.submit(ExcelImporter._read_chunk, *task) for task in plan]
+                       for plan in plans]
+            return [[row for f in plan for row in f.result()] for plan in futures]
+        except BrokenProcessPool as e:
+            # A fork pool is never rebuilt from a request thread
+            _PARSE_POOL = None
+            print(f"[import] parse pool broken ({e}); reading serially from now on")
+        except Exception as e:
+            print(f"[import] parallel parse failed ({e}); reading serially")
+        return [ExcelImporter.read_excel_file(path, ftype)[0] for path, ftype in jobs]
     
     @staticmethod
     def merge_data(file1_data, file2_data, match_column='packing_ref'):
@@ -162,63 +296,132 @@ class ExcelImporter:
         
         return merged_data
     
+    # basic_data columns written by an import, in INSERT order. The content
+    # hash covers all of them, so any change in the source row is detected.
+    IMPORT_COLUMNS = (
+        'packing_ref', 'line_no', 'item_code', 'item_description',
+        'qty_unit_tot', 'packaging', 'parcel_no', 'nb_parcels', 'batch_no',
+        'exp_date', 'kg_total', 'dm3_total', 'transport_reception', 'sub_folder',
+        'field_ref', 'ref_op_msfl', 'parcel_nb', 'weight_kg', 'volume_m3',
+        'invoice_credit_note_ref', 'estim_value_eu', 'exp_date_iso', 'project_code',
+    )
+
     @staticmethod
-    def import_to_database(data_rows, source_file, user_id):
+    def row_identity(row):
+        """Deterministic unique_id for a source row: same packing ref, line,
+        parcel and batch → same id, so re-imports update instead of duplicating"""
+        parcel = row.get('parcel_nb') or row.get('parcel_no')
+        key = '|'.join('' if v is None else str(v).strip() for v in
+                       (row.get('packing_ref'), row.get('line_no'), parcel, row.get('batch_no')))
+        return 'BD-' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:24]
+
+    @staticmethod
+    def content_hash(values):
+        """Hash of the imported column values, used to skip unchanged rows"""
+        return hashlib.sha1(repr(tuple(values)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def import_to_database(data_rows, source_file, user_id, batch_size=5000):
         """
-        Import merged data into database
+        Upsert merged data into basic_data.
+        Returns ({'inserted', 'updated', 'unchanged', 'duplicates',
+        'skipped_received'}, errors).
+
+        - a file repeating the same identity keeps its last occurrence; the
+          earlier ones are counted as duplicates and listed in errors
+        - rows of parcels already received are never updated (their stock
+          is in stock_transactions); changed ones are counted and listed
+        - an update never clears a project_code the row already has
         """
         conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        imported_count = 0
+        project_codes = active_project_codes(conn)
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0,
+                  'duplicates': 0, 'skipped_received': 0}
         errors = []
-        
+
+        prepared = {}
         for row in data_rows:
+            row = dict(row)
+            row['exp_date_iso'] = row.get('exp_date_iso') or iso_date(row.get('exp_date'))
+            row['project_code'] = match_project_code(project_codes, row.get('field_ref'))
+            values = tuple(row.get(c) for c in ExcelImporter.IMPORT_COLUMNS)
+            uid = ExcelImporter.row_identity(row)
+            if uid in prepared:
+                counts['duplicates'] += 1
+                errors.append(f"Duplicate row: {ExcelImporter._describe(row)} "
+                              f"appears more than once, the last occurrence was kept")
+            prepared[uid] = (values, ExcelImporter.content_hash(values), row)
+
+        cols = ', '.join(ExcelImporter.IMPORT_COLUMNS)
+        insert_sql = (f"INSERT INTO basic_data (unique_id, {cols}, content_hash, source_file, imported_by) "
+                      f"VALUES ({', '.join('?' * (len(ExcelImporter.IMPORT_COLUMNS) + 4))})")
+        assignments = ', '.join('project_code = COALESCE(?, project_code)' if c == 'project_code'
+                                else c + ' = ?' for c in ExcelImporter.IMPORT_COLUMNS)
+        update_sql = (f"UPDATE basic_data SET {assignments}, "
+                      f"content_hash = ?, source_file = ?, imported_by = ? "
+                      f"WHERE unique_id = ? AND COALESCE(reception_status, '') != 'Received'")
+
+        ids = list(prepared)
+        try:
+            for lo in range(0, len(ids), batch_size):
+                chunk = ids[lo:lo + batch_size]
+                existing = {}
+                for sub in range(0, len(chunk), 500):
+                    part = chunk[sub:sub + 500]
+                    existing.update((r[0], (r[1], r[2])) for r in conn.execute(
+                        f"SELECT unique_id, content_hash, reception_status = 'Received' FROM basic_data "
+                        f"WHERE unique_id IN ({', '.join('?' * len(part))})", part))
+                inserts, updates = [], []
+                for uid in chunk:
+                    values, digest, row = prepared[uid]
+                    if uid not in existing:
+                        inserts.append((uid, *values, digest, source_file, user_id))
+                    elif existing[uid][0] == digest:
+                        counts['unchanged'] += 1
+                    elif existing[uid][1]:
+                        counts['skipped_received'] += 1
+                        errors.append(f"Not updated: {ExcelImporter._describe(row)} "
+                                      f"is already received")
+                    else:
+                        updates.append((*values, digest, source_file, user_id, uid))
+                with bulk_writes(conn, 'basic_data'):
+                    counts['inserted'] += ExcelImporter._write_rows(conn, insert_sql, inserts, errors)
+                    counts['updated']  += ExcelImporter._write_rows(conn, update_sql, updates, errors)
+                conn.commit()
+        finally:
+            conn.close()
+
+        return counts, errors
+
+    @staticmethod
+    def _describe(row):
+        """Short human reference to a source row for import messages"""
+        parcel = row.get('parcel_nb') or row.get('parcel_no')
+        return (f"packing ref {row.get('packing_ref')}, line {row.get('line_no')}, "
+                f"parcel {parcel}, batch {row.get('batch_no')}")
+
+    @staticmethod
+    def _write_rows(conn, sql, rows, errors):
+        """executemany, falling back to row by row to report the failing rows.
+        The batch runs under a savepoint, so the rows it applied before a
+        failure are undone before the fallback writes them again."""
+        if not rows:
+            return 0
+        conn.execute("SAVEPOINT import_rows")
+        try:
+            written = conn.executemany(sql, rows).rowcount
+            conn.execute("RELEASE import_rows")
+            return written
+        except Exception:
+            conn.execute("ROLLBACK TO import_rows")
+            conn.execute("RELEASE import_rows")
+        written = 0
+        for params in rows:
             try:
-                unique_id = ExcelImporter.generate_unique_id()
-                
-                cursor.execute('''
-                    INSERT INTO basic_data (
-                        unique_id, packing_ref, line_no, item_code, item_description,
-                        qty_unit_tot, packaging, parcel_no, nb_parcels, batch_no,
-                        exp_date, kg_total, dm3_total, transport_reception, sub_folder,
-                        field_ref, ref_op_msfl, parcel_nb, weight_kg, volume_m3,
-                        invoice_credit_note_ref, estim_value_eu, source_file, imported_by
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    unique_id,
-                    row.get('packing_ref'),
-                    row.get('line_no'),
-                    row.get('item_code'),
-                    row.get('item_description'),
-                    row.get('qty_unit_tot'),
-                    row.get('packaging'),
-                    row.get('parcel_no'),
-                    row.get('nb_parcels'),
-                    row.get('batch_no'),
-                    row.get('exp_date'),
-                    row.get('kg_total'),
-                    row.get('dm3_total'),
-                    row.get('transport_reception'),
-                    row.get('sub_folder'),
-                    row.get('field_ref'),
-                    row.get('ref_op_msfl'),
-                    row.get('parcel_nb'),
-                    row.get('weight_kg'),
-                    row.get('volume_m3'),
-                    row.get('invoice_credit_note_ref'),
-                    row.get('estim_value_eu'),
-                    source_file,
-                    user_id
-                ))
-                imported_count += 1
+                written += conn.execute(sql, params).rowcount
             except Exception as e:
                 errors.append(f"Row error: {str(e)}")
-        
-        conn.commit()
-        conn.close()
-        
-        return imported_count, errors
+        return written
 
 # Example usage
 if __name__ == '__main__':
@@ -0,0 +1,99 @@
+"""
+Named-style templates for the generated Excel documents (packing lists,
+certificates, count sheets).
+
+The style objects are built once per process. WorkbookStyles registers them
+as named styles on first use in a workbook and resolves each to the
+workbook's style array, so writing a cell only copies that array instead of
+building Font/Fill/Alignment objects for it.
+"""
+from copy import copy
+
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.styles.borders import DEFAULT_BORDER
+
+TITLE_BLUE = '1F3A8A'
+
+_BOLD        = Font(bold=True)
+_HEADER_FONT = Font(bold=True, color='FFFFFF', size=10)
+_HEADER_FILL = PatternFill(start_color=TITLE_BLUE, end_color=TITLE_BLUE, fill_type='solid')
+_ALT_FILL    = PatternFill(start_color='EEF2FF', end_color='EEF2FF', fill_type='solid')
+_TOTAL_FILL  = PatternFill(start_color='D0D8F0', end_color='D0D8F0', fill_type='solid')
+_TOP         = Alignment(vertical='top')
+_TOP_WRAP    = Alignment(vertical='top', wrap_text=True)
+_CENTER      = Alignment(horizontal='center', vertical='center', wrap_text=True)
+_THIN        = Side(style='thin')
+_BOX         = Border(left=_THIN, right=_THIN, top=_THIN, bottom=_THIN)
+
+# name → NamedStyle attributes (font and border default to the workbook's)
+STYLE_TEMPLATES = {
+    'mf_title':         {'font': Font(bold=True, size=16, color=TITLE_BLUE)},
+    'mf_header':        {'font': _HEADER_FONT, 'fill': _HEADER_FILL, 'alignment': _CENTER},
+    'mf_cell':          {'alignment': _TOP},
+    'mf_cell_wrap':     {'alignment': _TOP_WRAP},
+    'mf_cell_alt':      {'alignment': _TOP, 'fill': _ALT_FILL},
+    'mf_cell_wrap_alt': {'alignment': _TOP_WRAP, 'fill': _ALT_FILL},
+    'mf_total':         {'fill': _TOTAL_FILL},
+    'mf_total_bold':    {'fill': _TOTAL_FILL, 'font': _BOLD},
+}
+# Bordered variants for the certificate table
+STYLE_TEMPLATES.update({f'{name}_boxed': dict(attrs, border=_BOX)
+                        for name, attrs in list(STYLE_TEMPLATES.items())
+                        if name != 'mf_title'})
+
+
+def row_styles(n_cols, wrap_cols=(), boxed=False):
+    """(plain, alternate) per-column style names for a striped data table"""
+    suffix = '_boxed' if boxed else ''
+    base = ['mf_cell_wrap' if c in wrap_cols else 'mf_cell' for c in range(1, n_cols + 1)]
+    return [b + suffix for b in base], [b + '_alt' + suffix for b in base]
+
+
+class WorkbookStyles:
+    """The STYLE_TEMPLATES of one workbook, registered lazily."""
+
+    def __init__(self, wb):
+        self.wb      = wb
+        self._arrays = {}
+
+    def __getitem__(self, name):
+        """Style array for `name`, registering the named style on first use."""
+        arr = self._arrays.get(name)
+        if arr is None:
+            if name in self.wb.named_styles:
+                style = self.wb._named_styles[name]
+            else:
+                attrs = {'font': DEFAULT_FONT, 'border': DEFAULT_BORDER, **STYLE_TEMPLATES[name]}
+                style = NamedStyle(name=name, **attrs)
+                self.wb.add_named_style(style)
+            arr = self._arrays[name] = style.as_tuple()
+        return arr
+
+    def apply(self, cell, name):
+        cell._style = copy(self[name])
+        return cell
+
+    def cell(self, ws, row, column, value=None, style=None):
+        cell = ws.cell(row=row, column=column, value=value)
+        if style:
+            cell._style = copy(self[style])
+        return cell
+
+    def write_rows(self, ws, first_row, rows, styles=None, alt_styles=None):
+        """
+        Write `rows` (sequences of values) from `first_row` down, column A on.
+        styles / alt_styles are per-column style names (None = unstyled);
+        alt_styles is used on every second row. Returns the next free row.
+        """
+        plain = [self[s] if s else None for s in styles] if styles else []
+        alt   = [self[s] if s else None for s in alt_styles] if alt_styles else plain
+        r = first_row
+        for i, values in enumerate(rows, 1):
+            arrays = alt if i % 2 == 0 else plain
+            for c, v in enumerate(values, 1):
+                cell = ws.cell(row=r, column=c, value=v)
+                if c <= len(arrays) and arrays[c - 1] is not None:
+                    cell._style = copy(arrays[c - 1])
+            r += 1
+        return r
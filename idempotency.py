@@ -0,0 +1,190 @@
+"""
+Idempotency-Key support for the write endpoints scanners and forms retry.
+
+A client sends the same `Idempotency-Key` header on every attempt of one
+logical request. The first attempt runs the view and its response is stored
+in the idempotency_keys table; a retry with the same key gets that stored
+response back (with `Idempotent-Replayed: true`) without running the view
+again. Keys are scoped to the user, expire after IDEMPOTENCY_TTL_S, and
+server errors (5xx) are not stored so those can simply be retried. A key
+whose response was never stored (the process died, or storing it failed)
+is never run again: the write may have happened, so its retries get a 409
+until the key expires.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import request, jsonify, make_response
+from flask_login import current_user
+
+from database import get_db_connection, is_busy_error
+from writer import run_in_transaction
+import metrics
+
+IDEMPOTENCY_TTL_S = 24 * 3600
+PENDING_STALE_S   = 120          # an attempt still "running" after this is assumed dead
+PURGE_EVERY_S     = 600
+MAX_KEY_LENGTH    = 255
+
+_purge_lock = threading.Lock()
+_last_purge = 0.0
+
+
+def _fingerprint():
+    """Hash of what makes two attempts the same request."""
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.full_path.encode())
+    # parse_form_data keeps request.form readable for the view afterwards
+    digest.update(request.get_data(cache=True, parse_form_data=True))
+    for name, value in sorted(request.form.items(multi=True)):
+        digest.update(f'{name}={value}'.encode())
+    return digest.hexdigest()
+
+
+def purge_expired(conn, ttl=IDEMPOTENCY_TTL_S):
+    """Drop stored responses older than `ttl` seconds. Caller commits."""
+    return conn.execute("DELETE FROM idempotency_keys WHERE created_at < ?",
+                        (time.time() - ttl,)).rowcount
+
+
+def _maybe_purge(conn):
+    global _last_purge
+    now = time.time()
+    with _purge_lock:
+        if now - _last_purge < PURGE_EVERY_S:
+            return
+        _last_purge = now
+    purge_expired(conn)
+
+
+def _claim_unit(conn, user_id, key, fingerprint, method, path):
+    """
+    Unit of work for _claim, run in its own write transaction. Returns
+    ('run', None) when this attempt should run the view, else (outcome, row)
+    with outcome one of 'mismatch', 'replay', 'in_progress', 'unfinished'.
+    """
+    _maybe_purge(conn)
+    row = conn.execute(
+        "SELECT * FROM idempotency_keys WHERE user_id=? AND idem_key=?",
+        (user_id, key)).fetchone()
+    now = time.time()
+    if row is not None:
+        if row['fingerprint'] != fingerprint:
+            return 'mismatch', row
+        if row['status_code'] is not None and row['created_at'] >= now - IDEMPOTENCY_TTL_S:
+            return 'replay', row
+        if row['status_code'] is None and row['created_at'] >= now - PENDING_STALE_S:
+            return 'in_progress', row
+        if row['status_code'] is None and row['created_at'] >= now - IDEMPOTENCY_TTL_S:
+            return 'unfinished', row
+        conn.execute("DELETE FROM idempotency_keys WHERE user_id=? AND idem_key=?",
+                     (user_id, key))
+    cur = conn.execute('''
+        INSERT OR IGNORE INTO idempotency_keys
+            (user_id, idem_key, method, path, fingerprint, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, key, method, path, fingerprint, now))
+    if not cur.rowcount:            # a concurrent attempt claimed it first
+        return 'in_progress', None
+    return 'run', None
+
+
+def _claim(user_id, key, fingerprint):
+    """
+    Record that `key` is being executed. Returns None when this attempt
+    should run the view, else the response to answer with (a replay, a
+    conflict while the first attempt is still running, or 503 busy).
+    """
+    conn = get_db_connection()
+    try:
+        outcome, row = run_in_transaction(conn, _claim_unit, user_id, key, fingerprint,
+                                          request.method, request.path, name='idempotency')
+    except sqlite3.OperationalError as e:
+        if is_busy_error(e):
+            metrics.incr('idempotency.busy')
+            return jsonify({'success': False, 'message': 'busy', 'retry': True}), 503
+        raise
+    finally:
+        conn.close()
+    if outcome == 'mismatch':
+        metrics.incr('idempotency.mismatch')
+        return jsonify({'success': False,
+                        'message': 'Idempotency-Key was already used for a different request'}), 422
+    if outcome == 'replay':
+        metrics.incr('idempotency.replayed')
+        resp = make_response(row['response_body'], row['status_code'])
+        resp.content_type = row['content_type'] or 'application/json'
+        resp.headers['Idempotent-Replayed'] = 'true'
+        return resp
+    if outcome == 'in_progress':
+        metrics.incr('idempotency.in_progress')
+        return jsonify({'success': False, 'message': 'in_progress', 'retry': True}), 409
+    if outcome == 'unfinished':
+        metrics.incr('idempotency.unfinished')
+        return jsonify({'success': False,
+                        'message': 'The first attempt with this Idempotency-Key did not finish; '
+                                   'check whether it was applied before sending it again'}), 409
+    return None
+
+
+def _finish_unit(conn, user_id, key, stored):
+    if stored is None:
+        conn.execute("DELETE FROM idempotency_keys WHERE user_id=? AND idem_key=?",
+                     (user_id, key))
+    else:
+        conn.execute('''
+            UPDATE idempotency_keys
+            SET status_code=?, response_body=?, content_type=?, created_at=?
+            WHERE user_id=? AND idem_key=?
+        ''', (*stored, time.time(), user_id, key))
+
+
+def _finish(user_id, key, resp):
+    """
+    Store the response of a claimed key, or release the key on a 5xx. The
+    view has already run, so a busy database here does not change its
+    answer: the key is left pending, and its retries get a 409 instead of
+    running the view a second time.
+    """
+    stored = None
+    if resp is not None and resp.status_code < 500 and not resp.is_streamed:
+        stored = (resp.status_code, resp.get_data(), resp.content_type)
+    conn = get_db_connection()
+    try:
+        run_in_transaction(conn, _finish_unit, user_id, key, stored, name='idempotency')
+        if stored is not None:
+            metrics.incr('idempotency.stored')
+    except sqlite3.OperationalError as e:
+        if not is_busy_error(e):
+            raise
+        metrics.incr('idempotency.finish_busy')
+    finally:
+        conn.close()
+
+
+def idempotent(view):
+    """Route guard: `@idempotent` under @login_required. Requests without an
+    Idempotency-Key header run as before."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (request.headers.get('Idempotency-Key') or '').strip()
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({'success': False, 'message': 'Idempotency-Key is too long'}), 400
+        user_id = current_user.get_id() if current_user.is_authenticated else ''
+
+        early = _claim(user_id, key, _fingerprint())
+        if early is not None:
+            return early
+        resp = None
+        try:
+            resp = make_response(view(*args, **kwargs))
+            return resp
+        finally:
+            _finish(user_id, key, resp)
+    return wrapper
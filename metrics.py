@@ -0,0 +1,57 @@
+"""
+In-process metrics for the /api/metrics endpoint.
+
+Counters are plain named integers (incr('auth.denied')); timings keep
+count/total/max of observed values (observe('reception.lock_wait_ms', 3.2));
+sources are callables registered once (e.g. a cache's stats()) and read on
+each snapshot. Everything is per worker process and resets on restart.
+"""
+import threading
+import time
+
+_lock     = threading.Lock()
+_counters = {}
+_timings  = {}
+_sources  = {}
+_started  = time.time()
+
+
+def incr(name, amount=1):
+    """Add `amount` to counter `name`."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def observe(name, value):
+    """Record one measurement of `name` (e.g. a wait time in ms)."""
+    with _lock:
+        t = _timings.get(name)
+        if t is None:
+            t = _timings[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+        t['count'] += 1
+        t['total'] += value
+        t['max'] = max(t['max'], value)
+
+
+def register(name, fn):
+    """Expose fn() under `name` in every snapshot (replaces any previous one)."""
+    with _lock:
+        _sources[name] = fn
+
+
+def snapshot():
+    """Current counters and source readings as a JSON-serialisable dict."""
+    with _lock:
+        counters = dict(_counters)
+        timings  = {k: dict(v, avg=round(v['total'] / v['count'], 3),
+                            total=round(v['total'], 3), max=round(v['max'], 3))
+                    for k, v in _timings.items()}
+        sources  = dict(_sources)
+    out = {'uptime_s': round(time.time() - _started, 1), 'counters': counters,
+           'timings': timings}
+    for name, fn in sources.items():
+        try:
+            out[name] = fn()
+        except Exception as e:
+            out[name] = {'error': str(e)}
+    return out
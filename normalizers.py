@@ -0,0 +1,138 @@
+"""
+Bulk, column-at-a-time versions of the utils normalizers for imports.
+
+A packing list repeats the same few hundred dates and quantities across
+tens of thousands of rows, and one column nearly always uses one date
+format. normalize_column() sniffs that format once per column, parses
+with strptime, memoises repeated values, and only hands cells it cannot
+read to the dateutil-based utils.normalize_date. Results match calling
+the scalar utils functions cell by cell, except that YYYY-MM-DD strings are
+read as ISO (dateutil's dayfirst=True swaps an ambiguous day and month).
+"""
+from datetime import datetime, date
+from functools import lru_cache
+
+from utils import normalize_number, normalize_date, _ISO_DATE_RE
+
+# Candidate day-first formats, in the order they are tried when sniffing
+DATE_FORMATS = (
+    '%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y', '%d.%m.%Y',
+    '%d-%b-%Y', '%d %b %Y', '%d/%b/%Y', '%Y/%m/%d',
+)
+
+SNIFF_SAMPLE = 50
+MEMO_SIZE    = 8192
+
+# How ExcelImporter columns are normalised
+COLUMN_KINDS = {
+    'qty_unit_tot':   'number',
+    'kg_total':       'number',
+    'dm3_total':      'number',
+    'weight_kg':      'number',
+    'volume_m3':      'number',
+    'estim_value_eu': 'number',
+    'nb_parcels':     'int',
+    'exp_date':       'date',
+}
+
+
+def sniff_date_format(values, sample=SNIFF_SAMPLE):
+    """The first DATE_FORMATS entry that parses every sampled string, or None"""
+    texts = []
+    for v in values:
+        if isinstance(v, str) and v.strip():
+            texts.append(v.strip())
+            if len(texts) >= sample:
+                break
+    if not texts:
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            for t in texts:
+                datetime.strptime(t, fmt)
+            return fmt
+        except ValueError:
+            continue
+    return None
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _parse_date_text(text, fmt, iso_prefix):
+    """date for a stripped string, via the sniffed format, ISO, then dateutil.
+    iso_prefix follows utils.iso_date, which reads any YYYY-MM-DD prefix."""
+    if fmt:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    m = _ISO_DATE_RE.match(text)
+    if m and (iso_prefix or len(text) == 10):
+        try:
+            return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        except ValueError:
+            return None
+    if text.upper() in ('N/A', 'NA', '-'):
+        return None
+    iso = normalize_date(text, '%Y-%m-%d')
+    return date.fromisoformat(iso) if iso else None
+
+
+def _to_date(value, fmt, iso_prefix):
+    if not value:
+        return None
+    if isinstance(value, (datetime, date)):
+        return value
+    if isinstance(value, str):
+        return _parse_date_text(value.strip(), fmt, iso_prefix)
+    iso = normalize_date(value, '%Y-%m-%d')
+    return date.fromisoformat(iso) if iso else None
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _number_text(text):
+    return normalize_number(text)
+
+
+def _to_number(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        return _number_text(value)
+    return normalize_number(value)
+
+
+def _to_int(value):
+    try:
+        return int(_to_number(value) or 0)
+    except Exception:
+        return 0
+
+
+def normalize_column(values, kind='text', output_format='%d-%b-%Y'):
+    """
+    Normalise one column of raw cell values. None stays None.
+      number   → utils.normalize_number
+      int      → int(normalize_number) or 0
+      date     → utils.normalize_date(value, output_format)
+      iso_date → utils.iso_date
+      text     → stripped string, or None when empty
+    """
+    if kind == 'number':
+        return [None if v is None else _to_number(v) for v in values]
+    if kind == 'int':
+        return [None if v is None else _to_int(v) for v in values]
+    if kind in ('date', 'iso_date'):
+        fmt = sniff_date_format(values)
+        out_fmt = '%Y-%m-%d' if kind == 'iso_date' else output_format
+        out = []
+        for v in values:
+            d = None if v is None else _to_date(v, fmt, kind == 'iso_date')
+            out.append(d.strftime(out_fmt) if d else None)
+        return out
+    return [None if v is None else (str(v).strip() if v else None) for v in values]
+
+
+def memo_stats():
+    """Hit/miss counts of the value memos (for diagnostics)"""
+    return {'dates': _parse_date_text.cache_info()._asdict(),
+            'numbers': _number_text.cache_info()._asdict()}
@@ -243,6 +243,34 @@ function toggleSection(header) {
     }
 }
 
+// Retry-safe write: every attempt carries the same Idempotency-Key, so a
+// retry after a timeout or dropped connection gets the stored response of
+// the first attempt instead of applying the write twice
+function newIdempotencyKey() {
+    if (window.crypto && typeof crypto.randomUUID === 'function') return crypto.randomUUID();
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2)
+         + Math.random().toString(36).slice(2);
+}
+
+async function fetchIdempotent(url, options = {}, retries = 3) {
+    const headers = { ...(options.headers || {}), 'Idempotency-Key': newIdempotencyKey() };
+    for (let attempt = 0; ; attempt++) {
+        try {
+            const resp = await fetch(url, { ...options, headers });
+            // 409 in_progress / 503 busy carry {retry:true}: try again shortly
+            if ((resp.status === 409 || resp.status === 503) && attempt < retries) {
+                const body = await resp.clone().json().catch(() => ({}));
+                if (!body.retry) return resp;
+            } else {
+                return resp;
+            }
+        } catch (e) {
+            if (attempt >= retries) throw e;
+        }
+        await new Promise(r => setTimeout(r, 300 * 2 ** attempt));
+    }
+}
+
 // Initialize on page load
 document.addEventListener('DOMContentLoaded', function () {
     console.log('📄 DOM loaded, initializing navigation...');
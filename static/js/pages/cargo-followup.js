@@ -8,8 +8,7 @@ let dcThirdParties  = [];
 let dcDispatchLines = [];      // [{parcel_number, item_code, ...}]
 let dcSelectedParcels = new Set(); // parcel numbers already in dispatch lines
 let dcItemRows        = [];  // raw rows from /api/dispatch/items
-let dcMapParcels      = [];  // raw rows from /api/dispatch/parcel-map
-let dcParcelStatusMap = {};  // { parcel_number: 'received'|'dispatched'|'pending' }
+let dcParcelStatusMap = {};  // { parcel_number: 'received'|'dispatched'|'pending' } from item rows
 let dcVisualRows      = [];  // grouped rows for visual map: [{project,packing_ref,item_code,...,parcels:[{parcel_number,qty,weight_kg}]}]
 let dcCurrentTab      = 'parcel';
 
@@ -85,9 +84,6 @@ async function dcInit() {
                 dcThirdParties.map(t=>`<option value="${t.third_party_id}">${t.name}</option>`).join('');
         }
 
-        // Sync project codes before loading data (so project column is populated)
-        try { await fetch('/api/cargo/recalculate-projects', { method: 'POST' }); } catch(e) {}
-
         dcLoadItems();
         dcLoadMap();
     } catch(e) { dcNotify('Init error: '+e.message, 'error'); }
@@ -180,7 +176,10 @@ async function dcAddParcelByNumber(parcelNo) {
         if (!rows.length) { dcNotify(`Parcel ${parcelNo}: no received items found.`, 'error'); return; }
         rows.forEach(row => dcDispatchLines.push(row));
         dcSelectedParcels.add(parcelNo);
-        dcNotify(`✅ Added parcel ${parcelNo} (${rows.length} lines).`, 'success');
+        if (rows.some(r => (r.reserved_qty||0) > 0))
+            dcNotify(`⚠️ Parcel ${parcelNo} is already reserved by another draft dispatch.`, 'error');
+        else
+            dcNotify(`✅ Added parcel ${parcelNo} (${rows.length} lines).`, 'success');
         dcRenderParcelSummary();
         dcRenderLines();
     } catch(e) { dcNotify('Error: '+e.message, 'error'); }
@@ -267,7 +266,9 @@ function dcRenderItemTable() {
     }
     tbody.innerHTML = dcItemRows.map((r, i) => {
         const selected = dcSelectedParcels.has(r.parcel_number);
-        const rowBg    = selected ? 'background:#D1FAE5' : (i%2===0 ? '' : 'background:#F9FAFB');
+        const reserved = (r.reserved_qty||0) > 0;
+        const rowBg    = selected ? 'background:#D1FAE5' : reserved ? 'background:#FEF3C7'
+                       : (i%2===0 ? '' : 'background:#F9FAFB');
         const exp      = (r.exp_date||'').slice(0,10);
         const expStyle = exp && exp < new Date().toISOString().slice(0,10) ? 'color:#DC2626;font-weight:600' : '';
         return `<tr style="${rowBg};cursor:pointer" onclick="dcSelectParcel('${dcEscStr(r.parcel_number)}')"
@@ -279,7 +280,7 @@ function dcRenderItemTable() {
             <td style="font-size:.85rem">${r.item_description||''}</td>
             <td style="font-size:.85rem">${r.batch_no||''}</td>
             <td style="font-size:.85rem;${expStyle}">${exp||'—'}</td>
-            <td style="text-align:right">${r.qty||0}</td>
+            <td style="text-align:right"${reserved ? ` title="${r.reserved_qty} reserved by a draft dispatch"` : ''}>${r.qty||0}${reserved ? ' 🔒' : ''}</td>
             <td style="font-size:.85rem">${r.unit||''}</td>
             <td style="text-align:right">${(parseFloat(r.weight_kg)||0).toFixed(2)}</td>
         </tr>`;
@@ -313,7 +314,7 @@ function dcClearItemFilters() {
     dcLoadItems();
 }
 
-// ── Load map data: items + parcel statuses in parallel ────────────────────────
+// ── Load map data for the selected project (items carry their parcel status) ──
 async function dcLoadMap() {
     const container = document.getElementById('dc-map-container');
     if (container) container.innerHTML = '<div style="text-align:center;color:#9CA3AF;padding:3rem">⏳ Loading…</div>';
@@ -322,18 +323,15 @@ async function dcLoadMap() {
         const project = document.getElementById('dc-map-project')?.value;
         if (project) params.set('project', project);
 
-        const [itemsRes, mapRes] = await Promise.all([
-            fetch('/api/dispatch/items?' + params).then(r=>r.json()),
-            fetch('/api/dispatch/parcel-map?' + params).then(r=>r.json()),
-        ]);
+        const itemsRes = await fetch('/api/dispatch/items?' + params).then(r=>r.json());
 
         // Build parcel status map { parcel_number → 'received'|'dispatched'|'pending' }
         dcParcelStatusMap = {};
-        (mapRes.parcels || []).forEach(p => { dcParcelStatusMap[p.parcel_number] = p.status; });
 
         // Group items by (project, packing_ref, item_code, batch_no, exp_date)
         const gMap = {};
         (itemsRes.items || []).forEach(r => {
+            if (r.parcel_number) dcParcelStatusMap[r.parcel_number] = r.parcel_status || 'received';
             const key = [r.project_code||'', r.packing_ref||'', r.item_code||'', r.batch_no||'', r.exp_date||''].join('||');
             if (!gMap[key]) gMap[key] = {
                 project_code: r.project_code, packing_ref: r.packing_ref,
@@ -581,7 +579,7 @@ async function dcSaveDraft() {
         })),
     };
     try {
-        const data = await fetch('/api/movements/out', {
+        const data = await fetchIdempotent('/api/movements/out', {
             method:'POST', headers:{'Content-Type':'application/json'},
             body: JSON.stringify(payload),
         }).then(r=>r.json());
@@ -609,14 +607,14 @@ async function dcConfirm() {
     };
     try {
         // Step 1: Save as draft
-        const saveResp = await fetch('/api/movements/out', {
+        const saveResp = await fetchIdempotent('/api/movements/out', {
             method:'POST', headers:{'Content-Type':'application/json'},
             body: JSON.stringify(payload),
         }).then(r=>r.json());
         if (!saveResp.success) { dcNotify(saveResp.message||'Save failed.', 'error'); return; }
 
         // Step 2: Confirm the draft
-        const confirmResp = await fetch(`/api/movements/out/${saveResp.id}/confirm`, {
+        const confirmResp = await fetchIdempotent(`/api/movements/out/${saveResp.id}/confirm`, {
             method:'POST',
         }).then(r=>r.json());
         if (!confirmResp.success) { dcNotify(confirmResp.message||'Confirm failed.', 'error'); return; }
@@ -632,7 +630,6 @@ function initCargoFollowupPage() {
     dcDispatchLines = [];
     dcSelectedParcels.clear();
     dcItemRows        = [];
-    dcMapParcels      = [];
     dcVisualRows      = [];
     dcParcelStatusMap = {};
     dcCurrentTab      = 'parcel';
@@ -263,7 +263,7 @@ async function crProcessScan() {
 // ── Auto-receive (scan path — no modal) ──────────────────────
 async function crAutoReceive(parcel) {
     try {
-        const r = await fetch('/api/cargo/receive-parcel', {
+        const r = await fetchIdempotent('/api/cargo/receive-parcel', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -399,7 +399,7 @@ async function crConfirmReceive() {
 
     if (btn) { btn.disabled = true; btn.textContent = '⏳ Saving…'; }
     try {
-        const r = await fetch('/api/cargo/receive-parcel', {
+        const r = await fetchIdempotent('/api/cargo/receive-parcel', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -461,7 +461,7 @@ async function crSaveParcelNote(parcelNum, note) {
 async function crUnreceive(parcelNum) {
     if (!confirm(`Undo reception for parcel "${parcelNum}"?\nThis will remove the stock transaction record.`)) return;
     try {
-        const r = await fetch('/api/cargo/unreceive-parcel', {
+        const r = await fetchIdempotent('/api/cargo/unreceive-parcel', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ parcel_number: parcelNum })
@@ -973,10 +973,17 @@ async function crParsePacking(rows, statusEl) {
 
     if (!crPackingData.length) throw new Error('No valid rows in Packing List');
 
+    // Sent through the resumable chunked upload, so a large list survives a
+    // dropped link and is not bound by the request size limit
+    const payload  = new File([JSON.stringify(crPackingData)], 'packing_list.json',
+                              { type: 'application/json' });
+    const uploadId = await uploadInChunks(payload, (sent, total) => {
+        if (statusEl) statusEl.innerHTML = crStatusMsg('info', `⏳ Uploading… ${Math.round(100 * sent / total)}%`);
+    });
     const resp = await fetch('/api/cargo/packing-list', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ records: crPackingData, session_id: crSessionId })
+        body: JSON.stringify({ upload_id: uploadId, session_id: crSessionId })
     });
     const result = await resp.json();
     if (!result.success) throw new Error(result.message || 'Save failed');
@@ -1340,7 +1347,7 @@ async function crConfirmReceiveLine() {
 
     if (btn) { btn.disabled = true; btn.textContent = '⏳ Saving…'; }
     try {
-        const resp = await fetch('/api/cargo/receive-line', {
+        const resp = await fetchIdempotent('/api/cargo/receive-line', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -39,8 +39,6 @@ async function invInit() {
             const el = document.getElementById(id);
             if (el) el.innerHTML = opts;
         });
-        // Retroactively populate project codes in basic_data (silent background call)
-        fetch('/api/cargo/recalculate-projects', {method:'POST'}).catch(()=>{});
     } catch(e) { invNotify('Init error: '+e.message, 'error'); }
 }
 
@@ -72,8 +70,8 @@ async function invLoadItems() {
                 <td>${r.item_description||''}</td>
                 <td>${r.batch_no||''}</td>
                 <td>${invExpStyle(r.exp_date)}</td>
-                <td style="font-size:.85rem;color:#6B7280">${r.parcel_number||'—'}</td>
-                <td style="font-size:.85rem;color:#6B7280">${r.pallet_number||'—'}</td>
+                <td style="font-size:.85rem;color:#6B7280">${invLocationList(r.locations, 'parcel_number')}</td>
+                <td style="font-size:.85rem;color:#6B7280">${invLocationList(r.locations, 'pallet_number')}</td>
                 <td style="text-align:right">${(r.net_stock||0).toFixed(3)}</td>
                 <td><input type="number" class="form-input" style="width:100px;text-align:right"
                            id="inv-phys-${i}" placeholder="0" min="0" step="any"
@@ -88,6 +86,18 @@ async function invLoadItems() {
     } catch(e) { invNotify('Load error: '+e.message, 'error'); }
 }
 
+// All distinct parcels / pallets holding a stock line, one per line with qty tooltip
+function invLocationList(locations, key) {
+    const seen = new Map();
+    (locations || []).forEach(l => {
+        const v = l[key];
+        if (!v) return;
+        seen.set(v, (seen.get(v) || 0) + (l.qty || 0));
+    });
+    if (!seen.size) return '—';
+    return [...seen].map(([v, q]) => `<div title="Qty ${q}">${v}</div>`).join('');
+}
+
 function invCalcVariance(i, systemQty) {
     const phys = parseFloat(document.getElementById(`inv-phys-${i}`)?.value);
     const varCell = document.getElementById(`inv-var-${i}`);
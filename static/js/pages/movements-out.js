@@ -82,7 +82,11 @@ async function moLoadStock() {
         return;
     }
     try {
-        const data = await fetch(`/api/movements/stock?project=${encodeURIComponent(project)}`).then(r=>r.json());
+        // Stock held by other Drafts is already netted out; our own Draft's is not
+        const params  = new URLSearchParams({project});
+        const editing = parseInt(document.getElementById('mo-editing-id').value);
+        if (editing) params.set('exclude', editing);
+        const data = await fetch(`/api/movements/stock?${params}`).then(r=>r.json());
         if (!data.success) return moNotify(data.message, 'error');
         moStockRows = data.stock || [];
         moRenderStockTable(moStockRows);
@@ -103,7 +107,7 @@ function moRenderStockTable(rows) {
             <td>${r.item_description||''}</td>
             <td>${r.batch_no||''}</td>
             <td>${moExpStyle(r.exp_date)}</td>
-            <td style="text-align:right;font-weight:600">${(r.available_qty||0).toFixed(3)}</td>
+            <td style="text-align:right;font-weight:600"${r.reserved_qty ? ` title="${(r.reserved_qty).toFixed(3)} reserved by other drafts"` : ''}>${(r.available_qty||0).toFixed(3)}${r.reserved_qty ? ' 🔒' : ''}</td>
         </tr>
     `).join('');
 }
@@ -261,7 +265,7 @@ async function moSaveDraft() {
     if (!payload.movement_date)  return moNotify('Please select a date.', 'error');
     if (!payload.source_project) return moNotify('Please select a source project.', 'error');
     try {
-        const r = await fetch('/api/movements/out', {
+        const r = await fetchIdempotent('/api/movements/out', {
             method:'POST', headers:{'Content-Type':'application/json'},
             body:JSON.stringify(payload)
         }).then(r=>r.json());
@@ -281,13 +285,13 @@ async function moConfirmDraft() {
     if (moCollectLines().length === 0) return moNotify('Add at least one line.', 'error');
     if (!confirm('Confirm this OUT movement? Stock will be reduced. Cannot be undone.')) return;
     try {
-        const save = await fetch('/api/movements/out', {
+        const save = await fetchIdempotent('/api/movements/out', {
             method:'POST', headers:{'Content-Type':'application/json'},
             body:JSON.stringify(payload)
         }).then(r=>r.json());
         if (!save.success) return moNotify(save.message, 'error');
 
-        const confirm_r = await fetch(`/api/movements/out/${save.id}/confirm`, {
+        const confirm_r = await fetchIdempotent(`/api/movements/out/${save.id}/confirm`, {
             method:'POST'
         }).then(r=>r.json());
         if (!confirm_r.success) return moNotify(confirm_r.message, 'error');
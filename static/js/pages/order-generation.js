@@ -816,7 +816,7 @@ async function ogSaveOrder() {
             order_generation_date: today,
             requested_delivery_date: dDate || null,
         }));
-        const r = await fetch(url, {
+        const r = await fetchIdempotent(url, {
             method: ogEditingId ? 'PUT' : 'POST', headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ order_number: num, order_type: ogCurrentType, order_description: desc, order_family: fam, order_project: proj, stock_date: sDate, requested_delivery_date: dDate || null, order_generation_date: today, currency: ogCurrency, lines: stampedLines })
         });
@@ -116,26 +116,49 @@ function rptExportSummary() {
 //  STOCK CARD
 // ════════════════════════════════════════════════════════════════════════════
 
-async function rptLoadCard() {
+let rptScPage  = null;   // null → server returns the most recent page
+let rptScPages = 1;
+
+async function rptLoadCard(page) {
     const item    = document.getElementById('rpt-sc-item').value.trim();
     const project = document.getElementById('rpt-sc-project').value;
     if (!item) return rptNotify('Enter an item code.', 'error');
-    const params = new URLSearchParams({ item });
+    const from    = document.getElementById('rpt-sc-from').value;
+    const params = new URLSearchParams({ item, limit: 200 });
     if (project) params.set('project', project);
+    if (from)    params.set('from', from);
+    if (page)    params.set('page', page);
 
     try {
         const data = await fetch('/api/reports/stock-card?' + params).then(r=>r.json());
         if (!data.success) return rptNotify(data.message, 'error');
         const txns = data.transactions || [];
-        document.getElementById('rpt-sc-info').textContent =
-            `Item: ${data.item}  |  Project: ${data.project}  |  ${txns.length} transactions`;
+        rptScPage  = data.page;
+        rptScPages = data.pages || 1;
+        const pager = rptScPages > 1
+            ? `  |  <button class="btn" style="padding:.1rem .5rem" ${rptScPage<=1?'disabled':''} onclick="rptLoadCard(${rptScPage-1})">◀</button>
+               Page ${rptScPage} / ${rptScPages}
+               <button class="btn" style="padding:.1rem .5rem" ${rptScPage>=rptScPages?'disabled':''} onclick="rptLoadCard(${rptScPage+1})">▶</button>`
+            : '';
+        const archived = (data.archived_years || []).length
+            ? `  |  Incl. closed years ${data.archived_years.join(', ')}` : '';
+        document.getElementById('rpt-sc-info').innerHTML =
+            `Item: ${data.item}  |  Project: ${data.project}  |  ${data.total} transactions${archived}${pager}`;
 
         const tbody = document.getElementById('rpt-sc-body');
         if (!txns.length) {
             tbody.innerHTML = '<tr><td colspan="11" style="text-align:center;color:#9CA3AF;padding:2rem">No transactions found for this item</td></tr>';
             return;
         }
-        tbody.innerHTML = txns.map((t,i) => {
+        const opening = data.opening_balance || 0;
+        const broughtForward = rptScPage > 1
+            ? `<tr style="background:#EEF2FF;font-style:italic">
+                <td colspan="8">Balance brought forward</td>
+                <td style="text-align:right;font-weight:700">${opening.toFixed(3)}</td>
+                <td colspan="2"></td>
+            </tr>`
+            : '';
+        tbody.innerHTML = broughtForward + txns.map((t,i) => {
             const dirBadge = t.source==='OUT'
                 ? `<span style="background:#FEE2E2;color:#991B1B;padding:.15rem .5rem;border-radius:4px;font-size:.8rem">${t.doc_type}</span>`
                 : `<span style="background:#D1FAE5;color:#065F46;padding:.15rem .5rem;border-radius:4px;font-size:.8rem">${t.doc_type}</span>`;
@@ -161,9 +184,11 @@ async function rptLoadCard() {
 function rptExportCard() {
     const item    = document.getElementById('rpt-sc-item').value.trim();
     const project = document.getElementById('rpt-sc-project').value;
+    const from    = document.getElementById('rpt-sc-from').value;
     if (!item) return rptNotify('Enter an item code first.', 'error');
     const params = new URLSearchParams({ item });
     if (project) params.set('project', project);
+    if (from)    params.set('from', from);
     window.open('/api/reports/stock-card/export?' + params, '_blank');
 }
 
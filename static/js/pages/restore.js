@@ -163,16 +163,17 @@ async function startRestore() {
             }
         } // ← THIS WAS MISSING!
 
-        // Step 2: Create form data
-        const formData = new FormData();
-        formData.append('file', selectedFile);
-
-        updateProgress(50, 'Uploading restore file...');
+        // Step 2: Upload in resumable chunks
+        updateProgress(35, 'Uploading restore file...');
+        const uploadId = await uploadInChunks(selectedFile, (sent, total) => {
+            updateProgress(35 + Math.round(40 * sent / total), 'Uploading restore file...');
+        });
 
-        // Step 3: Upload and restore
+        // Step 3: Restore from the assembled upload
         const response = await fetch('/api/backup/restore', {
             method: 'POST',
-            body: formData
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ upload_id: uploadId })
         });
 
         updateProgress(80, 'Restoring database...');
@@ -0,0 +1,78 @@
+// Chunked, resumable upload (see /api/uploads), used by the restore and
+// cargo reception pages. The session id is kept in localStorage per file,
+// so re-selecting the same file after a dropped connection or a page
+// reload continues from the server's offset.
+const UPLOAD_RETRIES = 5;
+
+async function uploadInChunks(file, onProgress) {
+    const key = `upload:${file.name}:${file.size}:${file.lastModified}`;
+    let status = null;
+
+    const savedId = localStorage.getItem(key);
+    if (savedId) {
+        const res = await fetch(`/api/uploads/${savedId}`);
+        if (res.ok) status = await res.json();
+    }
+    if (!status || !status.success) {
+        const res = await fetch('/api/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size })
+        });
+        status = await res.json();
+        if (!status.success) throw new Error(status.message || 'Upload failed');
+        localStorage.setItem(key, status.upload_id);
+    }
+
+    let offset = status.offset;
+    let failures = 0;
+    while (offset < file.size) {
+        onProgress(offset, file.size);
+        const chunk = await file.slice(offset, offset + status.chunk_size).arrayBuffer();
+        try {
+            const res = await fetch(`/api/uploads/${status.upload_id}?offset=${offset}`, {
+                method: 'PUT',
+                headers: {
+                    'Content-Type': 'application/octet-stream',
+                    ...(await chunkChecksumHeader(chunk))
+                },
+                body: chunk
+            });
+            const result = await res.json();
+            if (result.offset === undefined) throw new Error(result.message || 'Upload failed');
+            offset = result.offset;            // on 409/422 the server says where to resume
+            if (res.ok) failures = 0; else throw new Error(result.message);
+        } catch (error) {
+            if (++failures > UPLOAD_RETRIES) throw error;
+            await new Promise(resolve => setTimeout(resolve, 500 * 2 ** failures));
+        }
+    }
+    onProgress(file.size, file.size);
+    localStorage.removeItem(key);
+    return status.upload_id;
+}
+
+// SHA-256 needs a secure context (https/localhost); plain-http LAN installs fall back to CRC32
+async function chunkChecksumHeader(buffer) {
+    if (window.crypto && crypto.subtle) {
+        const digest = await crypto.subtle.digest('SHA-256', buffer);
+        const hex = Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+        return { 'X-Chunk-Sha256': hex };
+    }
+    return { 'X-Chunk-Crc32': crc32(new Uint8Array(buffer)).toString(16).padStart(8, '0') };
+}
+
+let crcTable = null;
+function crc32(bytes) {
+    if (!crcTable) {
+        crcTable = new Uint32Array(256);
+        for (let n = 0; n < 256; n++) {
+            let c = n;
+            for (let k = 0; k < 8; k++) c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+            crcTable[n] = c >>> 0;
+        }
+    }
+    let crc = 0xFFFFFFFF;
+    for (let i = 0; i < bytes.length; i++) crc = crcTable[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+    return (crc ^ 0xFFFFFFFF) >>> 0;
+}
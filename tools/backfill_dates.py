@@ -0,0 +1,58 @@
+"""
+Batch backfill of canonical ISO dates for existing rows.
+
+Fills exp_date_iso on stock_transactions, movement_lines and basic_data,
+and rewrites non-ISO movements.movement_date values to YYYY-MM-DD. The app
+runs the same job on startup (update_database_schema); this script is for
+running it on demand, e.g. against a restored backup, with progress output.
+
+Usage:
+    python tools/backfill_dates.py                       # data/inventory.db
+    python tools/backfill_dates.py --db backup.db --batch-size 5000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+import database
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Backfill canonical ISO dates')
+    ap.add_argument('--db', default=database.DATABASE)
+    ap.add_argument('--batch-size', type=int, default=20000)
+    args = ap.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        print(f"❌ Database not found: {args.db}")
+        return 1
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    conn.execute("PRAGMA busy_timeout=30000")
+    try:
+        before = {t: conn.execute(f"SELECT COUNT(*) FROM {t} WHERE exp_date_iso IS NULL").fetchone()[0]
+                  for t in database._ISO_DATE_SOURCES}
+    except sqlite3.OperationalError:
+        conn.close()
+        print("❌ exp_date_iso columns missing — start the app once to migrate the schema")
+        return 1
+
+    t0 = time.perf_counter()
+    updated = database.backfill_iso_dates(conn, batch_size=args.batch_size)
+    conn.commit()
+    print(f"✅ Canonicalised dates on {updated} rows in {time.perf_counter() - t0:.1f}s")
+    for table in database._ISO_DATE_SOURCES:
+        after = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE exp_date_iso IS NULL").fetchone()[0]
+        print(f"   {table:<20} undated {before[table]:>9,} → {after:>9,}")
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
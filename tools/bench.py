@@ -0,0 +1,252 @@
+"""
+Endpoint benchmark runner.
+
+Times the hot paths (parcel list, parcel reception, stock summary, expiry,
+dispatch parcel map, orders, XLSX exports) against a synthetic fixture DB
+built by tools/gen_fixture_db.py, and compares medians with a recorded
+baseline so a regression shows up as a non-zero exit code.
+
+The fixture is copied to a scratch file first, so write benchmarks
+(receive-parcel) never touch the cached fixture or data/inventory.db.
+
+Report and export cases empty the report cache before every run (outside
+the timed part), so they time the query and the file build; the *_cached
+cases time a cache hit.
+
+Usage:
+    python tools/bench.py --preset 10k --save-baseline      # record baseline
+    python tools/bench.py --preset 10k                      # compare (fails on >25% slower)
+    python tools/bench.py --preset 100k --only expiry,parcels --repeat 3
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+from tools.gen_fixture_db import PRESETS, ensure_fixture
+
+BENCH_DIR = os.path.join(_ROOT, 'data', 'bench')
+
+
+def _load_app(db_path):
+    """Import the Flask app bound to `db_path` (must run before any app import)."""
+    os.environ['MIDFLOW_DATABASE'] = db_path
+    os.chdir(_ROOT)                      # app.py uses paths relative to the repo root
+    import app as app_module
+    app_module.app.config['TESTING'] = True
+    # Export files cached next to the scratch DB, not in data/report_cache
+    cache_dir = os.path.join(os.path.dirname(db_path), 'report_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    app_module.REPORT_CACHE.disk_dir = cache_dir
+    return app_module
+
+
+def _login(client, username='admin', password='admin123'):
+    resp = client.post('/login', data={'username': username, 'password': password})
+    if resp.status_code != 302:
+        raise RuntimeError(f"login failed for {username!r} (HTTP {resp.status_code})")
+
+
+def _check(resp, name):
+    if resp.status_code >= 400:
+        raise RuntimeError(f"{name}: HTTP {resp.status_code} {resp.get_data(as_text=True)[:200]}")
+    return resp
+
+
+def build_cases(app_module, client, db_path):
+    """Return {name: zero-arg callable, or (setup, callable)}. Each call is
+    one timed iteration; setup runs before it, untimed."""
+    import sqlite3
+    ro = sqlite3.connect(db_path)
+    pending = [r[0] for r in ro.execute(
+        "SELECT DISTINCT parcel_number FROM basic_data "
+        "WHERE reception_status = 'Pending' ORDER BY parcel_number")]
+    sample_item = ro.execute(
+        "SELECT item_code, project_code FROM stock_transactions "
+        "GROUP BY item_code, project_code ORDER BY COUNT(*) DESC LIMIT 1").fetchone()
+    ro.close()
+    pending_iter = iter(pending)
+
+    def get(url):
+        return lambda: _check(client.get(url), url)
+
+    def uncached(fn):
+        return (app_module.REPORT_CACHE.clear, fn)
+
+    def receive_parcel():
+        parcel = next(pending_iter)
+        _check(client.post('/api/cargo/receive-parcel',
+                           json={'parcel_number': parcel, 'pallet_number': 'PBENCH'}),
+               'receive-parcel')
+
+    def stock_summary_rows():
+        conn = app_module._reports_db()
+        try:
+            app_module._stock_summary_rows(conn)
+        finally:
+            conn.close()
+
+    item, project = sample_item or ('', '')
+    card_query = urlencode({'item': item, 'project': project or ''})
+    return {
+        'parcels':               get('/api/cargo/parcels'),
+        'receive_parcel':        receive_parcel,
+        'stock_summary_rows':    stock_summary_rows,
+        'stock_summary':         uncached(get('/api/reports/stock-summary')),
+        'stock_summary_cached':  get('/api/reports/stock-summary'),
+        'stock_card':            get(f'/api/reports/stock-card?{card_query}'),
+        'expiry':                uncached(get('/api/reports/expiry?within_days=180')),
+        'dispatch_parcel_map':   get('/api/dispatch/parcel-map'),
+        'orders':                get('/api/orders'),
+        'inventory_items':       get('/api/inventory/items'),
+        'export_stock_summary':  uncached(get('/api/reports/stock-summary/export')),
+        'export_stock_summary_cached': get('/api/reports/stock-summary/export'),
+        'export_expiry':         uncached(get('/api/reports/expiry/export?within_days=180')),
+        'export_transactions':   uncached(get('/api/reports/transactions/export')),
+        'export_reception':      uncached(get('/api/reports/reception/export')),
+        'export_basic_data':     get('/api/basic-data/export'),
+    }
+
+
+def run_cases(cases, repeat, warmup):
+    results = {}
+    for name, case in cases.items():
+        setup, fn = case if isinstance(case, tuple) else (None, case)
+        try:
+            for _ in range(warmup):
+                if setup:
+                    setup()
+                fn()
+            samples = []
+            for _ in range(repeat):
+                if setup:
+                    setup()
+                t0 = time.perf_counter()
+                fn()
+                samples.append((time.perf_counter() - t0) * 1000)
+        except StopIteration:
+            print(f"  {name:<28} skipped (fixture ran out of pending parcels)")
+            continue
+        samples.sort()
+        results[name] = {
+            'median_ms': round(statistics.median(samples), 2),
+            'min_ms':    round(samples[0], 2),
+            'max_ms':    round(samples[-1], 2),
+            'p95_ms':    round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+            'n':         len(samples),
+        }
+        r = results[name]
+        print(f"  {name:<28} median {r['median_ms']:>9.1f} ms   "
+              f"min {r['min_ms']:>9.1f}   max {r['max_ms']:>9.1f}")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return list of (name, base_ms, now_ms) that regressed beyond tolerance."""
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        if r['median_ms'] > base['median_ms'] * (1 + tolerance):
+            regressions.append((name, base['median_ms'], r['median_ms']))
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Benchmark MidFlow hot paths on a fixture DB')
+    grp = ap.add_mutually_exclusive_group()
+    grp.add_argument('--preset', choices=sorted(PRESETS))
+    grp.add_argument('--lines', type=int)
+    grp.add_argument('--db', help='use an existing fixture DB instead of generating one')
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--warmup', type=int, default=1)
+    ap.add_argument('--only', help='comma-separated case names')
+    ap.add_argument('--baseline', help='baseline JSON (default: data/bench/baseline_<size>.json)')
+    ap.add_argument('--save-baseline', action='store_true', help='write results as the new baseline')
+    ap.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown (0.25 = 25%%)')
+    ap.add_argument('--out', help='also write results JSON here')
+    args = ap.parse_args(argv)
+
+    if args.db:
+        fixture, size = os.path.abspath(args.db), os.path.splitext(os.path.basename(args.db))[0]
+    else:
+        lines   = PRESETS[args.preset] if args.preset else (args.lines or PRESETS['10k'])
+        fixture = ensure_fixture(lines, seed=args.seed)
+        size    = str(lines)
+
+    scratch_dir = tempfile.mkdtemp(prefix='midflow_bench_')
+    scratch_db  = os.path.join(scratch_dir, 'inventory.db')
+    shutil.copyfile(fixture, scratch_db)
+    # Some exports save a copy under data/ before sending it — clean those up after
+    data_dir    = os.path.join(_ROOT, 'data')
+    data_before = set(os.listdir(data_dir))
+    try:
+        app_module = _load_app(scratch_db)
+        client = app_module.app.test_client()
+        _login(client)
+
+        cases = build_cases(app_module, client, scratch_db)
+        if args.only:
+            wanted = {c.strip() for c in args.only.split(',')}
+            unknown = wanted - set(cases)
+            if unknown:
+                ap.error(f"unknown case(s): {', '.join(sorted(unknown))}")
+            cases = {k: v for k, v in cases.items() if k in wanted}
+
+        print(f"Benchmarking {fixture} ({args.repeat} runs, {args.warmup} warm-up)")
+        results = run_cases(cases, args.repeat, args.warmup)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        for name in set(os.listdir(data_dir)) - data_before:
+            if name.endswith('.xlsx'):
+                os.remove(os.path.join(data_dir, name))
+
+    report = {
+        'fixture':  os.path.basename(fixture),
+        'python':   platform.python_version(),
+        'platform': platform.platform(),
+        'recorded': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results':  results,
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    baseline_path = args.baseline or os.path.join(BENCH_DIR, f'baseline_{size}.json')
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Baseline saved to {baseline_path}")
+        return 0
+
+    if not os.path.exists(baseline_path):
+        print(f"ℹ️  No baseline at {baseline_path} — run with --save-baseline to record one")
+        return 0
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+        for name, base_ms, now_ms in regressions:
+            print(f"   {name:<28} {base_ms:.1f} ms → {now_ms:.1f} ms")
+        return 1
+    print(f"✅ No regressions against {baseline_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
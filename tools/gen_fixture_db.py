@@ -0,0 +1,453 @@
+"""
+Deterministic synthetic inventory.db generator (benchmarks / load tests).
+
+Builds a database with the production schema (cloned from data/inventory.db)
+and fills it with realistic-looking warehouse data:
+
+  • basic_data          — packing-list lines, N lines in total
+  • cargo_summary       — one row per parcel
+  • stock_transactions  — one RECEPTION row per received line
+  • movements / movement_lines — confirmed IN/OUT + a few Drafts,
+                          some OUT lines dispatch whole parcels
+  • orders / order_lines — International + Local orders
+  • projects, mission_details, users (admin/admin123 etc.)
+
+Distributions: ~12 parcels per packing ref (long tail to 120), 1–10+ lines
+per parcel, 1–3 batches per item, expiry dates spread from already-expired
+to five years out, in the mixed formats the app receives in the field.
+
+Usage:
+    python tools/gen_fixture_db.py --preset 10k
+    python tools/gen_fixture_db.py --lines 250000 --out /tmp/inv.db --seed 7
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+from werkzeug.security import generate_password_hash
+
+TEMPLATE_DB  = os.path.join(_ROOT, 'data', 'inventory.db')
+FIXTURES_DIR = os.path.join(_ROOT, 'data', 'fixtures')
+
+# Bump when the generated data changes so cached fixtures are rebuilt
+FIXTURE_VERSION = 2
+
+PRESETS = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+
+MISSION_ABBR = 'BEN'
+PROJECTS = [
+    # (code, name, weight) — a few big projects and a long tail
+    ('BE101', 'Emergency Response',        40),
+    ('BE102', 'Hospital Support',          25),
+    ('BE205', 'Nutrition',                 15),
+    ('BE310', 'Water & Sanitation',        10),
+    ('BE420', 'Vaccination Campaign',       6),
+    ('BE999', 'Coordination',               4),
+]
+
+_ITEM_PREFIXES = ['DORA', 'DEXT', 'DINJ', 'EEMD', 'SPPE', 'SMED', 'KMED', 'ELAE']
+_ITEM_WORDS = ['PARACETAMOL', 'AMOXICILLIN', 'METOCLOPRAMIDE', 'SULFADIAZINE',
+               'COVERALL', 'GLOVES', 'SYRINGE', 'CATHETER', 'DRESSING',
+               'ORS', 'ZINC', 'CEFTRIAXONE', 'IBUPROFEN', 'BANDAGE', 'MASK']
+_ITEM_FORMS = ['500mg, tab.', '250mg/5ml, susp.', '1g, vial', 'M, unit',
+               '10cm x 4m, roll', 'sachet', '50g, tube', 'box of 100']
+
+
+def _schema_statements(template):
+    """Return (tables, indexes, triggers) CREATE statements from the template DB."""
+    src = sqlite3.connect(template)
+    try:
+        rows = src.execute(
+            "SELECT type, name, sql FROM sqlite_master "
+            "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY rowid"
+        ).fetchall()
+    finally:
+        src.close()
+    tables   = [sql for t, _, sql in rows if t == 'table']
+    indexes  = [sql for t, _, sql in rows if t == 'index']
+    triggers = [sql for t, _, sql in rows if t == 'trigger']
+    return tables, indexes, triggers
+
+
+def _fmt_exp(rng, d):
+    """Render an expiry date the way it arrives from HQ packing lists."""
+    roll = rng.random()
+    if roll < 0.70:
+        return d.strftime('%d/%m/%Y')
+    if roll < 0.90:
+        return d.isoformat()
+    return None
+
+
+def _ts(d, rng):
+    return datetime(d.year, d.month, d.day,
+                    rng.randint(7, 18), rng.randint(0, 59), rng.randint(0, 59)
+                    ).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def build_fixture_db(path, lines, seed=42, template=TEMPLATE_DB, today=None, verbose=True):
+    """Build a fixture DB at `path` with ~`lines` basic_data rows. Returns row counts."""
+    rng   = random.Random(seed)
+    today = today or date(2026, 6, 30)
+    t0    = time.perf_counter()
+
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    tables, indexes, triggers = _schema_statements(template)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    for sql in tables:
+        conn.execute(sql)
+
+    # ── Reference data ────────────────────────────────────────────────────
+    pw = generate_password_hash('admin123')
+    conn.executemany(
+        "INSERT INTO users (username, password, role, language) VALUES (?, ?, ?, 'en')",
+        [('admin', pw, 'HQ'), ('coordinator', pw, 'Coordinator'),
+         ('manager', pw, 'Manager'), ('supervisor', pw, 'Supervisor')]
+        + [(f'scanner{i:02d}', pw, 'Supervisor') for i in range(1, 11)]
+    )
+    conn.execute(
+        "INSERT INTO mission_details (mission_name, mission_abbreviation, lead_time_months, "
+        "cover_period_months, security_stock_months, is_active, created_by) "
+        "VALUES ('Benchmark Mission', ?, 3, 6, 2, 1, 1)", (MISSION_ABBR,))
+    conn.executemany(
+        "INSERT INTO projects (project_name, project_code, display_order, is_active, created_by) "
+        "VALUES (?, ?, ?, 1, 1)",
+        [(name, code, i) for i, (code, name, _) in enumerate(PROJECTS, 1)])
+
+    proj_codes   = [p[0] for p in PROJECTS]
+    proj_weights = [p[2] for p in PROJECTS]
+
+    # ── Item catalogue with batches ───────────────────────────────────────
+    n_items = max(300, lines // 40)
+    items = []
+    seen_codes = set()
+    while len(items) < n_items:
+        code = (rng.choice(_ITEM_PREFIXES)
+                + ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4))
+                + rng.choice('123456789') + rng.choice('TCVMS-'))
+        if code in seen_codes:
+            continue
+        seen_codes.add(code)
+        desc = f"{rng.choice(_ITEM_WORDS)}, {rng.choice(_ITEM_FORMS)}"
+        n_batches = rng.choices([1, 2, 3], weights=[50, 35, 15])[0]
+        batches = []
+        for _ in range(n_batches):
+            # Skewed towards 1–2 years out, some already expired
+            days = int(rng.triangular(-120, 1825, 450))
+            batches.append((f"{rng.choice('ABCDEFGHKLMN')}{rng.randint(10000, 99999)}",
+                            today + timedelta(days=days)))
+        items.append((code, desc, rng.choice(['1', '10', '50', '100', '1000']), batches))
+    # Popular items get more lines (Zipf-ish)
+    item_weights = [1.0 / (i + 1) ** 0.8 for i in range(len(items))]
+
+    # ── Packing refs → parcels → lines ────────────────────────────────────
+    bd_rows, cs_rows, st_rows = [], [], []
+    received_parcels = []   # (parcel_number, project_code, [line dicts], received_date)
+    line_total = 0
+    ref_seq = recep_total = pallet_seq = 0
+    recep_seq = {}          # per-year, matching _cr_next_reception_number
+    start_day = today - timedelta(days=3 * 365)
+
+    while line_total < lines:
+        ref_seq += 1
+        packing_ref = str(250000 + ref_seq)
+        project     = rng.choices(proj_codes, weights=proj_weights)[0]
+        # Shipments arrive evenly over the last three years
+        arrival     = start_day + timedelta(days=rng.randint(0, 3 * 365))
+        arrival     = min(arrival, today)
+        field_ref   = f"{arrival.strftime('%y')}/BE/{project}/PO{ref_seq:05d}"
+        transport   = f"TR{arrival.strftime('%y%m')}{ref_seq % 97:02d}"
+        session_id  = f"CS-{arrival.strftime('%Y%m%d')}-{ref_seq % 7}"
+        # Older shipments are more likely to be received already
+        recv_prob   = 0.55 + 0.4 * (1 - (arrival - start_day).days / (3 * 365.0))
+        n_parcels   = min(120, max(1, int(rng.expovariate(1 / 12.0))))
+
+        for parcel_nb in range(1, n_parcels + 1):
+            if line_total >= lines:
+                break
+            parcel_number = f"{packing_ref}{parcel_nb}"
+            n_lines = min(25, 1 + int(rng.expovariate(1 / 2.5)), lines - line_total)
+            weight  = round(rng.uniform(2, 45), 2)
+            volume  = round(weight / rng.uniform(80, 250), 3)
+            value   = round(rng.uniform(20, 4000), 2)
+            received = rng.random() < recv_prob
+            recv_day = min(today, arrival + timedelta(days=rng.randint(0, 20)))
+            recep_no = pallet = received_at = None
+            if received:
+                yy = recv_day.strftime('%y')
+                recep_seq[yy] = recep_seq.get(yy, 0) + 1
+                recep_total += 1
+                if recep_total % 15 == 1:
+                    pallet_seq += 1
+                recep_no    = f"{yy}/{MISSION_ABBR}/SR{recep_seq[yy]:04d}"
+                pallet      = f"P{pallet_seq:03d}"
+                received_at = _ts(recv_day, rng)
+            status = 'Received' if received else 'Pending'
+
+            cs_rows.append((parcel_number, transport, ref_seq % 40, field_ref, ref_seq,
+                            int(packing_ref), parcel_nb, weight, volume, ref_seq, value,
+                            status, received_at, 1 if received else None,
+                            'International', session_id))
+
+            parcel_lines = []
+            for line_no in range(1, n_lines + 1):
+                code, desc, pack, batches = rng.choices(items, weights=item_weights)[0]
+                batch_no, exp_d = rng.choice(batches)
+                qty      = float(rng.choice([10, 20, 50, 100, 200, 500, 1000]))
+                exp_txt  = _fmt_exp(rng, exp_d)
+                # Reception-time expiry override (ISO or N/A) on a share of lines
+                exp_recv = None
+                if received:
+                    roll = rng.random()
+                    exp_recv = (exp_d.isoformat() if roll < 0.30 else
+                                'N/A' if roll < 0.33 else exp_txt)
+                unique_id = f"{packing_ref}_{line_no}_{parcel_nb}"
+                bd_rows.append((
+                    unique_id, packing_ref, str(line_no), code, desc, qty, pack,
+                    str(parcel_nb), n_parcels, batch_no, exp_txt,
+                    round(weight / n_lines, 3), round(volume * 1000 / n_lines, 3),
+                    transport, str(ref_seq % 40), field_ref, str(ref_seq),
+                    str(parcel_nb), weight, volume, str(ref_seq), value,
+                    'Excel Import', 1,
+                    parcel_number, status, 'International', session_id, pallet,
+                    recep_no, received_at, 1 if received else None, project,
+                    qty if received else None, exp_recv,
+                    batch_no if received else None,
+                ))
+                if received:
+                    st_rows.append((
+                        recep_no, 'RECEPTION', parcel_number, packing_ref, line_no,
+                        code, desc, qty, pack, batch_no, exp_recv or '',
+                        field_ref, field_ref, pallet, transport,
+                        weight, volume, value, MISSION_ABBR, 1, received_at,
+                        session_id, '', project,
+                    ))
+                parcel_lines.append((code, desc, batch_no, exp_recv or exp_txt or '', qty, pack))
+                line_total += 1
+
+            if received:
+                received_parcels.append((parcel_number, project, parcel_lines, recv_day, pallet))
+
+    conn.executemany('''
+        INSERT INTO cargo_summary
+            (parcel_number, transport_reception, sub_folder, field_ref, ref_op_msfl,
+             goods_reception, parcel_nb, weight_kg, volume_m3, invoice_credit_note_ref,
+             estim_value_eu, reception_status, received_at, received_by, order_type,
+             cargo_session_id)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    ''', cs_rows)
+    conn.executemany('''
+        INSERT INTO basic_data
+            (unique_id, packing_ref, line_no, item_code, item_description,
+             qty_unit_tot, packaging, parcel_no, nb_parcels, batch_no,
+             exp_date, kg_total, dm3_total, transport_reception, sub_folder,
+             field_ref, ref_op_msfl, parcel_nb, weight_kg, volume_m3,
+             invoice_credit_note_ref, estim_value_eu, source_file, imported_by,
+             parcel_number, reception_status, order_type, cargo_session_id, pallet_number,
+             reception_number, received_at, received_by, project_code,
+             qty_received, exp_date_received, batch_no_received)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    ''', bd_rows)
+    conn.executemany('''
+        INSERT INTO stock_transactions
+            (reception_number, transaction_type, parcel_number, packing_ref, line_no,
+             item_code, item_description, qty_received, packaging, batch_no, exp_date,
+             order_number, field_ref, pallet_number, transport_reception,
+             weight_kg, volume_m3, estim_value_eu, mission_abbreviation, received_by,
+             received_at, cargo_session_id, notes, project_code)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    ''', st_rows)
+    n_bd, n_st, n_cs = len(bd_rows), len(st_rows), len(cs_rows)
+    del bd_rows, st_rows, cs_rows
+
+    # ── Movements: whole-parcel dispatches, item OUTs, confirmed INs, Drafts ─
+    mov_rows, ml_rows = [], []
+    doc_seq = {}
+    mov_id = 0
+
+    def _doc_number(doc_type, d):
+        key = (doc_type, d.year)
+        doc_seq[key] = doc_seq.get(key, 0) + 1
+        return f"{MISSION_ABBR}/{d.strftime('%y')}/{doc_type}/{doc_seq[key]:03d}"
+
+    def _add_movement(mtype, doc_type, d, src, dst, status, mlines, end_user=None):
+        nonlocal mov_id
+        mov_id += 1
+        doc_no = _doc_number(doc_type, d) if status == 'Confirmed' else None
+        tw = sum(l[7] for l in mlines)
+        mov_rows.append((mov_id, doc_no, mtype, doc_type, d.isoformat(), src, dst,
+                         end_user, status, round(tw, 3), 0.0, None, 1, _ts(d, rng)))
+        for i, (code, desc, batch, exp, qty, unit, parcel, weight) in enumerate(mlines, 1):
+            ml_rows.append((mov_id, doc_no, i, code, desc, qty, unit, batch, exp,
+                            0.0, 'EUR', 0.0, weight, 0.0, parcel, _ts(d, rng)))
+
+    rng.shuffle(received_parcels)
+    n_dispatch = len(received_parcels) // 10
+    dispatched, remaining = received_parcels[:n_dispatch], received_parcels[n_dispatch:]
+    i = 0
+    while i < len(dispatched):
+        group = dispatched[i:i + rng.randint(5, 20)]
+        i += len(group)
+        src = group[0][1]
+        d   = min(today, max(p[3] for p in group) + timedelta(days=rng.randint(1, 60)))
+        mlines = [(code, desc, batch, exp, qty, pack, pn, 1.0)
+                  for pn, proj, plines, _, _ in group if proj == src
+                  for code, desc, batch, exp, qty, pack in plines]
+        if mlines:
+            _add_movement('OUT', 'OEU', d, src, None, 'Confirmed', mlines, end_user=1)
+
+    # Item-level OUTs (partial quantities) and confirmed INs
+    n_item_movs = max(5, lines // 400)
+    for k in range(n_item_movs):
+        pool = remaining[rng.randrange(len(remaining))] if remaining else None
+        if not pool:
+            break
+        pn, proj, plines, recv_day, _ = pool
+        d = min(today, recv_day + timedelta(days=rng.randint(1, 120)))
+        if k % 3 == 2:
+            mlines = []
+            for _ in range(rng.randint(1, 12)):
+                code, desc, pack, batches = rng.choice(items)
+                batch, exp_d = rng.choice(batches)
+                mlines.append((code, desc, batch, exp_d.isoformat(),
+                               float(rng.choice([5, 10, 25, 50])), pack, None, 0.5))
+            _add_movement('IN', rng.choice(['ILP', 'IDN', 'IMSF']), d, None, proj,
+                          'Confirmed', mlines)
+        else:
+            mlines = [(code, desc, batch, exp, round(qty * rng.uniform(0.05, 0.4)), pack, None, 0.2)
+                      for code, desc, batch, exp, qty, pack in plines[:rng.randint(1, len(plines))]]
+            status = 'Draft' if k % 17 == 0 else 'Confirmed'
+            _add_movement('OUT', rng.choice(['OEU', 'OEXP', 'ODMG']), d, proj, None,
+                          status, mlines, end_user=1)
+
+    conn.executemany('''
+        INSERT INTO movements
+            (id, document_number, movement_type, doc_type, movement_date,
+             source_project, dest_project, end_user_id, status,
+             total_weight_kg, total_volume_m3, notes, created_by, created_at)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    ''', mov_rows)
+    conn.executemany('''
+        INSERT INTO movement_lines
+            (movement_id, document_number, line_no, item_code, item_description,
+             qty, unit, batch_no, exp_date, unit_price, currency, total_value,
+             weight_kg, volume_m3, parcel_number, created_at)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    ''', ml_rows)
+    conn.executemany(
+        "INSERT INTO doc_sequences (doc_type, year, last_seq) VALUES (?, ?, ?)",
+        [(dt, y, n) for (dt, y), n in doc_seq.items()])
+    conn.execute("INSERT INTO end_users (name, user_type) VALUES ('OPD Ward', 'Department')")
+
+    # ── Orders ────────────────────────────────────────────────────────────
+    order_rows, ol_rows = [], []
+    n_orders = max(5, lines // 500)
+    local_seq = {}
+    for oid in range(1, n_orders + 1):
+        proj   = rng.choices(proj_codes, weights=proj_weights)[0]
+        family = rng.choice(['Med', 'Log'])
+        d      = start_day + timedelta(days=rng.randint(0, 3 * 365))
+        if rng.random() < 0.3:
+            otype = 'Local'
+            key = (d.year, proj, family)
+            local_seq[key] = local_seq.get(key, 0) + 1
+            onum = f"{d.strftime('%y')}/{proj}/{family}/LP{local_seq[key]:02d}"
+        else:
+            otype = 'International'
+            onum = f"{d.strftime('%y')}/BE/{proj}/PO{90000 + oid:05d}"
+        order_rows.append((oid, onum, f"{family} order {oid}", d.isoformat(),
+                           (d + timedelta(days=90)).isoformat(), 1, family, proj,
+                           otype, d.isoformat(), 'EUR'))
+        for ln in range(1, rng.randint(5, 40) + 1):
+            code, desc, pack, _ = rng.choices(items, weights=item_weights)[0]
+            qty = rng.choice([10, 50, 100, 500])
+            recv = 0
+            status = 'Pending'
+            if otype == 'Local' and rng.random() < 0.5:
+                recv = qty if rng.random() < 0.6 else qty // 2
+                status = 'Fully Received' if recv == qty else 'Partial'
+            ol_rows.append((oid, onum, ln, code, desc, qty, proj, family, pack,
+                            round(rng.uniform(0.1, 50), 2),
+                            rng.choice([None, 'Requested', 'Approved']),
+                            f"{family} order {oid}", d.isoformat(), 'EUR', otype,
+                            recv, status))
+    conn.executemany('''
+        INSERT INTO orders
+            (id, order_number, order_description, order_generation_date,
+             requested_delivery_date, created_by, order_family, order_project,
+             order_type, stock_date, currency)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?)
+    ''', order_rows)
+    conn.executemany('''
+        INSERT INTO order_lines
+            (order_id, order_number, line_no, item_code, item_description, quantity,
+             project, order_family, packaging, price_per_pack, validation_status,
+             order_description, order_generation_date, currency, order_type,
+             qty_received, reception_status)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    ''', ol_rows)
+
+    # Indexes and triggers last — bulk load is much faster without them
+    for sql in indexes + triggers:
+        conn.execute(sql)
+    conn.commit()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("ANALYZE")
+    conn.close()
+
+    counts = {
+        'basic_data': n_bd, 'cargo_summary': n_cs, 'stock_transactions': n_st,
+        'movements': len(mov_rows), 'movement_lines': len(ml_rows),
+        'orders': len(order_rows), 'order_lines': len(ol_rows),
+        'items': len(items), 'projects': len(PROJECTS),
+    }
+    if verbose:
+        print(f"✅ Fixture DB written to {path} in {time.perf_counter() - t0:.1f}s")
+        for k, v in counts.items():
+            print(f"   {k:<20} {v:>10,}")
+    return counts
+
+
+def fixture_path(lines, seed=42):
+    """Default cache location for a fixture of the given size."""
+    return os.path.join(FIXTURES_DIR, f"inventory_{lines}_s{seed}_v{FIXTURE_VERSION}.db")
+
+
+def ensure_fixture(lines, seed=42, template=TEMPLATE_DB):
+    """Return path to a cached fixture DB, generating it on first use."""
+    path = fixture_path(lines, seed)
+    if not os.path.exists(path):
+        build_fixture_db(path, lines, seed=seed, template=template)
+    return path
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Generate a synthetic MidFlow inventory.db')
+    grp = ap.add_mutually_exclusive_group()
+    grp.add_argument('--preset', choices=sorted(PRESETS), help='10k, 100k or 1m basic_data lines')
+    grp.add_argument('--lines', type=int, help='number of basic_data lines')
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--out', help='output path (default: data/fixtures/inventory_<lines>_s<seed>_v<N>.db)')
+    ap.add_argument('--template', default=TEMPLATE_DB, help='DB to clone the schema from')
+    args = ap.parse_args(argv)
+
+    lines = PRESETS[args.preset] if args.preset else (args.lines or PRESETS['10k'])
+    build_fixture_db(args.out or fixture_path(lines, args.seed), lines,
+                     seed=args.seed, template=args.template)
+
+
+if __name__ == '__main__':
+    main()
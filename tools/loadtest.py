@@ -0,0 +1,331 @@
+"""
+Concurrent barcode-scanner load test.
+
+Simulates N handheld scanners working one warehouse: each session logs in,
+then loops  receive-parcel → change-pallet → parcel list  against a fixture
+DB (tools/gen_fixture_db.py). A share of scans re-scan a parcel another
+scanner already took, the way double scans happen on the floor.
+
+Reports throughput, p50/p95/p99 latency per endpoint, `database is locked`
+counts, and integrity checks on the resulting DB:
+  • no reception number shared by two parcels
+  • no parcel received twice (stock_transactions rows == parcel lines)
+  • every RECEPTION stock_transactions row matches its basic_data line
+    (reception number, item, pallet) and vice versa
+
+By default the app is served in-process by a threaded werkzeug server on a
+scratch copy of the fixture. Use --url/--db to hit an already-running server.
+
+Usage:
+    python tools/loadtest.py --scanners 8 --duration 30
+    python tools/loadtest.py --preset 100k --scanners 10 --iterations 50 --json out.json
+    python tools/loadtest.py --url http://127.0.0.1:5000 --db data/inventory.db --scanners 6
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import queue
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+from tools.gen_fixture_db import PRESETS, ensure_fixture
+
+LOCK_MARKERS = ('database is locked', 'database table is locked', 'database is busy')
+
+
+class Stats:
+    """Thread-safe latency / outcome collector."""
+
+    def __init__(self):
+        self._lock     = threading.Lock()
+        self.latencies = {}          # endpoint → [ms]
+        self.statuses  = {}          # endpoint → {status: count}
+        self.locked    = {}          # endpoint → count of lock errors
+        self.errors    = []          # (endpoint, status, message) samples
+
+    def record(self, endpoint, status, ms, message=''):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(ms)
+            by_status = self.statuses.setdefault(endpoint, {})
+            by_status[status] = by_status.get(status, 0) + 1
+            if any(m in message for m in LOCK_MARKERS):
+                self.locked[endpoint] = self.locked.get(endpoint, 0) + 1
+            elif status >= 500 or status == 0:
+                if len(self.errors) < 20:
+                    self.errors.append((endpoint, status, message[:200]))
+
+
+def _pct(sorted_ms, p):
+    if not sorted_ms:
+        return 0.0
+    idx = min(len(sorted_ms) - 1, max(0, int(round(p / 100.0 * len(sorted_ms))) - 1))
+    return sorted_ms[idx]
+
+
+class Scanner(threading.Thread):
+    """One handheld: own cookie session, pulls parcels off the shared queue."""
+
+    def __init__(self, idx, base_url, username, password, work, received, stats,
+                 stop_at, iterations, dup_rate, think_ms, seed):
+        super().__init__(name=f'scanner-{idx}', daemon=True)
+        self.base_url   = base_url.rstrip('/')
+        self.username   = username
+        self.password   = password
+        self.work       = work
+        self.received   = received
+        self.stats      = stats
+        self.stop_at    = stop_at
+        self.iterations = iterations
+        self.dup_rate   = dup_rate
+        self.think_ms   = think_ms
+        self.rng        = random.Random(seed)
+        self.pallet     = f"PLT{idx:02d}"
+        self.opener     = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.login_ok   = False
+
+    def _call(self, endpoint, method, path, payload=None, form=None):
+        url  = self.base_url + path
+        data = None
+        headers = {}
+        if payload is not None:
+            data = json.dumps(payload).encode()
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode()
+        req = urllib.request.Request(url, data=data, method=method, headers=headers)
+        t0 = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=60) as resp:
+                body, status = resp.read(), resp.status
+        except urllib.error.HTTPError as e:
+            body, status = e.read(), e.code
+        except Exception as e:           # connection reset, timeout …
+            self.stats.record(endpoint, 0, (time.perf_counter() - t0) * 1000, str(e))
+            return 0, {}
+        ms = (time.perf_counter() - t0) * 1000
+        try:
+            js = json.loads(body) if body[:1] in (b'{', b'[') else {}
+        except ValueError:
+            js = {}
+        self.stats.record(endpoint, status, ms, js.get('message', '') if isinstance(js, dict) else '')
+        return status, js
+
+    def run(self):
+        status, _ = self._call('login', 'POST', '/login',
+                               form={'username': self.username, 'password': self.password})
+        # urllib follows the redirect to the dashboard, so success ends on 200
+        self.login_ok = status == 200
+        if not self.login_ok:
+            return
+        done = 0
+        while time.time() < self.stop_at and (not self.iterations or done < self.iterations):
+            if self.received and self.rng.random() < self.dup_rate:
+                parcel, session_id = self.rng.choice(self.received)
+            else:
+                try:
+                    parcel, session_id = self.work.get_nowait()
+                except queue.Empty:
+                    break
+            status, js = self._call('receive-parcel', 'POST', '/api/cargo/receive-parcel',
+                                    payload={'parcel_number': parcel,
+                                             'pallet_number': self.pallet,
+                                             'session_id': session_id or ''})
+            if status == 200 and js.get('success'):
+                self.received.append((parcel, session_id))
+                # Operator moves the parcel to the pallet they are actually building
+                if self.rng.random() < 0.3:
+                    self.pallet = f"PLT{self.rng.randint(1, 99):02d}"
+                self._call('change-pallet', 'PATCH', '/api/cargo/change-pallet',
+                           payload={'parcel_number': parcel, 'new_pallet': self.pallet})
+            q = f"?session_id={urllib.parse.quote(session_id)}" if session_id else ''
+            self._call('parcels', 'GET', '/api/cargo/parcels' + q)
+            done += 1
+            if self.think_ms:
+                time.sleep(self.rng.uniform(0, self.think_ms) / 1000.0)
+
+
+def integrity_checks(db_path):
+    """Return {check_name: [offending rows]} — empty lists mean the DB is consistent."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        checks = {
+            'reception_number_shared_by_parcels': conn.execute('''
+                SELECT reception_number, COUNT(DISTINCT parcel_number)
+                FROM stock_transactions
+                WHERE transaction_type = 'RECEPTION' AND reception_number IS NOT NULL
+                GROUP BY reception_number HAVING COUNT(DISTINCT parcel_number) > 1
+            ''').fetchall(),
+            'parcel_received_twice': conn.execute('''
+                SELECT st.parcel_number, st.n, bd.n
+                FROM (SELECT parcel_number, COUNT(*) AS n FROM stock_transactions
+                      WHERE transaction_type = 'RECEPTION' GROUP BY parcel_number) st
+                JOIN (SELECT parcel_number, COUNT(*) AS n FROM basic_data
+                      GROUP BY parcel_number) bd ON bd.parcel_number = st.parcel_number
+                WHERE st.n > bd.n
+            ''').fetchall(),
+            'transaction_without_matching_line': conn.execute('''
+                SELECT st.id, st.parcel_number, st.reception_number
+                FROM stock_transactions st
+                WHERE st.transaction_type = 'RECEPTION'
+                  AND NOT EXISTS (
+                      SELECT 1 FROM basic_data bd
+                      WHERE bd.parcel_number    = st.parcel_number
+                        AND bd.reception_number = st.reception_number
+                        AND bd.item_code        = st.item_code
+                        AND COALESCE(bd.pallet_number, '') = COALESCE(st.pallet_number, ''))
+            ''').fetchall(),
+            'received_line_without_transaction': conn.execute('''
+                SELECT bd.id, bd.parcel_number, bd.reception_number
+                FROM basic_data bd
+                WHERE bd.reception_status = 'Received' AND bd.reception_number IS NOT NULL
+                  AND COALESCE(bd.order_type, 'International') != 'Local'
+                  AND NOT EXISTS (
+                      SELECT 1 FROM stock_transactions st
+                      WHERE st.transaction_type = 'RECEPTION'
+                        AND st.parcel_number    = bd.parcel_number
+                        AND st.reception_number = bd.reception_number
+                        AND st.item_code        = bd.item_code)
+            ''').fetchall(),
+        }
+    finally:
+        conn.close()
+    return checks
+
+
+def _serve(db_path):
+    """Start the app on a threaded werkzeug server; return (base_url, server)."""
+    import logging
+    from werkzeug.serving import make_server
+    from tools.bench import _load_app
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)   # no per-request log lines
+    app_module = _load_app(db_path)
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Simulate concurrent barcode scanners')
+    grp = ap.add_mutually_exclusive_group()
+    grp.add_argument('--preset', choices=sorted(PRESETS))
+    grp.add_argument('--lines', type=int)
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--url', help='target an already-running server (requires --db)')
+    ap.add_argument('--db', help='DB used by --url server, for integrity checks')
+    ap.add_argument('--scanners', type=int, default=8)
+    ap.add_argument('--duration', type=float, default=20, help='seconds')
+    ap.add_argument('--iterations', type=int, default=0, help='max scans per scanner (0 = until duration)')
+    ap.add_argument('--dup-rate', type=float, default=0.05, help='share of re-scans of received parcels')
+    ap.add_argument('--think-ms', type=float, default=0, help='max random pause between scans')
+    ap.add_argument('--username', default='admin')
+    ap.add_argument('--password', default='admin123')
+    ap.add_argument('--json', help='write the report as JSON here')
+    args = ap.parse_args(argv)
+
+    if args.url and not args.db:
+        ap.error('--url needs --db so the integrity checks can read the same database')
+
+    scratch_dir = server = None
+    if args.url:
+        base_url, db_path = args.url, args.db
+    else:
+        lines   = PRESETS[args.preset] if args.preset else (args.lines or PRESETS['10k'])
+        fixture = ensure_fixture(lines, seed=args.seed)
+        scratch_dir = tempfile.mkdtemp(prefix='midflow_load_')
+        db_path = os.path.join(scratch_dir, 'inventory.db')
+        shutil.copyfile(fixture, db_path)
+        base_url, server = _serve(db_path)
+
+    try:
+        conn = sqlite3.connect(db_path)
+        pending = conn.execute('''
+            SELECT parcel_number, MAX(cargo_session_id) FROM basic_data
+            WHERE reception_status = 'Pending' AND parcel_number IS NOT NULL
+            GROUP BY parcel_number
+        ''').fetchall()
+        conn.close()
+        random.Random(args.seed).shuffle(pending)
+        work = queue.Queue()
+        for p in pending:
+            work.put(p)
+
+        stats, received = Stats(), []
+        stop_at = time.time() + args.duration
+        scanners = [Scanner(i + 1, base_url, args.username, args.password, work, received,
+                            stats, stop_at, args.iterations, args.dup_rate, args.think_ms,
+                            args.seed + i)
+                    for i in range(args.scanners)]
+        print(f"Running {args.scanners} scanners against {base_url} "
+              f"({len(pending):,} pending parcels, {args.duration:.0f}s max)")
+        t0 = time.perf_counter()
+        for s in scanners:
+            s.start()
+        for s in scanners:
+            s.join()
+        elapsed = time.perf_counter() - t0
+        if not all(s.login_ok for s in scanners):
+            print("❌ Login failed for one or more scanners")
+            return 2
+
+        report = {'scanners': args.scanners, 'elapsed_s': round(elapsed, 2), 'endpoints': {}}
+        total = 0
+        print(f"\n{'endpoint':<16}{'count':>8}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+              f"{'locked':>8}  statuses")
+        for ep, samples in sorted(stats.latencies.items()):
+            s = sorted(samples)
+            total += len(s)
+            row = {
+                'count':    len(s),
+                'rps':      round(len(s) / elapsed, 1),
+                'p50_ms':   round(_pct(s, 50), 1),
+                'p95_ms':   round(_pct(s, 95), 1),
+                'p99_ms':   round(_pct(s, 99), 1),
+                'locked':   stats.locked.get(ep, 0),
+                'statuses': stats.statuses.get(ep, {}),
+            }
+            report['endpoints'][ep] = row
+            print(f"{ep:<16}{row['count']:>8}{row['rps']:>9}{row['p50_ms']:>9}{row['p95_ms']:>9}"
+                  f"{row['p99_ms']:>9}{row['locked']:>8}  {row['statuses']}")
+        report['throughput_rps'] = round(total / elapsed, 1)
+        report['lock_errors']    = sum(stats.locked.values())
+        report['other_errors']   = stats.errors
+        print(f"\nThroughput {report['throughput_rps']} req/s over {elapsed:.1f}s, "
+              f"{report['lock_errors']} lock error(s)")
+        for ep, status, msg in stats.errors[:5]:
+            print(f"   {ep} HTTP {status}: {msg}")
+
+        checks = integrity_checks(db_path)
+        report['integrity'] = {k: len(v) for k, v in checks.items()}
+        failed = {k: v for k, v in checks.items() if v}
+        print("\nIntegrity:")
+        for name, rows in checks.items():
+            mark = '❌' if rows else '✅'
+            print(f"   {mark} {name:<36} {len(rows)}" + (f"   e.g. {rows[0]}" if rows else ''))
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2, default=str)
+        return 1 if failed else 0
+    finally:
+        if server:
+            server.shutdown()
+        if scratch_dir:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
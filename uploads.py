@@ -0,0 +1,193 @@
+"""
+Chunked, resumable uploads.
+
+A client opens a session (POST /api/uploads), then PUTs fixed-size chunks
+at increasing offsets, each with a SHA-256 or CRC32 checksum. After a
+dropped connection it asks for the current offset and carries on from
+there. Chunks are appended straight to a .part file on disk, and the
+finished file is handed to the consuming endpoint (import preview, backup
+restore) with take().
+"""
+import json
+import os
+import threading
+import time
+import uuid
+import hashlib
+import zlib
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CHUNK_SIZE     = 8 * 1024 * 1024       # stays under MAX_CONTENT_LENGTH
+MAX_UPLOAD_SIZE    = 2 * 1024 * 1024 * 1024
+STALE_AFTER_S      = 24 * 3600
+
+
+class UploadError(Exception):
+    """Upload protocol error; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra  = extra
+
+
+class UploadStore:
+    def __init__(self, root):
+        self.root   = root
+        self._locks = {}                      # upload_id → lock serialising its chunks
+        self._guard = threading.Lock()        # protects _locks only
+        os.makedirs(root, exist_ok=True)
+
+    # ── paths / metadata ─────────────────────────────────────────────
+    def _part(self, upload_id):
+        return os.path.join(self.root, f'{upload_id}.part')
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.root, f'{upload_id}.json')
+
+    def _check_id(self, upload_id):
+        try:
+            uuid.UUID(upload_id)
+        except (ValueError, TypeError):
+            raise UploadError('Unknown upload', 404)
+        if not os.path.exists(self._meta_path(upload_id)):
+            raise UploadError('Unknown upload', 404)
+
+    def _load(self, upload_id, user_id):
+        self._check_id(upload_id)
+        try:
+            with open(self._meta_path(upload_id)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Unknown upload', 404)
+        if meta['user_id'] != user_id:
+            raise UploadError('Unknown upload', 404)
+        return meta
+
+    def _save(self, meta):
+        tmp = self._meta_path(meta['upload_id']) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._meta_path(meta['upload_id']))
+
+    def _discard(self, upload_id):
+        for path in (self._part(upload_id), self._meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._guard:
+            self._locks.pop(upload_id, None)
+
+    def _lock_for(self, upload_id):
+        """One lock per upload, so a slow fsync only holds up that upload."""
+        self._check_id(upload_id)
+        with self._guard:
+            return self._locks.setdefault(upload_id, threading.Lock())
+
+    # ── protocol ─────────────────────────────────────────────────────
+    def create(self, filename, size, user_id, chunk_size=None, sha256=None):
+        if not filename:
+            raise UploadError('filename is required')
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            raise UploadError('size is required')
+        if size <= 0 or size > MAX_UPLOAD_SIZE:
+            raise UploadError('Invalid upload size')
+        chunk_size = min(int(chunk_size or DEFAULT_CHUNK_SIZE), MAX_CHUNK_SIZE)
+        self.purge_stale()
+
+        upload_id = str(uuid.uuid4())
+        open(self._part(upload_id), 'wb').close()
+        meta = {
+            'upload_id':  upload_id,
+            'filename':   filename,
+            'size':       size,
+            'chunk_size': chunk_size,
+            'sha256':     (sha256 or '').lower() or None,
+            'received':   0,
+            'user_id':    user_id,
+            'created':    time.time(),
+            'updated':    time.time(),
+        }
+        self._save(meta)
+        return self.status_of(meta)
+
+    def status(self, upload_id, user_id):
+        return self.status_of(self._load(upload_id, user_id))
+
+    @staticmethod
+    def status_of(meta):
+        return {
+            'upload_id':  meta['upload_id'],
+            'filename':   meta['filename'],
+            'size':       meta['size'],
+            'chunk_size': meta['chunk_size'],
+            'offset':     meta['received'],
+            'complete':   meta['received'] >= meta['size'],
+        }
+
+    def write_chunk(self, upload_id, user_id, offset, data, sha256=None, crc32=None):
+        """Append one chunk at `offset`. Re-sending an already stored chunk
+        is harmless; a gap or a checksum mismatch is rejected."""
+        with self._lock_for(upload_id):
+            meta = self._load(upload_id, user_id)
+            if offset != meta['received']:
+                if offset < meta['received'] and offset + len(data) <= meta['received']:
+                    return self.status_of(meta)       # duplicate of a stored chunk
+                raise UploadError('Offset mismatch', 409, offset=meta['received'])
+            if not data or len(data) > meta['chunk_size']:
+                raise UploadError('Invalid chunk size')
+            if offset + len(data) > meta['size']:
+                raise UploadError('Chunk past end of file')
+            if sha256:
+                if hashlib.sha256(data).hexdigest() != sha256.lower():
+                    raise UploadError('Chunk checksum mismatch', 422, offset=meta['received'])
+            elif crc32:
+                if f'{zlib.crc32(data) & 0xffffffff:08x}' != crc32.lower().rjust(8, '0'):
+                    raise UploadError('Chunk checksum mismatch', 422, offset=meta['received'])
+            else:
+                raise UploadError('A chunk checksum (X-Chunk-Sha256 or X-Chunk-Crc32) is required')
+
+            with open(self._part(upload_id), 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+            meta['received'] = offset + len(data)
+            meta['updated']  = time.time()
+            self._save(meta)
+            return self.status_of(meta)
+
+    def take(self, upload_id, user_id, dest_path):
+        """Move a completed upload to dest_path; returns its original filename."""
+        with self._lock_for(upload_id):
+            meta = self._load(upload_id, user_id)
+            if meta['received'] < meta['size']:
+                raise UploadError('Upload is not complete', 409, offset=meta['received'])
+            part = self._part(upload_id)
+            if meta['sha256']:
+                digest = hashlib.sha256()
+                with open(part, 'rb') as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(block)
+                if digest.hexdigest() != meta['sha256']:
+                    self._discard(upload_id)
+                    raise UploadError('File checksum mismatch — upload again', 422)
+            os.makedirs(os.path.dirname(dest_path) or '.', exist_ok=True)
+            os.replace(part, dest_path)
+            self._discard(upload_id)
+            return meta['filename']
+
+    def purge_stale(self, max_age=STALE_AFTER_S):
+        cutoff = time.time() - max_age
+        for name in os.listdir(self.root):
+            if name.endswith('.json'):
+                path = os.path.join(self.root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        self._discard(name[:-5])
+                except OSError:
+                    pass
@@ -1,7 +1,9 @@
-from datetime import datetime
+from datetime import datetime, date
 from dateutil import parser
 import re
 
+_ISO_DATE_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})')
+
 def normalize_number(value):
     """
     Normalize number input:
@@ -57,6 +59,29 @@ def normalize_date(date_input, output_format='%d-%b-%Y'):
     except (ValueError, TypeError):
         return None
 
+def iso_date(date_input):
+    """
+    Convert any date format to a sortable YYYY-MM-DD string for storage
+    Accepts: date/datetime, YYYY-MM-DD[ HH:MM:SS], anything normalize_date accepts
+    Returns: '2026-02-21', or None for empty / 'N/A' / unparseable input
+    """
+    if not date_input:
+        return None
+
+    if isinstance(date_input, (datetime, date)):
+        return date_input.strftime('%Y-%m-%d')
+
+    text = str(date_input).strip()
+    m = _ISO_DATE_RE.match(text)
+    if m:
+        try:
+            return date(int(m.group(1)), int(m.group(2)), int(m.group(3))).isoformat()
+        except ValueError:
+            return None
+    if text.upper() in ('N/A', 'NA', '-'):
+        return None
+    return normalize_date(text, '%Y-%m-%d')
+
 def format_excel_number(value, locale='en'):
     """
     Format number for Excel export based on locale
@@ -83,4 +108,8 @@ if __name__ == '__main__':
     
     print(normalize_date("2026-02-21"))   # 21-Feb-2026
     print(normalize_date("21/02/2026"))   # 21-Feb-2026
-    print(normalize_date("02-21-2026"))   # 21-Feb-2026
\ No newline at end of file
+    print(normalize_date("02-21-2026"))   # 21-Feb-2026
+
+    print(iso_date("21/02/2026"))         # 2026-02-21
+    print(iso_date("21-Feb-2026"))        # 2026-02-21
+    print(iso_date("N/A"))                # None
\ No newline at end of file
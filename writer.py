@@ -0,0 +1,213 @@
+"""
+Single-writer queue with group commit.
+
+SQLite has one write lock per database file. Instead of every request
+thread taking it with its own BEGIN IMMEDIATE ... COMMIT, a WriteQueue owns
+one connection on a dedicated thread. Request threads submit units of work
+(callables taking that connection) and get a Future back. The writer drains
+whatever is queued, runs up to max_batch units inside one transaction (each
+under its own SAVEPOINT, so a failing unit only undoes itself) and commits
+them together; every future resolves once that commit has happened.
+
+Units of work must not commit or roll back themselves. To undo its own
+writes and still answer normally (e.g. "already received"), a unit raises
+Rollback(value).
+"""
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from database import begin_immediate
+import metrics
+
+
+class Rollback(Exception):
+    """Undo the current unit of work's writes; its future resolves to `value`."""
+
+    def __init__(self, value=None):
+        super().__init__()
+        self.value = value
+
+
+def run_in_transaction(conn, fn, *args, name='db', **kwargs):
+    """Run one unit of work on `conn` as its own write transaction — the same
+    contract as WriteQueue.submit, without the queue."""
+    begin_immediate(conn, name)
+    try:
+        result = fn(conn, *args, **kwargs)
+    except Rollback as r:
+        conn.rollback()
+        return r.value
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return result
+
+
+class WriteQueue:
+    def __init__(self, connect, name='writer', max_batch=32, max_delay_s=0.0, timeout_s=30):
+        """
+        connect     — callable returning a new sqlite3 connection (opened on the writer thread)
+        max_batch   — most units committed together
+        max_delay_s — how long to wait for more units once one arrives (0 = only
+                      group what is already queued, no added latency)
+        timeout_s   — how long run() waits for the commit
+        """
+        self.connect     = connect
+        self.name        = name
+        self.max_batch   = max_batch
+        self.max_delay_s = max_delay_s
+        self.timeout_s   = timeout_s
+        self._queue      = queue.Queue()
+        self._lock       = threading.Lock()
+        self._thread     = None
+        self.groups = self.units = self.failed_units = self.failed_groups = 0
+        metrics.register(name, self.stats)
+
+    # ── submitting ───────────────────────────────────────────────────
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(conn, *args, **kwargs); the Future resolves to its return
+        value after the commit, or to the exception it (or the commit) raised."""
+        future = Future()
+        self._queue.put((fn, args, kwargs, future, time.perf_counter()))
+        self._ensure_thread()
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        """submit() and wait for the commit. A unit still queued after
+        timeout_s is withdrawn and reported as a busy database."""
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return future.result(self.timeout_s)
+        except FutureTimeout:
+            if future.cancel():
+                metrics.incr(f'{self.name}.timeouts')
+                raise sqlite3.OperationalError('database is busy (write queue timeout)')
+            return future.result()      # already running: its commit is imminent
+
+    def close(self):
+        """Finish the queued units and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    # ── writer thread ────────────────────────────────────────────────
+    def _loop(self):
+        conn = self.connect()
+        try:
+            stopping = False
+            while not stopping:
+                job = self._queue.get()
+                if job is None:
+                    break
+                batch    = [job]
+                deadline = time.perf_counter() + self.max_delay_s
+                while len(batch) < self.max_batch:
+                    try:
+                        wait = deadline - time.perf_counter()
+                        job = self._queue.get(timeout=wait) if wait > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        stopping = True
+                        break
+                    batch.append(job)
+                self._commit_group(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit_group(self, conn, batch):
+        started = time.perf_counter()
+        for *_, queued_at in batch:
+            metrics.observe(f'{self.name}.queue_wait_ms', (started - queued_at) * 1000)
+        batch = [job for job in batch if job[3].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            begin_immediate(conn, self.name)
+        except Exception as e:
+            self._fail(batch, e)
+            return
+
+        outcomes = []                   # (future, result, exception)
+        for fn, args, kwargs, future, _ in batch:
+            conn.execute("SAVEPOINT unit")
+            try:
+                outcomes.append((future, fn(conn, *args, **kwargs), None))
+            except Rollback as r:
+                outcomes.append((future, r.value, None))
+                self._undo_unit(conn)
+                continue
+            except Exception as e:
+                self.failed_units += 1
+                outcomes.append((future, None, e))
+                if not self._undo_unit(conn):
+                    # The transaction itself is gone: nothing in it was kept
+                    self._fail([job for job in batch if not job[3].done()], e)
+                    return
+                continue
+            conn.execute("RELEASE unit")
+
+        try:
+            conn.commit()
+        except Exception as e:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            self._fail(batch, e)
+            return
+
+        self.groups += 1
+        self.units  += len(batch)
+        metrics.observe(f'{self.name}.group_size', len(batch))
+        metrics.observe(f'{self.name}.group_ms', (time.perf_counter() - started) * 1000)
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    @staticmethod
+    def _undo_unit(conn):
+        """Roll back to the unit's savepoint; False if the transaction was lost."""
+        try:
+            conn.execute("ROLLBACK TO unit")
+            conn.execute("RELEASE unit")
+            return True
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            return False
+
+    def _fail(self, batch, error):
+        self.failed_groups += 1
+        for job in batch:
+            if not job[3].done():
+                job[3].set_exception(error)
+
+    def stats(self):
+        return {
+            'running':       bool(self._thread and self._thread.is_alive()),
+            'queued':        self._queue.qsize(),
+            'groups':        self.groups,
+            'units':         self.units,
+            'avg_group':     round(self.units / self.groups, 2) if self.groups else None,
+            'failed_units':  self.failed_units,
+            'failed_groups': self.failed_groups,
+        }